@@ -0,0 +1,100 @@
+import argparse
+import os
+import tempfile
+import time
+
+from ..connection import connection_profiles, create_sqlite_engine, deferred_foreign_keys
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+# Show what the connection profiles buy us: the same load of a parent/child pair of tables
+# shaped like resource/resource_column followed by a point-lookup and a scan workload, once per
+# profile, each against a fresh database file.
+#
+#   python -m cleanknit.bench.connection_profiles --resources 20000 --columns 20
+
+_ddl = [
+    "CREATE TABLE parent (id TEXT PRIMARY KEY, name TEXT, payload TEXT)",
+    """CREATE TABLE child (parent_id TEXT REFERENCES parent (id), n INTEGER, name TEXT,
+        description TEXT, PRIMARY KEY (parent_id, n))""",
+]
+
+
+def run_profile(profile, directory, n_resources, n_columns, batch_size=5000):
+    path = os.path.join(directory, profile + ".db")
+    # one connection for the whole run, as the loaders assume
+    engine = create_sqlite_engine("sqlite:///" + path, profile=profile, poolclass=StaticPool)
+    S = Session(bind=engine)
+    conn = S.connection()
+    for ddl in _ddl:
+        conn.exec_driver_sql(ddl)
+    S.commit()
+
+    parents = [
+        ("%04x-%04x" % divmod(i, 65536), "resource %d" % i, "x" * 200) for i in range(n_resources)
+    ]
+    children = (
+        (p[0], j, "column %d" % j, "description of column %d" % j)
+        for p in parents
+        for j in range(n_columns)
+    )
+
+    timings = {}
+    t0 = time.perf_counter()
+    with deferred_foreign_keys(S) if profile == "bulk-load" else _nothing():
+        conn = S.connection()
+        conn.exec_driver_sql("INSERT INTO parent VALUES (?, ?, ?)", parents)
+        batch = []
+        for c in children:
+            batch.append(c)
+            if len(batch) >= batch_size:
+                conn.exec_driver_sql("INSERT INTO child VALUES (?, ?, ?, ?)", batch)
+                S.commit()
+                conn = S.connection()
+                batch = []
+        if batch:
+            conn.exec_driver_sql("INSERT INTO child VALUES (?, ?, ?, ?)", batch)
+        S.commit()
+    timings["load"] = time.perf_counter() - t0
+
+    conn = S.connection()
+    t0 = time.perf_counter()
+    for p in parents[:: max(1, n_resources // 2000)]:
+        conn.exec_driver_sql("SELECT count(*) FROM child WHERE parent_id = ?", (p[0],)).scalar()
+    timings["lookups"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    conn.exec_driver_sql(
+        "SELECT p.name, count(*), max(length(c.description)) FROM parent AS p "
+        "JOIN child AS c ON (c.parent_id = p.id) GROUP BY p.name ORDER BY 2 DESC LIMIT 10"
+    ).fetchall()
+    timings["scan"] = time.perf_counter() - t0
+    S.close()
+    engine.dispose()
+    return timings
+
+
+class _nothing:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--resources", type=int, default=20000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--profiles", nargs="*", default=list(connection_profiles))
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("%-18s %10s %10s %10s" % ("profile", "load", "lookups", "scan"))
+        for profile in args.profiles:
+            t = run_profile(profile, directory, args.resources, args.columns)
+            print("%-18s %10.3f %10.3f %10.3f" % (profile, t["load"], t["lookups"], t["scan"]))
+
+
+if __name__ == "__main__":
+    main()
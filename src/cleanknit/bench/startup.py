@@ -0,0 +1,117 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Cold start of the soc command. `soc search` is run from scripts and Excel thousands of times
+# a day so it has a budget (~100 ms wall, including the interpreter) and must not import any
+# of the heavy dependencies. Each command is run repeatedly in a fresh interpreter and the best
+# time is taken, which is what a warm disk cache gives you. The bare interpreter start is
+# reported alongside as the floor.
+#
+#   python -m cleanknit.bench.startup --budget 0.1
+
+# modules that only the heavier subcommands are allowed to import
+heavy_modules = ("sqlalchemy", "structlog", "numpy", "aiohttp", "cmd2", "rich", "textual", "argopt")
+
+
+def time_command(argv, runs=10):
+    """
+    the best wall time in seconds of running argv in a fresh interpreter"""
+    best = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def imported_heavy_modules(argv):
+    """
+    the heavy_modules that get imported when running argv, from -X importtime"""
+    r = subprocess.run(
+        [argv[0], "-X", "importtime"] + argv[1:],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    found = set()
+    for line in r.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        name = line.rsplit("|", 1)[-1].strip()
+        top = name.split(".", 1)[0]
+        if top in heavy_modules:
+            found.add(top)
+    return sorted(found)
+
+
+def make_rule4(directory, n_resources=200, n_columns=10):
+    """
+    a small rule4 database with a search index and catalog snapshot to run soc search and soc
+    catalog against"""
+    from ..connection import create_sqlite_engine
+    from ..cli.soc import create_socrata_rule4, rule4_session
+    from ..socrata.catalogsnapshot import catalog_snapshot_path, write_catalog_snapshot
+    from ..socrata.search import create_search_index, rebuild_search_index
+    from . import synthetic
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        resource_list = synthetic.write_catalogs(".", 1, n_resources, n_columns)
+        path = os.path.join(directory, "rule4.db")
+        S = rule4_session(create_sqlite_engine("sqlite://", profile="bulk-load"), path)
+        create_socrata_rule4(S, resource_list, streaming=True)
+        create_search_index(S)
+        rebuild_search_index(S)
+        write_catalog_snapshot(S, catalog_snapshot_path(path), path)
+        S.close()
+    finally:
+        os.chdir(cwd)
+    return path
+
+
+def commands(database):
+    soc = [sys.executable, "-m", "cleanknit.cli.main"]
+    return dict(
+        help=soc + ["--help"],
+        search=soc + ["search", "--database", database, "housing", "perm"],
+        search_json=soc + ["search", "--database", database, "--json", "water"],
+        catalog=soc + ["catalog", "--database", database, "--domain", "data0.example.gov"],
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="soc cold start")
+    parser.add_argument("--budget", type=float, default=0.1, help="seconds")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        database = make_rule4(directory)
+        floor = time_command([sys.executable, "-c", "pass"], args.runs)
+        print("%-14s %8.1f ms" % ("python", floor * 1000))
+        for name, command in commands(database).items():
+            seconds = time_command(command, args.runs)
+            heavy = imported_heavy_modules(command)
+            over = seconds > args.budget
+            failed = failed or over or bool(heavy)
+            print(
+                "%-14s %8.1f ms%s%s"
+                % (
+                    name,
+                    seconds * 1000,
+                    "  OVER BUDGET" if over else "",
+                    "  imports %s" % ", ".join(heavy) if heavy else "",
+                )
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
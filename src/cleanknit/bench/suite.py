@@ -0,0 +1,440 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pysqlite3
+import sqlalchemy
+import structlog
+from sqlalchemy import MetaData, Table, create_engine, sql
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.schema import CreateTable
+
+from . import synthetic
+
+try:
+    # not available on Windows, where peak RSS is simply not reported
+    import resource as rusage
+except ImportError:
+    rusage = None
+
+# Benchmarks for the ingestion and metadata code against deterministic synthetic data (see
+# synthetic.py). Each benchmark runs in a fresh process so that its peak RSS is its own and
+# reports the wall time of the part being measured (the setup is not timed), rows/s and
+# peak RSS. The results are written as JSON and can be compared against a baseline from an
+# earlier run, in which case anything that got slower or bigger than the tolerance allows
+# fails the run.
+#
+#   python -m cleanknit.bench.suite --output baseline.json
+#   ... change things ...
+#   python -m cleanknit.bench.suite --baseline baseline.json --output results.json
+
+default_params = dict(
+    domains=2, resources=500, columns=20, rows=50000, queries=200, seed=0, repeat=1
+)
+
+
+def _session(rule4=True):
+    from ..socrata.model import _socrata_sqlalchemy_metadata
+
+    # sqlite:// uses the SingletonThreadPool so the attached schema and the raw connection
+    # used by backup_schema are all the one connection
+    S = Session(bind=create_engine("sqlite://", module=pysqlite3))
+    if rule4:
+        S.execute("ATTACH DATABASE ':memory:' AS socrata")
+        S.commit()
+        _socrata_sqlalchemy_metadata.create_all(bind=S.connection())
+        S.commit()
+    return S
+
+
+def _rule4_counts(S):
+    from ..socrata.model import resource, resource_column
+
+    n = S.execute(sql.select(sql.func.count()).select_from(resource)).scalar()
+    n += S.execute(sql.select(sql.func.count()).select_from(resource_column)).scalar()
+    S.rollback()
+    return n
+
+
+def _loaded(params, streaming=True):
+    from ..cli.soc import create_socrata_rule4
+
+    resource_list = synthetic.write_catalogs(
+        ".", params["domains"], params["resources"], params["columns"], params["seed"]
+    )
+    S = _session()
+    create_socrata_rule4(S, resource_list, streaming=streaming)
+    return S, resource_list
+
+
+def _dataset_metadata(params, schema):
+    from ..socrata.model import sa_column_for
+
+    metadata = MetaData(schema=schema)
+    for domain in synthetic.domain_names(params["domains"]):
+        catalog = synthetic.make_catalog(
+            domain, params["resources"], params["columns"], params["seed"]
+        )
+        for r in catalog["results"]:
+            res = r["resource"]
+            Table(
+                res["id"],
+                metadata,
+                *[
+                    sa_column_for(*c)
+                    for c in zip(
+                        res["columns_field_name"],
+                        res["columns_datatype"],
+                        res["columns_description"],
+                    )
+                ],
+            )
+    return metadata
+
+
+def bench_rule4_load(params, streaming=False):
+    from ..cli.soc import create_socrata_rule4
+
+    resource_list = synthetic.write_catalogs(
+        ".", params["domains"], params["resources"], params["columns"], params["seed"]
+    )
+    S = _session()
+    t0 = time.perf_counter()
+    create_socrata_rule4(S, resource_list, streaming=streaming)
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=_rule4_counts(S))
+
+
+def bench_rule4_load_streaming(params):
+    return bench_rule4_load(params, streaming=True)
+
+
+def bench_backup_schema(params):
+    from ..munge import backup_schema
+
+    S, _ = _loaded(params)
+    t0 = time.perf_counter()
+    backup_schema(S, "socrata", "sqlite:///backup.db", pages=-1)
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=_rule4_counts(S))
+
+
+def bench_create_tables_in_schema(params):
+    from ..munge import create_tables_in_schema
+
+    metadata = _dataset_metadata(params, "bench")
+    S = _session(rule4=False)
+    t0 = time.perf_counter()
+    create_tables_in_schema(S, "bench", metadata)
+    S.commit()
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=len(metadata.tables))
+
+
+def bench_reflect_schema(params):
+    from .. import munge
+
+    S, _ = _loaded(params)
+    munge.create_tables_in_schema(S, "bench", _dataset_metadata(params, "bench"))
+    S.commit()
+    t0 = time.perf_counter()
+    metadata = munge.reflect_schema(S, "bench")
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=sum(len(t.columns) for t in metadata.tables.values()))
+
+
+def bench_as_sa_table_ddl(params):
+    from ..socrata.model import Resource
+
+    S, _ = _loaded(params)
+    resources = S.query(Resource).options(selectinload(Resource.columns)).all()
+    dialect = S.bind.dialect
+    t0 = time.perf_counter()
+    metadata = MetaData()
+    n = 0
+    for r in resources:
+        if not r.columns:
+            continue
+        n += len(str(CreateTable(r.as_sa_table(metadata, schema="bench")).compile(dialect=dialect)))
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=len(metadata.tables), ddl_bytes=n)
+
+
+def bench_fts_rebuild(params):
+    from ..socrata.search import create_search_index, rebuild_search_index
+
+    S, _ = _loaded(params)
+    create_search_index(S)
+    t0 = time.perf_counter()
+    rebuild_search_index(S)
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=_rule4_counts(S))
+
+
+def bench_fts_search(params):
+    import random
+
+    from ..socrata.search import SearchIndex, create_search_index, rebuild_search_index
+
+    S, _ = _loaded(params)
+    create_search_index(S)
+    rebuild_search_index(S)
+    index = SearchIndex(S)
+    rnd = random.Random(params["seed"])
+    queries = []
+    for _ in range(params["queries"]):
+        words = rnd.sample(synthetic._words, rnd.randint(1, 2))
+        # some of them as if still being typed
+        if rnd.random() < 0.5:
+            words[-1] = words[-1][: rnd.randint(2, len(words[-1]))]
+        queries.append(" ".join(words))
+    t0 = time.perf_counter()
+    n = 0
+    for q in queries:
+        # the cache is not what is being measured
+        index.invalidate()
+        n += len(index.search(q))
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=len(queries), results=n)
+
+
+def _delimited(params):
+    from ..cli.soc import create_socrata_rule4
+
+    # one resource is enough, it is the rows that count
+    resource_list = synthetic.write_catalogs(".", 1, 1, params["columns"], params["seed"])
+    S = _session()
+    create_socrata_rule4(S, resource_list)
+    domain = resource_list["results"][0]["domain"]
+    result = synthetic.make_catalog(domain, 1, params["columns"], params["seed"])["results"][0]
+    path = synthetic.write_csv(
+        result["resource"]["id"] + ".csv", result, params["rows"], params["seed"]
+    )
+    return S, path
+
+
+def bench_load_delimited(params):
+    from ..socrata.dataset import load_delimited
+
+    S, path = _delimited(params)
+    t0 = time.perf_counter()
+    n = load_delimited(S, path)
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=n)
+
+
+def _snapshot(params):
+    from ..socrata.dataset import load_delimited, resource_id_from_path
+    from ..socrata.snapshot import write_snapshot
+
+    S, path = _delimited(params)
+    S.execute("ATTACH DATABASE 'datasets.db' AS datasets")
+    S.commit()
+    load_delimited(S, path, schema="datasets", spatial_index=False)
+    t0 = time.perf_counter()
+    snapshot = write_snapshot(S, resource_id_from_path(path), "snapshots", "datasets", path)
+    return snapshot, time.perf_counter() - t0
+
+
+def bench_snapshot_write(params):
+    snapshot, seconds = _snapshot(params)
+    return dict(seconds=seconds, rows=snapshot.n_rows)
+
+
+def bench_snapshot_group_by(params):
+    from ..socrata.snapshot import Snapshot
+
+    snapshot, _ = _snapshot(params)
+    # a fresh reader, so the timing includes mapping the files
+    snapshot = Snapshot(snapshot.path)
+    strings = [c for c in snapshot.columns if snapshot.kind(c) == "string"]
+    numbers = [c for c in snapshot.columns if snapshot.kind(c) in ("int64", "float64")]
+    t0 = time.perf_counter()
+    n = 0
+    for key in strings:
+        for value in numbers:
+            n += len(snapshot.group_by(key, value, "sum"))
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=snapshot.n_rows * len(strings) * len(numbers), groups=n)
+
+
+def bench_spatial_join(params):
+    import random
+
+    from ..socrata.geometry import Geometry
+    from ..socrata.spatial import create_spatial_index, spatial_join
+
+    # rows address points against a grid of square lots (each with a courtyard hole)
+    S = _session(rule4=False)
+    metadata = MetaData()
+    points = Table("points", metadata, sqlalchemy.Column("the_geom", Geometry))
+    lots = Table("lots", metadata, sqlalchemy.Column("the_geom", Geometry))
+    metadata.create_all(bind=S.connection())
+    rnd = random.Random(params["seed"])
+    n = 100
+    S.execute(
+        points.insert(),
+        [
+            dict(the_geom="POINT (%f %f)" % (rnd.uniform(0, n), rnd.uniform(0, n)))
+            for _ in range(params["rows"])
+        ],
+    )
+    lot = "POLYGON ((%d %d, %d %d, %d %d, %d %d, %d %d), (%s %s, %s %s, %s %s, %s %s, %s %s))"
+    S.execute(
+        lots.insert(),
+        [
+            dict(
+                the_geom=lot
+                % (
+                    (x, y, x + 1, y, x + 1, y + 1, x, y + 1, x, y)
+                    + (x + 0.4, y + 0.4, x + 0.6, y + 0.4, x + 0.6, y + 0.6)
+                    + (x + 0.4, y + 0.6, x + 0.4, y + 0.4)
+                )
+            )
+            for x in range(n)
+            for y in range(n)
+        ],
+    )
+    S.commit()
+    t0 = time.perf_counter()
+    create_spatial_index(S, "lots", "the_geom")
+    pairs = spatial_join(S, "points", "the_geom", "lots", "the_geom", into="point_lot")
+    S.commit()
+    seconds = time.perf_counter() - t0
+    return dict(seconds=seconds, rows=params["rows"], pairs=pairs)
+
+
+benchmarks = dict(
+    (name[len("bench_") :], f)
+    for name, f in list(globals().items())
+    if name.startswith("bench_") and callable(f)
+)
+
+
+def _peak_rss_kb():
+    if rusage is None:
+        return None
+    peak = rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB everywhere else
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _run_one(name, params):
+    # quiet the loaders so we are not timing the log output
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+    best = None
+    for _ in range(params["repeat"]):
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            # the catalog loaders expect the <domain>.json files in the current directory
+            os.chdir(directory)
+            try:
+                r = benchmarks[name](params)
+            finally:
+                os.chdir(cwd)
+        if best is None or r["seconds"] < best["seconds"]:
+            best = r
+    best["wall_seconds"] = best.pop("seconds")
+    best["rows_per_second"] = best["rows"] / best["wall_seconds"] if best["wall_seconds"] else None
+    best["peak_rss_kb"] = _peak_rss_kb()
+    return best
+
+
+def run(names=None, **params):
+    """
+    run the named benchmarks (default all), each in a freshly spawned process, and return
+    the results document"""
+    params = dict(default_params, **params)
+    names = list(benchmarks) if not names else names
+    results = {}
+    # spawn rather than fork so the child's peak RSS does not start out as ours
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = pool.submit(_run_one, name, params).result()
+    return dict(
+        params=params,
+        environment=dict(
+            python=platform.python_version(),
+            sqlite=pysqlite3.sqlite_version,
+            sqlalchemy=sqlalchemy.__version__,
+            platform=platform.platform(),
+        ),
+        benchmarks=results,
+    )
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    the (benchmark, measure, baseline, now) tuples for the measures that regressed by more
+    than tolerance (a fraction) relative to the baseline"""
+    if results["params"] != baseline["params"]:
+        raise ValueError(
+            "baseline was run with different parameters %s" % json.dumps(baseline["params"])
+        )
+    regressions = []
+    for name, r in results["benchmarks"].items():
+        b = baseline["benchmarks"].get(name, None)
+        if b is None:
+            continue
+        for measure in ("wall_seconds", "peak_rss_kb"):
+            if r.get(measure) is None or b.get(measure) is None:
+                continue
+            if r[measure] > b[measure] * (1.0 + tolerance):
+                regressions.append((name, measure, b[measure], r[measure]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CleanKnit benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run: %s" % ", ".join(benchmarks))
+    for k, v in default_params.items():
+        parser.add_argument("--" + k, type=int, default=v)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="fail if slower or bigger than this earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    unknown = [n for n in args.names if n not in benchmarks]
+    if unknown:
+        parser.error("unknown benchmark(s) %s" % ", ".join(unknown))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    results = run(args.names, **dict((k, getattr(args, k)) for k in default_params))
+    print("%-28s %10s %12s %14s %12s" % ("benchmark", "rows", "wall (s)", "rows/s", "peak RSS MB"))
+    for name, r in results["benchmarks"].items():
+        print(
+            "%-28s %10d %12.3f %14.0f %12s"
+            % (
+                name,
+                r["rows"],
+                r["wall_seconds"],
+                r["rows_per_second"] or 0,
+                "%.1f" % (r["peak_rss_kb"] / 1024.0) if r["peak_rss_kb"] is not None else "-",
+            )
+        )
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, measure, before, now in regressions:
+            print("REGRESSION %s %s: %s -> %s" % (name, measure, before, now))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import csv
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+# Deterministic generator for Socrata-shaped test data: catalog files in the shape returned
+# by the discovery API (and expected by create_socrata_rule4) and rows.csv style exports for
+# the resources in them. The same seed always gives byte-for-byte the same files so timings
+# from different runs (and machines) are of the same work.
+# xref https://socratadiscovery.docs.apiary.io/#reference/0/find-by-domain
+
+# roughly the mix of data types in the NYC catalog
+_data_types = [
+    ("Text", 50),
+    ("Number", 25),
+    ("Calendar date", 10),
+    ("Date", 3),
+    ("Point", 4),
+    ("URL", 2),
+    ("Checkbox", 3),
+    ("Polygon", 1),
+    ("MultiPolygon", 2),
+]
+
+_words = (
+    "housing water permit inspection school borough street tree sales property tax "
+    "violation complaint service request budget payroll election transit bus subway parking "
+    "restaurant health crime arrest fire building energy waste recycling park library "
+    "population census income zoning lot block bbl bin address zip district council"
+).split()
+
+_categories = ["Housing & Development", "Education", "Transportation", "Health", "City Government"]
+_epoch = datetime(2015, 1, 1)
+
+
+def _timestamp(rnd):
+    d = _epoch + timedelta(seconds=rnd.randrange(8 * 365 * 86400))
+    return d.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _resource_id(rnd):
+    alphabet = "abcdefghijkmnpqrstuvwxyz23456789"
+    return "".join(rnd.choice(alphabet) for _ in range(4)) + "-" + "".join(
+        rnd.choice(alphabet) for _ in range(4)
+    )
+
+
+def _data_type(rnd):
+    return rnd.choices([t for t, _ in _data_types], weights=[w for _, w in _data_types])[0]
+
+
+def make_result(rnd, domain, n_columns):
+    """
+    one element of $.results"""
+    resource_id = _resource_id(rnd)
+    title = " ".join(rnd.choice(_words) for _ in range(rnd.randint(2, 6))).title()
+    field_names, names, data_types, descriptions = [], [], [], []
+    for j in range(n_columns):
+        name = " ".join(rnd.choice(_words) for _ in range(rnd.randint(1, 3)))
+        field_names.append("%s_%d" % (name.replace(" ", "_"), j))
+        names.append(name.title())
+        data_types.append(_data_type(rnd))
+        descriptions.append(" ".join(rnd.choice(_words) for _ in range(rnd.randint(0, 20))))
+    created = _timestamp(rnd)
+    updated = max(created, _timestamp(rnd))
+    return {
+        "resource": {
+            "name": title,
+            "id": resource_id,
+            "parent_fxf": [],
+            "description": " ".join(rnd.choice(_words) for _ in range(rnd.randint(5, 60))),
+            "attribution": "Department of %s" % rnd.choice(_words).title(),
+            "attribution_link": None,
+            "contact_email": None,
+            "type": "dataset",
+            "updatedAt": updated,
+            "createdAt": created,
+            "metadata_updated_at": updated,
+            "data_updated_at": updated,
+            "page_views": {
+                "page_views_last_week": rnd.randrange(1000),
+                "page_views_last_month": rnd.randrange(5000),
+                "page_views_total": rnd.randrange(10 ** 6),
+            },
+            "columns_name": names,
+            "columns_field_name": field_names,
+            "columns_datatype": data_types,
+            "columns_description": descriptions,
+            "columns_format": [{} for _ in range(n_columns)],
+            "download_count": rnd.randrange(10 ** 5),
+            "provenance": "official",
+            "lens_display_type": "table",
+            "lens_view_type": "tabular",
+            "blob_mime_type": None,
+            "hide_from_data_json": False,
+            "publication_date": created,
+        },
+        "classification": {
+            "categories": rnd.sample(_categories, 2),
+            "tags": [],
+            "domain_category": rnd.choice(_categories),
+            "domain_tags": rnd.sample(_words, 3),
+            "domain_metadata": [],
+        },
+        "metadata": {"domain": domain, "license": "See Terms of Use"},
+        "permalink": "https://%s/d/%s" % (domain, resource_id),
+        "link": "https://%s/%s/%s" % (domain, title.replace(" ", "-"), resource_id),
+        "owner": {"id": _resource_id(rnd), "user_type": "interactive", "display_name": "NYC OpenData"},
+        "creator": {"id": _resource_id(rnd), "user_type": "interactive", "display_name": "NYC OpenData"},
+    }
+
+
+def make_catalog(domain, n_resources, n_columns, seed=0):
+    rnd = random.Random("%s/%d" % (domain, seed))
+    results = [make_result(rnd, domain, n_columns) for _ in range(n_resources)]
+    return {"results": results, "resultSetSize": n_resources, "timings": {"serviceMillis": 1}}
+
+
+def domain_names(n_domains):
+    return ["data%d.example.gov" % i for i in range(n_domains)]
+
+
+def write_catalogs(directory, n_domains, n_resources, n_columns, seed=0):
+    """
+    write <domain>.json for n_domains domains of n_resources resources of n_columns columns
+    each. Returns the resource list (as from /api/catalog/v1/domains) to pass to
+    create_socrata_rule4."""
+    results = []
+    for domain in domain_names(n_domains):
+        with open(os.path.join(directory, domain + ".json"), "w") as fp:
+            json.dump(make_catalog(domain, n_resources, n_columns, seed), fp)
+        results.append(dict(domain=domain, count=n_resources))
+    return {"results": results}
+
+
+def _value(rnd, data_type):
+    if rnd.random() < 0.05:
+        return ""
+    if data_type == "Number":
+        return str(rnd.randrange(10 ** 6)) if rnd.random() < 0.8 else "%.2f" % rnd.uniform(0, 1e4)
+    if data_type in ("Calendar date", "Date"):
+        # the rows.csv format
+        d = _epoch + timedelta(seconds=rnd.randrange(8 * 365 * 86400))
+        return d.strftime("%m/%d/%Y %I:%M:%S %p")
+    if data_type == "Point":
+        return "POINT (%.6f %.6f)" % (rnd.uniform(-74.25, -73.7), rnd.uniform(40.5, 40.9))
+    if data_type in ("Polygon", "MultiPolygon"):
+        # small squares, like tax lots
+        squares = []
+        for _ in range(1 if data_type == "Polygon" else 2):
+            x, y, d = rnd.uniform(-74.25, -73.7), rnd.uniform(40.5, 40.9), rnd.uniform(1e-4, 1e-3)
+            squares.append(
+                "((%.6f %.6f, %.6f %.6f, %.6f %.6f, %.6f %.6f, %.6f %.6f))"
+                % (x, y, x + d, y, x + d, y + d, x, y + d, x, y)
+            )
+        if data_type == "Polygon":
+            return "POLYGON %s" % squares[0]
+        return "MULTIPOLYGON (%s)" % ", ".join(squares)
+    if data_type == "Checkbox":
+        return rnd.choice(("true", "false"))
+    if data_type == "URL":
+        return "https://example.gov/%d" % rnd.randrange(10 ** 6)
+    return " ".join(rnd.choice(_words) for _ in range(rnd.randint(1, 4)))
+
+
+def write_csv(path, result, n_rows, seed=0):
+    """
+    write a rows.csv style export for a catalog result: display names in the header and
+    values in the format Socrata exports them"""
+    rnd = random.Random("%s/%d" % (result["resource"]["id"], seed))
+    names = result["resource"]["columns_name"]
+    data_types = result["resource"]["columns_datatype"]
+    with open(path, "w", newline="", encoding="utf-8") as fp:
+        w = csv.writer(fp)
+        w.writerow(names)
+        for _ in range(n_rows):
+            w.writerow([_value(rnd, t) for t in data_types])
+    return path
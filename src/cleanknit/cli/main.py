@@ -0,0 +1,404 @@
+import argparse
+import sys
+
+# The soc command. Only the standard library is imported up front: each subcommand imports
+# what it needs when it runs, so the lightweight ones (search in particular, which is called
+# from scripts and Excel thousands of times a day) do not pay for SQLAlchemy, structlog,
+# cmd2, rich and friends. bench/startup.py checks that this stays true.
+#
+#   soc ingest domains.json --database rule4.db
+#   soc refresh domains.json --database rule4.db
+#   soc materialize --database rule4.db --target sqlite:///datasets.db
+#   soc materialize --database rule4.db --shards shards
+#   soc search --database rule4.db "housing maint"
+#   soc dictionary --database rule4.db 64uk-42ks=pluto_datadictionary.pdf
+#   soc sync --database rule4.db --datasets datasets.db erm2-nwe9 64uk-42ks
+#   soc catalog --database rule4.db --domain data.cityofnewyork.us
+#   soc catalog --database rule4.db erm2-nwe9
+#   soc shell
+
+
+def configure_logging(verbose=False):
+    import logging
+
+    import structlog
+
+    # xref https://stackoverflow.com/a/66537038
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(
+            logging.DEBUG if verbose else logging.INFO
+        ),
+    )
+
+
+def _rule4(args, connection_profile):
+    from ..connection import create_sqlite_engine
+    from .soc import rule4_session
+
+    configure_logging(args.verbose)
+    engine = create_sqlite_engine("sqlite://", profile=connection_profile)
+    if args.profile:
+        from ..instrument import instrument_engine, write_metrics_at_exit
+
+        instrument_engine(engine, args.progress_every, args.slow_seconds)
+        write_metrics_at_exit(args.profile)
+    return rule4_session(engine, args.database, connection_profile)
+
+
+def _resource_list(path):
+    import json
+
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _rebuild_search_index(S):
+    from ..socrata.search import create_search_index, rebuild_search_index
+
+    create_search_index(S)
+    rebuild_search_index(S)
+
+
+def _rebuild_catalog_snapshot(S, database):
+    from ..socrata.catalogsnapshot import catalog_snapshot_path, write_catalog_snapshot
+
+    write_catalog_snapshot(S, catalog_snapshot_path(database), database)
+
+
+def _open_catalog(database):
+    """
+    the CatalogSnapshot of the database if there is one and it is up to date, else None"""
+    from ..socrata.catalogsnapshot import CatalogSnapshot, catalog_snapshot_path
+
+    try:
+        catalog = CatalogSnapshot(catalog_snapshot_path(database))
+    except (OSError, ValueError):
+        return None
+    if catalog.is_stale():
+        catalog.close()
+        return None
+    return catalog
+
+
+def ingest(args):
+    from .soc import create_socrata_rule4, parallel_socrata_rule4
+
+    S = _rule4(args, "bulk-load")
+    resource_list = _resource_list(args.domains)
+    if args.mode == "parallel":
+        parallel_socrata_rule4(S, resource_list)
+    else:
+        create_socrata_rule4(
+            S, resource_list, streaming=args.mode == "streaming", batch_size=args.batch_size
+        )
+    _rebuild_search_index(S)
+    _rebuild_catalog_snapshot(S, args.database)
+    S.close()
+
+
+def refresh(args):
+    from .soc import refresh_socrata_rule4
+
+    S = _rule4(args, "bulk-load")
+    stats = refresh_socrata_rule4(S, _resource_list(args.domains), batch_size=args.batch_size)
+    if stats["inserted"] or stats["updated"] or stats["deleted"]:
+        _rebuild_search_index(S)
+        _rebuild_catalog_snapshot(S, args.database)
+    S.close()
+
+
+def materialize(args):
+    from sqlalchemy import create_engine
+
+    from ..connection import create_sqlite_engine
+    from .soc import materialize_schema
+
+    S = _rule4(args, "interactive-read")
+    if args.shards:
+        from ..socrata.shards import ShardRouter
+        from .soc import materialize_shard
+
+        router = ShardRouter(S, args.shards)
+        results = router.run_parallel(
+            materialize_shard,
+            args.domains or router.domains(existing=False),
+            args=(args.database, args.chunk_size, not args.keep_existing),
+            max_workers=args.workers,
+        )
+        for skipped in results.values():
+            for resource_id, reason in skipped:
+                print("skipped %s: %s" % (resource_id, reason), file=sys.stderr)
+        S.close()
+        return
+    if args.target.startswith("sqlite"):
+        target = create_sqlite_engine(args.target, profile="bulk-load")
+    else:
+        target = create_engine(args.target)
+    catalog = _open_catalog(args.database)
+    skipped = materialize_schema(
+        S,
+        target=target,
+        chunk_size=args.chunk_size,
+        drop_existing=not args.keep_existing,
+        domains=args.domains or None,
+        catalog=catalog,
+    )
+    for resource_id, reason in skipped:
+        print("skipped %s: %s" % (resource_id, reason), file=sys.stderr)
+    if catalog is not None:
+        catalog.close()
+    S.close()
+
+
+def search(args):
+    from ..socrata.search import search_file
+
+    rows = search_file(args.database, " ".join(args.query), limit=args.limit)
+    if args.json:
+        import json
+
+        keys = ("kind", "resource_id", "name", "field_name", "rank")
+        json.dump([dict(zip(keys, r)) for r in rows], sys.stdout)
+        sys.stdout.write("\n")
+        return
+    for kind, resource_id, name, field_name, rank in rows:
+        print("\t".join((kind, resource_id, name or "", field_name or "", "%g" % rank)))
+
+
+def catalog(args):
+    catalog = _open_catalog(args.database)
+    if catalog is None:
+        # missing or out of date. Only this needs SQLAlchemy
+        S = _rule4(args, "bulk-load")
+        _rebuild_catalog_snapshot(S, args.database)
+        S.close()
+        catalog = _open_catalog(args.database)
+        if catalog is None:
+            print("could not build a catalog snapshot for %s" % args.database, file=sys.stderr)
+            return 1
+    out = []
+    with catalog:
+        if args.resource_ids:
+            for resource_id in args.resource_ids:
+                r = catalog.resource(resource_id)
+                if r is None:
+                    print("unknown resource %s" % resource_id, file=sys.stderr)
+                    return 1
+                columns = [
+                    dict(
+                        field_number=c.field_number,
+                        field_name=c.field_name,
+                        data_type=c.data_type,
+                        name=c.name,
+                    )
+                    for c in r.columns()
+                ]
+                out.append(dict(resource_id=r.resource_id, domain=r.domain, columns=columns))
+        else:
+            for r in catalog.resources(args.domain):
+                out.append(dict(domain=r.domain, resource_id=r.resource_id, name=r.name))
+    if args.json:
+        import json
+
+        json.dump(out, sys.stdout)
+        sys.stdout.write("\n")
+        return
+    for r in out:
+        if "columns" not in r:
+            print("\t".join((r["domain"], r["resource_id"], r["name"] or "")))
+            continue
+        for c in r["columns"]:
+            fields = (c["field_number"], c["field_name"] or "", c["data_type"], c["name"])
+            print("\t".join((r["resource_id"],) + tuple(str(f) for f in fields)))
+
+
+def dictionary(args):
+    from ..socrata.datadictionary import apply_data_dictionaries
+
+    documents = []
+    for d in args.documents:
+        resource_id, sep, path = d.partition("=")
+        if not sep:
+            raise SystemExit("expected <resource id>=<path>: %s" % d)
+        documents.append((resource_id, path))
+    S = _rule4(args, "bulk-load")
+    n = apply_data_dictionaries(
+        S,
+        documents,
+        args.cache_dir,
+        max_workers=args.workers,
+        overwrite=args.overwrite,
+        stylesheets=args.stylesheets,
+    )
+    if n:
+        # the descriptions are in the search index and the catalog snapshot
+        _rebuild_search_index(S)
+        _rebuild_catalog_snapshot(S, args.database)
+    print("%d column descriptions filled in" % n)
+    S.close()
+
+
+def sync(args):
+    import os
+
+    from ..socrata.sync import sync_datasets
+
+    S = _rule4(args, "bulk-load")
+    kwargs = dict(app_token=args.app_token or os.environ.get("SOCRATA_APP_TOKEN", None))
+    if args.soda_url:
+        kwargs["soda_url"] = args.soda_url
+    if args.shards:
+        from ..socrata.shards import ShardRouter
+
+        kwargs["router"] = ShardRouter(S, args.shards)
+    else:
+        S.connection().exec_driver_sql("ATTACH DATABASE ? AS datasets", (args.datasets,))
+        kwargs["schema"] = "datasets"
+    results = sync_datasets(
+        S,
+        args.resource_ids,
+        max_concurrent=args.concurrency,
+        page_size=args.page_size,
+        lookback=args.lookback,
+        **kwargs
+    )
+    failed = 0
+    for resource_id, r in results.items():
+        if isinstance(r, Exception):
+            print("%s\terror\t%s" % (resource_id, r), file=sys.stderr)
+            failed += 1
+        else:
+            print("%s\t%d\t%d" % (resource_id, r["upserted"], r["deleted"]))
+    S.close()
+    return 1 if failed else 0
+
+
+def vacuum(args):
+    from ..socrata.shards import ShardRouter
+
+    S = _rule4(args, "bulk-load")
+    ShardRouter(S, args.shards).vacuum(args.domains or None, max_workers=args.workers)
+    S.close()
+
+
+def shell(args):
+    from .shell import MechE
+
+    MechE(rule4=args.rule4).cmdloop()
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="soc", description="Socrata rule4 tools")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    sub.required = True
+
+    rule4 = argparse.ArgumentParser(add_help=False)
+    rule4.add_argument("--database", default="rule4.db", help="the rule4 database file")
+    rule4.add_argument(
+        "--profile",
+        metavar="JSON",
+        help="collect per-stage and per-statement metrics and write them to JSON at exit",
+    )
+    rule4.add_argument("--progress-every", type=int, default=100000, help="VM steps")
+    rule4.add_argument("--slow-seconds", type=float, default=5.0)
+
+    loading = argparse.ArgumentParser(add_help=False)
+    loading.add_argument(
+        "domains",
+        help="the resource list from /api/catalog/v1/domains. The <domain>.json catalog "
+        "files are read from the current directory",
+    )
+    loading.add_argument("--batch-size", type=int, default=5000)
+
+    p = sub.add_parser(
+        "ingest", parents=[rule4, loading], help="load the catalog files into rule4"
+    )
+    p.add_argument(
+        "--mode", choices=("legacy", "streaming", "parallel"), default="streaming"
+    )
+    p.set_defaults(func=ingest)
+
+    p = sub.add_parser(
+        "refresh", parents=[rule4, loading], help="apply changed catalog files to rule4"
+    )
+    p.set_defaults(func=refresh)
+
+    p = sub.add_parser(
+        "materialize", parents=[rule4], help="create a table for each resource in the target"
+    )
+    target = p.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target", help="SQLAlchemy URL of the target database")
+    target.add_argument("--shards", metavar="DIR", help="one SQLite file per domain in DIR")
+    p.add_argument("--workers", type=int, default=None, help="shards materialized at once")
+    p.add_argument("--domains", nargs="*")
+    p.add_argument("--chunk-size", type=int, default=500)
+    p.add_argument("--keep-existing", action="store_true")
+    p.set_defaults(func=materialize)
+
+    p = sub.add_parser("vacuum", parents=[rule4], help="VACUUM the domain shards in parallel")
+    p.add_argument("--shards", metavar="DIR", required=True)
+    p.add_argument("--domains", nargs="*")
+    p.add_argument("--workers", type=int, default=None)
+    p.set_defaults(func=vacuum)
+
+    p = sub.add_parser(
+        "sync", parents=[rule4], help="pull the rows changed since the last sync from SODA"
+    )
+    p.add_argument("resource_ids", nargs="+", metavar="RESOURCE_ID")
+    target = p.add_mutually_exclusive_group(required=True)
+    target.add_argument("--datasets", metavar="PATH", help="the SQLite file of the datasets")
+    target.add_argument("--shards", metavar="DIR", help="one SQLite file per domain in DIR")
+    p.add_argument("--concurrency", type=int, default=4, help="resources synced at once")
+    p.add_argument("--page-size", type=int, default=5000)
+    p.add_argument(
+        "--lookback", type=float, default=300, help="seconds re-read before the high-water mark"
+    )
+    p.add_argument("--app-token", help="default $SOCRATA_APP_TOKEN")
+    p.add_argument("--soda-url", help="URL template of the SODA endpoint, e.g. a local stub")
+    p.set_defaults(func=sync)
+
+    p = sub.add_parser("search", help="full-text search of the resources and columns")
+    p.add_argument("query", nargs="+")
+    p.add_argument("--database", default="rule4.db", help="the rule4 database file")
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=search)
+
+    p = sub.add_parser(
+        "catalog",
+        parents=[rule4],
+        help="the resources of a domain, or the columns of resources, from the catalog snapshot",
+    )
+    p.add_argument("resource_ids", nargs="*", metavar="RESOURCE_ID")
+    p.add_argument("--domain", help="only the resources of this domain")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=catalog)
+
+    p = sub.add_parser(
+        "dictionary",
+        parents=[rule4],
+        help="fill in the column descriptions from PDF data dictionaries",
+    )
+    p.add_argument("documents", nargs="+", metavar="RESOURCE_ID=PATH")
+    p.add_argument("--cache-dir", default=".datadictionary", help="extracted entries by hash")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--overwrite", action="store_true", help="replace existing descriptions")
+    p.add_argument(
+        "--stylesheets", action="store_true", help="also write the XSL TSVs next to each PDF"
+    )
+    p.set_defaults(func=dictionary)
+
+    p = sub.add_parser("shell", help="the MechE interactive shell")
+    p.add_argument("--rule4", default="sqlite://", help="SQLAlchemy URL of the rule4 database")
+    p.set_defaults(func=shell)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
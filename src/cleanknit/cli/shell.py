@@ -0,0 +1,356 @@
+import os
+import signal
+import sys
+import time
+from typing import Any
+import cmd2
+from cmd2 import Cmd2ArgumentParser, with_argparser
+
+from rich.table import Table
+from rich import box
+from rich.console import Console
+from rich.markup import escape
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# The SQLite engines use a hand-rolled pysqlite3 from https://github.com/coleifer/pysqlite3
+# (see create_sqlite_engine). The setup.py is edited to make the list of compilation options
+# mutually consistent wrt https://github.com/nalgeon/sqlite#sqlite-shell-builder as I like to
+# prototype features using the sqlite3 *shell* and then only 'fall up' to Python when there
+# is something 'fancy' to be done.
+from ..connection import create_sqlite_engine
+from ..querycache import QueryCache, environment_variable
+
+Session=sessionmaker()
+
+from argopt import argopt
+
+def hasdocopt(f, *args, **kwargs):
+    # cmd2 insists on its own subclass of ArgumentParser
+    parser=argopt(
+        f.__doc__,
+        argparser=Cmd2ArgumentParser,
+        formatter_class=cmd2.RawDescriptionCmd2HelpFormatter,
+    )
+    return with_argparser(parser)(f)
+    
+class RichCmd(cmd2.Cmd):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.console=Console()
+        # Make maxrepeats settable at runtime
+    
+    def poutput(self, msg: Any='',*,end:str="\n") -> None:
+        self.console.print(msg)
+        # with self.console.capture() as capture:
+        #     self.console.print(msg)
+        # str_output=capture.get()
+        # super().poutput(str_output,end=end)
+
+    def perror(self, msg: Any = '', *, end: str = '\n', apply_style: bool = True) -> None:
+        self.console.print(msg)
+        # with self.console.capture() as capture:
+        #     self.console.print(msg)
+        # str_output=capture.get()
+        # super().perror(str_output,end=end,apply_style=apply_style)
+
+    def pexcept(self, msg: Any, *, end: str = '\n', apply_style: bool = True) -> None:
+        #self.console.print(msg)
+        if self.debug and sys.exc_info() != (None,None,None):
+            self.console.print_exception(show_locals=True)
+        else:
+            super().pexcept(msg,end=end,apply_style=apply_style)
+
+
+def _rule4_engine(url):
+    if url.startswith('sqlite'):
+        # StaticPool: the one connection (with its PRAGMAs, ATTACHed databases and page
+        # cache) is kept for the life of the shell rather than reopened for every command
+        return create_sqlite_engine(url, profile="interactive-read", poolclass=StaticPool)
+    return create_engine(url)
+
+
+class MechE(RichCmd):
+    prompt="MechE$ "
+    def __init__(self, rule4="sqlite://", engine=None, **kwargs):
+        super().__init__(**kwargs)
+        self.rule4 = rule4
+        self.add_settable(cmd2.Settable('rule4', str, 'SQLAlchemy URI for Rule4 database', self))
+        self.engine = engine if engine is not None else _rule4_engine(self.rule4)
+        self.S = None
+        self.register_precmd_hook(self.setup_session)
+        self.register_postcmd_hook(self.close_session)
+
+    def setup_session(self, data: cmd2.plugin.PrecommandData) -> cmd2.plugin.PrecommandData:
+        if self.S is None:
+            self.S = Session(bind=self.engine)
+        return data
+
+    def close_session(self, data: cmd2.plugin.PostcommandData) -> cmd2.plugin.PostcommandData:
+        # end any read transaction (so we don't hold up a WAL checkpoint) but keep the
+        # session and its connection for the next command
+        if self.S is not None:
+            self.S.rollback()
+        return data
+
+    def _onchange_rule4(self, param_name, old, new):
+        if self.S is not None:
+            self.S.close()
+            self.S = None
+        self.engine.dispose()
+        self.engine = _rule4_engine(new)
+
+    @hasdocopt
+    def do_db(self,opts):
+        '''db
+
+Usage:
+    db
+    '''
+        # the db shell shares our engine (and so our connection)
+        c = MechEDb(rule4=self.rule4, engine=self.engine)
+        c.cmdloop()
+
+    @hasdocopt
+    def do_banana(self, opts):
+        '''Example programme description.
+You should be able to do
+    args = argopt(__doc__).parse_args()
+instead of
+    args = docopt(__doc__)
+
+Usage:
+    banana [options] <x> [<y>...]
+
+Arguments:
+    <x>                   A file.
+    --anarg=<a>           Description here [default: 1e3:int].
+    -p PAT, --patts PAT   Or [default: None:file].
+    --bar=<b>             Another [default: something] should
+                          auto-wrap something in quotes and assume str.
+    -f, --force           Force.
+'''
+        t = Table("anarg", "patts", "fruit", title=opts.bar, box=box.MINIMAL_DOUBLE_HEAD)
+        self.console.print(t)
+
+
+def _cell(v):
+    if v is None:
+        return "[dim]NULL[/dim]"
+    if isinstance(v, bytes):
+        return "[dim]<%d bytes>[/dim]" % len(v)
+    # don't let the data be taken for rich markup
+    return escape(str(v))
+
+
+class MechEDb(MechE):
+    prompt="db> "
+
+    def __init__(self, **kwargs):
+        # a query can span lines up to the ; and > and | are SQL here, not redirection
+        super().__init__(multiline_commands=['query'], allow_redirection=False, **kwargs)
+        self.page_size = 50
+        self.max_rows = 0
+        self.plan = True
+        self.add_settable(cmd2.Settable('page_size', int, 'rows fetched and shown at a time', self))
+        self.add_settable(cmd2.Settable('max_rows', int, 'stop after this many rows (0 for all)', self))
+        self.add_settable(cmd2.Settable('plan', bool, 'show EXPLAIN QUERY PLAN before a query', self))
+        # off unless $CLEANKNIT_QUERY_CACHE names a file. See querycache.py
+        self.cache = os.environ.get(environment_variable, "")
+        self.query_cache = QueryCache(self.cache) if self.cache else None
+        self.add_settable(
+            cmd2.Settable(
+                'cache', str, 'query result cache file ("" for none)', self,
+                onchange_cb=self._onchange_cache,
+            )
+        )
+
+    def _onchange_cache(self, param_name, old, new):
+        if self.query_cache is not None:
+            self.query_cache.close()
+        self.query_cache = QueryCache(new) if new else None
+
+    def _show_plan(self, conn, q):
+        try:
+            rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + q).fetchall()
+        except DBAPIError:
+            # let running the query itself report the problem
+            return
+        # (id, parent, notused, detail), drawn as a tree like the sqlite3 shell does
+        depth = {0: -1}
+        lines = []
+        for id, parent, _, detail in rows:
+            depth[id] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[id] + detail)
+        self.console.print("[bold]QUERY PLAN[/bold]\n" + "\n".join(lines))
+
+    def _print_page(self, columns, rows, title, first):
+        t = Table(
+            *columns,
+            title=title if first else None,
+            show_header=first,
+            box=box.MINIMAL_DOUBLE_HEAD,
+        )
+        for row in rows:
+            t.add_row(*[_cell(v) for v in row])
+        self.console.print(t)
+
+    def _show_cached(self, columns, rows, title=None):
+        t0 = time.perf_counter()
+        if self.max_rows:
+            rows = rows[: self.max_rows]
+        for i in range(0, len(rows), self.page_size):
+            self._print_page(columns, rows[i : i + self.page_size], title, i == 0)
+        self.console.print(
+            "%d rows in %.3fs [green](cached)[/green]" % (len(rows), time.perf_counter() - t0)
+        )
+
+    def _stream(self, q, title=None, collect=None):
+        """
+        run q and print the rows a page (fetchmany) at a time as they arrive. Ctrl-C cancels
+        the statement even while SQLite is busy: the SIGINT handler calls interrupt() and the
+        progress handler aborts the VM at its next check. With collect (a list) every row is
+        fetched, and appended to it, whatever max_rows is, and the column names are returned.
+        """
+        conn = self.S.connection()
+        dbapi_connection = conn.connection.connection
+        # the one instrument_engine installed, if any, keeps running underneath ours
+        handler, every = conn.connection.info.get("progress_handler", (None, 10000))
+        cancelled = []
+
+        def on_sigint(signum, frame):
+            cancelled.append(True)
+            dbapi_connection.interrupt()
+
+        def progress():
+            if cancelled:
+                return 1
+            return handler() if handler is not None else 0
+
+        previous = signal.signal(signal.SIGINT, on_sigint)
+        dbapi_connection.set_progress_handler(progress, every)
+        t0 = time.perf_counter()
+        first = None
+        n = 0
+        noun = "rows"
+        columns = None
+        try:
+            result = conn.exec_driver_sql(q)
+            if not result.returns_rows:
+                # DDL/DML typed at the shell is meant to stick
+                self.S.commit()
+                n = max(result.rowcount, 0)
+                noun = "rows affected"
+            else:
+                columns = list(result.keys())
+                while not cancelled:
+                    page = self.page_size
+                    if self.max_rows:
+                        page = min(page, self.max_rows - n)
+                    if collect is not None:
+                        # the rest are only fetched (for the cache), not shown
+                        rows = result.fetchmany(self.page_size if page <= 0 else page)
+                    else:
+                        rows = result.fetchmany(page) if page > 0 else []
+                    if first is None:
+                        first = time.perf_counter() - t0
+                    if not rows:
+                        break
+                    if collect is not None:
+                        collect.extend(rows)
+                    if page > 0:
+                        self._print_page(columns, rows, title, n == 0)
+                        n += len(rows)
+                result.close()
+        except OperationalError:
+            if not cancelled:
+                raise
+        finally:
+            dbapi_connection.set_progress_handler(handler, every if handler is not None else 0)
+            signal.signal(signal.SIGINT, previous)
+
+        elapsed = time.perf_counter() - t0
+        summary = "%d %s in %.3fs" % (n, noun, elapsed)
+        if first is not None:
+            summary += " (first row after %.3fs)" % first
+        if cancelled:
+            summary += " [red]cancelled[/red]"
+        self.console.print(summary)
+        return None if cancelled else columns
+
+    @hasdocopt
+    def do_compile(self, opts):
+        '''compile
+        
+Usage: compile [options]    
+
+Arguments:
+  -v, --verbose     Verbose
+        '''
+        self._stream("PRAGMA compile_options;", title="Compile Options")
+
+    @hasdocopt
+    def do_modules(self, opts):
+        '''modules
+        
+Usage: modules [options]    
+
+Arguments:
+  -v, --verbose     Verbose
+        '''
+        self._stream("SELECT name AS module from pragma_module_list;", title="Modules")
+
+    def do_query(self, statement):
+        '''query
+
+Usage: query <q>;
+
+Run the SQL q, which can span lines up to the terminating ;. The rows are shown page_size
+at a time as they are fetched, up to max_rows. Ctrl-C cancels the query. See
+"set page_size", "set max_rows" and "set plan".
+        '''
+        q = statement.args
+        if not q.strip():
+            self.perror("query what?")
+            return
+        conn = self.S.connection()
+        lookup = self.query_cache.lookup(self.S, q) if self.query_cache else None
+        if lookup is not None and lookup.result is not None:
+            self._show_cached(*lookup.result)
+            return
+        if self.plan:
+            self._show_plan(conn, q)
+        if lookup is None or lookup.key is None:
+            self._stream(q)
+            return
+        rows = []
+        columns = self._stream(q, collect=rows)
+        if columns is not None:
+            self.query_cache.store(lookup, columns, rows)
+
+    def do_cache(self, statement):
+        '''cache
+
+Usage: cache [clear]
+
+Show the query result cache hit/miss counts and size, or with clear empty it. See
+"set cache".
+        '''
+        if self.query_cache is None:
+            self.perror('no query cache, see "set cache"')
+            return
+        if statement.args.strip() == "clear":
+            self.query_cache.invalidate()
+        t = Table("hits", "misses", "uncacheable", "evictions", "entries", "bytes",
+                  title=self.query_cache.path, box=box.MINIMAL_DOUBLE_HEAD)
+        stats = self.query_cache.stats()
+        t.add_row(*[str(stats[k]) for k in ("hits", "misses", "uncacheable", "evictions",
+                                            "entries", "bytes")])
+        self.console.print(t)
+
+
+if __name__ == "__main__":
+    MechE().cmdloop()
\ No newline at end of file
@@ -1,6 +1,39 @@
+from sqlalchemy import sql, MetaData, Table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
-from ..socrata.model import log, domain,resource,resource_column
+from ..socrata.model import (
+    log,
+    domain,
+    resource,
+    resource_column,
+    rule4_version,
+    sa_column_for,
+    _domain_to_schema_map,
+)
+from ..socrata.catalog import (
+    catalog_envelope,
+    cook_resources,
+    cooked_tables,
+    iter_catalog_rows,
+    shred_catalog_file,
+    shred_resource,
+    shred_resource_columns,
+)
+from ..socrata.payload import (
+    PayloadStore,
+    prune_payloads,
+    register_functions,
+    resource_json_ddl,
+)
+from ..munge import insert_tuples
+from ..querycache import invalidate_session
+from ..connection import apply_pragmas, deferred_foreign_keys
+from ..instrument import metrics, stage
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
 import json
+import os
+import time
 
 def resource2dict(resource_list):
     """
@@ -38,127 +71,562 @@ def resource2dict(resource_list):
 # curl "https://api.us.socrata.com/api/catalog/v1?domains=data.cityofnewyork.us&offset=0&limit=3450" --out newyork.json
 
 
-def create_socrata_rule4(S, resource_list):
-    resource_map = resource2dict(resource_list)
-    ins = domain.insert()
-    with S.begin():
-        S.execute(ins, list(resource_map.values()))
-    log.info("Done persisting domains")
+def create_socrata_rule4(S, resource_list, streaming=False, batch_size=5000):
+    if streaming:
+        return stream_socrata_rule4(S, resource_list, batch_size=batch_size)
+
+    with stage("read") as s:
+        resource_map = resource2dict(resource_list)
+        s["bytes"] = sum(len(l["_resources"]) for l in resource_map.values())
+    store = PayloadStore(S)
 
-    # This might take up a fair bit of memory
-    all_resources = []
+    # This might take up a fair bit of memory. See stream_socrata_rule4 for
+    # the bounded-memory alternative.
+    domains, all_resources = [], []
     for l in resource_map.values():
         try:
-            for r in json.loads(l["_resources"])["results"]:
-                all_resources.append(
-                    dict(
-                        resource_id=r["resource"]["id"],
-                        domain=r["metadata"]["domain"],
-                        name=r["resource"]["name"],
-                        metadata=r["metadata"],
-                        permalink=r["permalink"],
-                        resource=r,
-                    )
-                )
+            with stage("decode", domain=l["domain"], bytes=len(l["_resources"])) as s:
+                catalog = json.loads(l["_resources"])
+                results = catalog["results"]
+                s["rows"] = len(results)
         except json.JSONDecodeError:
             log.error("problem decoding JSON", domain=l["domain"])
             continue
+        # domain._resources gets the envelope as the results each go in resource.resource
+        domains.append(dict(domain=l["domain"], _resources=catalog_envelope(catalog)))
+        with stage("shred", domain=l["domain"], rows=len(results)):
+            all_resources.extend(shred_resource(r) for r in results)
+
+    with stage("insert", table="domain", rows=len(domains)):
+        store.put_columns(domains, ("_resources",))
+        store.flush()
+        S.execute(domain.insert(), domains)
+    with stage("commit"):
+        S.commit()
+    log.info("Done persisting domains")
 
     all_resource_columns = []
 
     ins = resource.insert()
-    with S.begin():
-        S.execute(ins, all_resources)
+    with stage("insert", table="resource", rows=len(all_resources)):
+        # copies as all_resources keeps the result objects for shredding the columns below
+        rows = store.put_columns([dict(r) for r in all_resources], ("metadata", "resource"))
+        store.flush()
+        S.execute(ins, rows)
+    with stage("commit"):
+        S.commit()
     log.info("Done persisting resources")
 
-    rc_cols = list([c.name for c in resource_column.columns])
-    for r in all_resources:
-        if not "resource_id" in r:
-            log.debug("no resource_id", **r)
+    with stage("shred", table="resource_column") as s:
+        for r in all_resources:
+            all_resource_columns.extend(shred_resource_columns(r["resource"]))
+        s["rows"] = len(all_resource_columns)
+
+    log.info("Done preparing resource-columns")
+
+    with stage("insert", table="resource_column", rows=len(all_resource_columns)):
+        S.execute(resource_column.insert(), all_resource_columns)
+    with stage("commit"):
+        S.commit()
+
+    log.info("Done persisting resource-columns")
+
+    with stage("cook"):
+        cook_resources(S)
+        S.commit()
+    log.info("Done persisting metadata")
+    invalidate_session(S, "socrata")
+
+
+def resource2paths(resource_list):
+    """
+    like resource2dict but only returns the names of the catalog files rather than
+    reading them in."""
+    d = {}
+    for r in resource_list["results"]:
+        if r["count"] == 0:
             continue
-        resource_id = r["resource_id"]
-        if not "metadata" in r:
-            log.debug("no metadata", **r)
+        path = r["domain"] + ".json"
+        if not os.path.exists(path):
             continue
+        d[r["domain"]] = path
+    return d
+
+
+def stream_socrata_rule4(S, resource_list, batch_size=5000):
+    """
+    streaming version of create_socrata_rule4: each catalog file is walked incrementally
+    and rows are flushed with executemany in batches of at most batch_size so that peak memory
+    is bounded by the batch size rather than the size of the catalog. The foreign keys are
+    checked once at the end rather than row by row.
+
+    As with create_socrata_rule4, domain._resources gets the catalog envelope (resultSetSize
+    etc.) rather than the whole blob as the individual results are kept in resource.resource"""
+    resource_paths = resource2paths(resource_list)
+    store = PayloadStore(S)
+
+    def flush(resources, columns):
+        # payloads and then resources as resource_column has a FK to resource
+        t0 = time.perf_counter()
+        if resources:
+            store.put_columns(resources, ("metadata", "resource"))
+            store.flush()
+            S.execute(resource.insert(), resources)
+        if columns:
+            S.execute(resource_column.insert(), columns)
+        n = (len(resources), len(columns), time.perf_counter() - t0)
+        resources.clear()
+        columns.clear()
+        return n
 
-        res = r["resource"]["resource"]
-        if not "columns_field_name" in res:
-            log.debug(
-                "no columns_field_name",
-                domain=r["metadata"]["domain"],
-                resource_id=resource_id,
-                name=res["name"],
+    n_resources = n_columns = 0
+    with deferred_foreign_keys(S):
+        for domain_name, path in resource_paths.items():
+            envelope = {}
+            resources, columns = [], []
+            dr = dc = 0
+            # reading, decoding and shredding are interleaved by iter_catalog_rows so they
+            # are counted together as decode, which is whatever is not spent inserting
+            insert_seconds = 0.0
+            try:
+                S.begin()
+                t0 = time.perf_counter()
+                with open(path, "r") as fp:
+                    for resource_row, column_rows in iter_catalog_rows(fp, envelope):
+                        resources.append(resource_row)
+                        columns.extend(column_rows)
+                        if len(resources) + len(columns) >= batch_size:
+                            r, c, t = flush(resources, columns)
+                            dr += r
+                            dc += c
+                            insert_seconds += t
+                    r, c, t = flush(resources, columns)
+                    dr += r
+                    dc += c
+                    insert_seconds += t
+                decode_seconds = time.perf_counter() - t0 - insert_seconds
+                # the envelope is only complete once the results have been walked so the
+                # domain row goes in last (the foreign keys are only checked at the end)
+                h = store.put(envelope)
+                store.flush()
+                S.execute(domain.insert(), dict(domain=domain_name, _resources=h))
+                with stage("commit", domain=domain_name):
+                    S.commit()
+            except (ValueError, KeyError) as e:
+                # json.JSONDecodeError is a ValueError. The transaction for the domain is
+                # rolled back so we don't end up with half a domain.
+                S.rollback()
+                store.rollback()
+                log.error("problem decoding JSON", domain=domain_name, error=str(e))
+                continue
+            metrics.add_stage("decode", decode_seconds, rows=dr, bytes=os.path.getsize(path))
+            metrics.add_stage("insert", insert_seconds, rows=dr + dc)
+            n_resources += dr
+            n_columns += dc
+            log.info(
+                "Done persisting domain",
+                domain=domain_name,
+                resources=dr,
+                resource_columns=dc,
+                decode_seconds=round(decode_seconds, 3),
+                insert_seconds=round(insert_seconds, 3),
             )
-            continue
 
-        number_of_columns = len(res["columns_field_name"])
-        if number_of_columns == 0:
-            log.debug(
-                "zero columns",
-                domain=r["metadata"]["domain"],
-                resource_id=resource_id,
-                name=res["name"],
+        # one set-based pass over everything rather than per batch
+        with stage("cook"):
+            cook_resources(S)
+            S.commit()
+
+    log.info("Done persisting metadata", resources=n_resources, resource_columns=n_columns)
+    invalidate_session(S, "socrata")
+
+
+def refresh_socrata_rule4(S, resource_list, batch_size=5000):
+    """
+    incremental version of create_socrata_rule4 for a database that has already been loaded.
+    Each result is fingerprinted (ignoring the volatile page-view counters) and only the
+    resources whose fingerprint differs from the stored one are upserted and have their
+    resource_column rows replaced. Resources that are no longer in a domain's catalog are deleted.
+    Returns counts of what was done."""
+    resource_paths = resource2paths(resource_list)
+    stats = dict(inserted=0, updated=0, unchanged=0, deleted=0)
+    store = PayloadStore(S)
+
+    ins = sqlite_insert(resource)
+    upsert = ins.on_conflict_do_update(
+        index_elements=[resource.c.resource_id],
+        set_=dict(
+            (c.name, ins.excluded[c.name]) for c in resource.columns if not c.primary_key
+        ),
+    )
+
+    def flush(resources, columns):
+        if resources:
+            S.execute(
+                resource_column.delete().where(
+                    resource_column.c.resource_id.in_([r["resource_id"] for r in resources])
+                )
             )
-            continue
+            store.put_columns(resources, ("metadata", "resource"))
+            store.flush()
+            S.execute(upsert, resources)
+            cook_resources(S, [r["resource_id"] for r in resources])
+        if columns:
+            S.execute(resource_column.insert(), columns)
+        resources.clear()
+        columns.clear()
 
-        tuples = list(
-            [
-                tuple(z)
-                for z in zip(
-                    (res["id"],) * number_of_columns,
-                    range(1, number_of_columns + 1),
-                    res["columns_field_name"],
-                    res["columns_datatype"],
-                    res["columns_name"],
-                    res["columns_description"],
+    for domain_name, path in resource_paths.items():
+        existing = dict(
+            S.execute(
+                sql.select(resource.c.resource_id, resource.c.fingerprint).where(
+                    resource.c.domain == domain_name
                 )
-            ]
+            ).fetchall()
         )
-        for rc in [dict(zip(rc_cols, t)) for t in tuples]:
-            all_resource_columns.append(rc)
+        S.rollback()
+        envelope = {}
+        resources, columns = [], []
+        seen = set()
+        ds = dict(inserted=0, updated=0, unchanged=0, deleted=0)
+        try:
+            with S.begin():
+                # the domain row is written once the envelope is complete, after the
+                # resources that refer to it
+                S.connection().exec_driver_sql("PRAGMA defer_foreign_keys = ON")
+                with open(path, "r") as fp:
+                    for resource_row, column_rows in iter_catalog_rows(fp, envelope):
+                        resource_id = resource_row["resource_id"]
+                        seen.add(resource_id)
+                        old = existing.get(resource_id, None)
+                        if old == resource_row["fingerprint"]:
+                            ds["unchanged"] += 1
+                            continue
+                        ds["updated" if resource_id in existing else "inserted"] += 1
+                        resources.append(resource_row)
+                        columns.extend(column_rows)
+                        if len(resources) + len(columns) >= batch_size:
+                            flush(resources, columns)
+                    flush(resources, columns)
 
-    log.info("Done preparing resource-columns")
+                gone = [k for k in existing if k not in seen]
+                for i in range(0, len(gone), batch_size):
+                    chunk = gone[i : i + batch_size]
+                    for t in cooked_tables:
+                        S.execute(t.delete().where(t.c.resource_id.in_(chunk)))
+                    S.execute(
+                        resource_column.delete().where(resource_column.c.resource_id.in_(chunk))
+                    )
+                    S.execute(resource.delete().where(resource.c.resource_id.in_(chunk)))
+                ds["deleted"] = len(gone)
+
+                h = store.put(envelope)
+                store.flush()
+                ins = sqlite_insert(domain).values(domain=domain_name, _resources=h)
+                S.execute(
+                    ins.on_conflict_do_update(
+                        index_elements=[domain.c.domain], set_=dict(_resources=h)
+                    )
+                )
+        except (ValueError, KeyError) as e:
+            store.rollback()
+            log.error("problem decoding JSON", domain=domain_name, error=str(e))
+            continue
+        for k, v in ds.items():
+            stats[k] += v
+        log.info("Done refreshing domain", domain=domain_name, **ds)
 
+    # the payloads of the results that changed or went away
     with S.begin():
-        S.execute(resource_column.insert(), all_resource_columns)
+        stats["pruned"] = prune_payloads(S)
 
-    log.info("Done persisting resource-columns")
-    log.info("Done persisting metadata")
-# with Session() as session:
-#     # q = session.query(Domain).options(joinedload(Domain.resources).joinedload(Resource.columns))
-#     new_m = MetaData()
-#     for dom in session.query(Domain):
-#         target_schema = _domain_to_schema_map.get(dom.domain, None)
-#         print(dom.domain, target_schema)
-#         for r in dom.resources:
-#             skip_table = False
-#             if len(r.columns) == 0:
-#                 print("resource %s has zero columns! %s" % (r.name, r.permalink))
-#                 continue
-#             else:
-#                 # print("%d columns in resource %s" % (len(r.columns), r.name))
-#                 for c in r.columns:
-#                     if len(c.field_name) >= 100:
-#                         print(
-#                             "Column %s in table %s too long (%d). Skipping table"
-#                             % (c.field_name, r.name, len(c.field_name))
-#                         )
-#                         skip_table = True
-#                         break
-#                 pass
-#             # SQLite can deal with such long identifiers as appear in this metadata
-#             # PostgreSQL accepts the identifiers but truncates them. This may cause duplicate column-names
-#             # SQL Server 2019 has a maximum length of 128
-#             if not skip_table:
-#                 t = r.as_sa_table(new_m, schema=target_schema)
-#             # print("adding table %s %s" % (t.name, t.columns))
-
-#     # Posgresql can run out of memory if we try and drop a whole bunch of tables
-#     # at once within the same transaction
-#     print("dropping resource tables")
-#     for tn in new_m.tables:
-#         tab = new_m.tables.get(tn)
-#         tab.drop(bind=session.bind, checkfirst=True)
-
-#     print("Creating resource tables")
-#     new_m.create_all(bind=session.bind)
\ No newline at end of file
+    log.info("Done refreshing metadata", **stats)
+    invalidate_session(S, "socrata")
+    return stats
+
+
+def parallel_socrata_rule4(S, resource_list, max_workers=None):
+    """
+    decode and shred the domain catalog files across a process pool while this process
+    acts as the single writer (SQLite only allows one). Each domain is written in its own
+    transaction as soon as its worker hands back the rows.
+    Returns the accumulated time for each stage."""
+    resource_paths = resource2paths(resource_list)
+    store = PayloadStore(S)
+    timings = dict(decode=0.0, shred=0.0, insert=0.0, cook=0.0, wall=0.0)
+    n_resources = n_columns = 0
+    t_start = time.perf_counter()
+    with deferred_foreign_keys(S), ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(shred_catalog_file, domain_name, path)
+            for domain_name, path in resource_paths.items()
+        ]
+        for f in as_completed(futures):
+            batch = f.result()
+            if "error" in batch:
+                log.error("problem decoding JSON", domain=batch["domain"], error=batch["error"])
+                continue
+            timings["decode"] += batch["decode_seconds"]
+            timings["shred"] += batch["shred_seconds"]
+            n = len(batch["resources"])
+            metrics.add_stage("decode", batch["decode_seconds"], rows=n)
+            metrics.add_stage("shred", batch["shred_seconds"], rows=n)
+
+            with stage(
+                "insert", domain=batch["domain"], rows=n + len(batch["resource_columns"])
+            ) as s:
+                # compressed here rather than in the workers as the dictionary is trained on
+                # whichever batch comes back first
+                for h, text in batch["payloads"].items():
+                    store.add(h, text)
+                store.flush()
+                insert_tuples(S, domain, [(batch["domain"], batch["envelope"])])
+                insert_tuples(S, resource, batch["resources"])
+                insert_tuples(S, resource_column, batch["resource_columns"])
+            with stage("commit", domain=batch["domain"]) as c:
+                S.commit()
+            insert_seconds = s["seconds"] + c["seconds"]
+            timings["insert"] += insert_seconds
+
+            n_resources += len(batch["resources"])
+            n_columns += len(batch["resource_columns"])
+            log.info(
+                "Done persisting domain",
+                domain=batch["domain"],
+                resources=len(batch["resources"]),
+                resource_columns=len(batch["resource_columns"]),
+                decode_seconds=round(batch["decode_seconds"], 3),
+                shred_seconds=round(batch["shred_seconds"], 3),
+                insert_seconds=round(insert_seconds, 3),
+            )
+
+        with stage("cook") as s:
+            cook_resources(S)
+            S.commit()
+        timings["cook"] = s["seconds"]
+    timings["wall"] = time.perf_counter() - t_start
+
+    # decode and shred are summed over the workers so can exceed wall time. When
+    # insert approaches wall the writer is the bottleneck and more workers won't help.
+    log.info(
+        "Done persisting metadata",
+        resources=n_resources,
+        resource_columns=n_columns,
+        **dict((k + "_seconds", round(v, 3)) for k, v in timings.items()),
+    )
+    invalidate_session(S, "socrata")
+    return timings
+
+
+# The Socrata column names can be very long. SQLite does not care, PostgreSQL accepts the
+# identifiers but truncates them (which can produce duplicate column names) and SQL Server 2019
+# has a maximum length of 128. Tables with identifiers that don't fit are skipped and reported.
+def _too_long(name, max_identifier_length):
+    return max_identifier_length is not None and len(name) > max_identifier_length
+
+
+def _rule4_chunks(S, domains, chunk_size):
+    q = sql.select(sql.distinct(resource_column.c.resource_id)).order_by(
+        resource_column.c.resource_id
+    )
+    if domains is not None:
+        q = q.select_from(resource_column.join(resource)).where(resource.c.domain.in_(domains))
+    resource_ids = S.execute(q).scalars().all()
+
+    columns_q = (
+        sql.select(
+            resource.c.domain,
+            resource.c.resource_id,
+            resource_column.c.field_name,
+            resource_column.c.data_type,
+            resource_column.c.description,
+        )
+        .select_from(resource.join(resource_column))
+        .where(resource.c.resource_id.in_(sql.bindparam("resource_ids", expanding=True)))
+        .order_by(resource.c.resource_id, resource_column.c.field_number)
+    )
+    for i in range(0, len(resource_ids), chunk_size):
+        rows = S.execute(columns_q, dict(resource_ids=resource_ids[i : i + chunk_size])).fetchall()
+        # release the read transaction before writing as the target may be the same database
+        S.rollback()
+        yield rows
+
+
+def _catalog_chunks(catalog, domains, chunk_size):
+    # the rows of _rule4_chunks from a CatalogSnapshot, without going to the database
+    records = [
+        r for d in (domains if domains is not None else catalog.domains())
+        for r in catalog.resources(d)
+    ]
+    records.sort(key=lambda r: r.resource_id)
+    for i in range(0, len(records), chunk_size):
+        yield [
+            (r.domain, r.resource_id, c.field_name, c.data_type, c.description)
+            for r in records[i : i + chunk_size]
+            for c in r.columns()
+        ]
+
+
+def materialize_schema(
+    S,
+    target=None,
+    chunk_size=500,
+    drop_existing=True,
+    domains=None,
+    schema_map=None,
+    catalog=None,
+):
+    """
+    create a table for every resource that has columns, using the rule4 metadata. The
+    tables of a domain go in the schema schema_map (default _domain_to_schema_map) gives it.
+    The metadata is read with one set-based query per chunk of chunk_size resources (rather
+    than lazily loading Domain.resources and Resource.columns one at a time), or from a
+    CatalogSnapshot if there is one, and the DDL for each chunk is emitted in its own
+    transaction, so memory is bounded and PostgreSQL does not run out of memory dropping
+    thousands of tables in one transaction.
+    Returns the list of (resource_id, reason) for the tables that were skipped."""
+    target = target if target is not None else S.bind
+    schema_map = _domain_to_schema_map if schema_map is None else schema_map
+    max_identifier_length = getattr(target.dialect, "max_identifier_length", None)
+
+    if catalog is not None:
+        chunks = _catalog_chunks(catalog, domains, chunk_size)
+    else:
+        chunks = _rule4_chunks(S, domains, chunk_size)
+
+    skipped = []
+    n_tables = 0
+    for rows in chunks:
+        metadata = MetaData()
+        for resource_id, cols in groupby(rows, key=lambda r: r[1]):
+            cols = list(cols)
+            target_schema = schema_map.get(cols[0][0], None)
+            if _too_long(resource_id, max_identifier_length):
+                skipped.append((resource_id, "table name too long"))
+                continue
+            long_column = next(
+                (c[2] for c in cols if _too_long(c[2], max_identifier_length)),
+                None,
+            )
+            if long_column is not None:
+                log.warning(
+                    "column name too long. Skipping table",
+                    resource_id=resource_id,
+                    field_name=long_column,
+                    length=len(long_column),
+                )
+                skipped.append((resource_id, "column %s too long" % long_column))
+                continue
+            Table(
+                resource_id,
+                metadata,
+                *[sa_column_for(*c[2:]) for c in cols],
+                schema=target_schema,
+            )
+
+        with target.begin() as conn:
+            if drop_existing:
+                metadata.drop_all(bind=conn, checkfirst=True)
+            metadata.create_all(bind=conn)
+        n_tables += len(metadata.tables)
+        log.info("Done creating resource tables", tables=len(metadata.tables), total=n_tables)
+
+    log.info("Done materializing schema", tables=n_tables, skipped=len(skipped))
+    return skipped
+
+
+def materialize_shard(domain_name, path, rule4, chunk_size=500, drop_existing=True):
+    """
+    materialize_schema for one domain into its shard file (see socrata/shards.py), reading
+    the metadata from the rule4 database file. Module level so that ShardRouter.run_parallel
+    can run it for many domains at once"""
+    from ..connection import create_sqlite_engine
+
+    S = sessionmaker(bind=create_sqlite_engine("sqlite://", profile="bulk-load"))()
+    S.connection().exec_driver_sql("ATTACH DATABASE ? AS socrata", (rule4,))
+    S.commit()
+    target = create_sqlite_engine("sqlite:///%s" % path, profile="bulk-load")
+    try:
+        # the shard is the domain's schema so the tables go in its main
+        return materialize_schema(
+            S, target, chunk_size, drop_existing, domains=[domain_name], schema_map={}
+        )
+    finally:
+        S.close()
+        target.dispose()
+
+
+def _upgrade_rule4(S, version, batch_size=5000):
+    """
+    move the JSON of a rule4 database with it inline in the catalog tables (version 1, or 0
+    without a payload table) into payload, as it is, and cook it. A version 0 file with a
+    payload table already has the current layout, it just was not stamped"""
+    conn = S.connection()
+    tables = set(
+        r[0]
+        for r in conn.exec_driver_sql("SELECT name FROM socrata.sqlite_schema WHERE type = 'table'")
+    )
+    if version == 0 and ("payload" in tables or "resource" not in tables):
+        return
+    log.info("Upgrading rule4 database", version=version, to=rule4_version)
+    # the DDL would otherwise be committed as it goes, leaving a file that looks upgraded
+    conn.exec_driver_sql("BEGIN")
+    columns = set(r[1] for r in conn.exec_driver_sql("PRAGMA socrata.table_info(resource)"))
+    if "fingerprint" not in columns:
+        conn.exec_driver_sql("ALTER TABLE socrata.resource ADD COLUMN fingerprint VARCHAR(40)")
+    resource.metadata.create_all(bind=conn)
+    store = PayloadStore(S)
+    n = 0
+    for table, columns in ((domain, ("_resources",)), (resource, ("metadata", "resource"))):
+        names = ", ".join('"%s"' % c for c in columns)
+        update = "UPDATE socrata.%s SET %s WHERE rowid = ?" % (
+            table.name,
+            ", ".join('"%s" = ?' % c for c in columns),
+        )
+        last = 0
+        while True:
+            rows = conn.exec_driver_sql(
+                "SELECT rowid, %s FROM socrata.%s WHERE rowid > ? ORDER BY rowid LIMIT ?"
+                % (names, table.name),
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            rows = store.put_columns([dict(zip(("rowid",) + columns, r)) for r in rows], columns)
+            store.flush()
+            conn.exec_driver_sql(
+                update, [tuple(r[c] for c in columns) + (r["rowid"],) for r in rows]
+            )
+            n += len(rows)
+    cook_resources(S)
+    log.info("Done upgrading rule4 database", rows=n, payloads=store.payloads)
+
+
+def rule4_session(engine, database, connection_profile="bulk-load"):
+    """
+    a Session on engine (an in-memory SQLite engine) with the rule4 database file ATTACHed as
+    socrata, the per-database PRAGMAs of the connection profile applied to it, payload_json
+    registered and the rule4 tables created if they are not there already. A file with an
+    older layout is upgraded; one with a newer layout is refused"""
+    S = sessionmaker(bind=engine)()
+    conn = S.connection()
+    conn.exec_driver_sql("ATTACH DATABASE ? AS socrata", (database,))
+    apply_pragmas(conn.connection, connection_profile, schema="socrata")
+    register_functions(conn.connection)
+    S.commit()
+    version = S.connection().exec_driver_sql("PRAGMA socrata.user_version").scalar()
+    if version > rule4_version:
+        S.close()
+        raise ValueError(
+            "%s is a version %d rule4 database, this only knows up to version %d"
+            % (database, version, rule4_version)
+        )
+    if version < rule4_version:
+        _upgrade_rule4(S, version)
+    conn = S.connection()
+    resource.metadata.create_all(bind=conn)
+    conn.exec_driver_sql(resource_json_ddl.format(schema="socrata"))
+    conn.exec_driver_sql("PRAGMA socrata.user_version = %d" % rule4_version)
+    S.commit()
+    return S
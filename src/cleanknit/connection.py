@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+
+import pysqlite3
+from sqlalchemy import create_engine, event
+from structlog import get_logger
+
+log = get_logger()
+
+# Named sets of PRAGMAs for the different ways we use SQLite. These replace the old global
+# "connect" listener in socrata/model.py which turned on foreign_keys for every Engine
+# (including non-SQLite ones). A profile is applied to a particular engine, and only if it is
+# a SQLite engine.
+# xref https://www.sqlite.org/pragma.html
+# xref https://www.sqlite.org/wal.html
+#
+# cache_size is negative so it is in KiB rather than pages.
+connection_profiles = {
+    # what set_sqlite_pragma used to do
+    "default": dict(foreign_keys="ON"),
+    # loaders: durability only matters once the load has finished and the FKs are checked
+    # in one go at the end (see deferred_foreign_keys)
+    "bulk-load": dict(
+        journal_mode="WAL",
+        synchronous="OFF",
+        cache_size=-1048576,
+        mmap_size=0,
+        temp_store="MEMORY",
+        foreign_keys="OFF",
+    ),
+    # the shell, search and other short queries against a database someone else is loading
+    "interactive-read": dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-65536,
+        mmap_size=268435456,
+        temp_store="MEMORY",
+        foreign_keys="ON",
+    ),
+    # big scans and aggregations over the loaded datasets
+    "analytics": dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-524288,
+        mmap_size=4294967296,
+        temp_store="MEMORY",
+        foreign_keys="ON",
+    ),
+}
+
+
+def apply_pragmas(dbapi_connection, profile, schema=None):
+    """
+    set the PRAGMAs of the named profile on a DBAPI connection. Pass schema to apply the
+    per-database ones (journal_mode etc.) to a database that was ATTACHed after connecting"""
+    pragmas = connection_profiles[profile]
+    prefix = f'"{schema}".' if schema else ""
+    cursor = dbapi_connection.cursor()
+    try:
+        for k, v in pragmas.items():
+            if schema and k in ("foreign_keys", "temp_store"):
+                # these are per-connection rather than per-database
+                continue
+            cursor.execute(f"PRAGMA {prefix}{k}={v}")
+    finally:
+        cursor.close()
+
+
+def apply_profile(engine, profile):
+    """
+    apply the named profile to every connection the engine makes. Does nothing for
+    engines that are not SQLite"""
+    if profile not in connection_profiles:
+        raise ValueError("unknown connection profile %s" % profile)
+    if engine.dialect.name != "sqlite":
+        return engine
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, profile)
+
+    return engine
+
+
+def create_sqlite_engine(url="sqlite://", profile="default", **kwargs):
+    """
+    create_engine with the hand-rolled pysqlite3 and the named connection profile"""
+    kwargs.setdefault("module", pysqlite3)
+    return apply_profile(create_engine(url, **kwargs), profile)
+
+
+@contextmanager
+def deferred_foreign_keys(S):
+    """
+    turn off foreign key enforcement for the duration of a bulk load and then run a single
+    PRAGMA foreign_key_check over everything instead of checking each row as it goes in.
+    Must be entered outside of a transaction as SQLite ignores PRAGMA foreign_keys inside one.
+    The violations (schema, table, rowid, parent, fkid) are put in the list that is yielded.
+    If the load raises it is rolled back, not checked or committed."""
+    conn = S.connection()
+    previous = conn.exec_driver_sql("PRAGMA foreign_keys").scalar()
+    restore = "PRAGMA foreign_keys=%s" % ("ON" if previous else "OFF")
+    conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+    S.commit()
+    violations = []
+    try:
+        yield violations
+    except:
+        S.rollback()
+        S.connection().exec_driver_sql(restore)
+        S.commit()
+        raise
+    conn = S.connection()
+    # without a schema name foreign_key_check only looks at main
+    for db in [r[1] for r in conn.exec_driver_sql("PRAGMA database_list")]:
+        violations.extend(
+            (db,) + tuple(r) for r in conn.exec_driver_sql(f'PRAGMA "{db}".foreign_key_check')
+        )
+    S.commit()
+    # after the commit, as it would be ignored in the load's transaction
+    S.connection().exec_driver_sql(restore)
+    S.commit()
+    if violations:
+        log.error(
+            "foreign key violations after bulk load",
+            violations=len(violations),
+            first=violations[0],
+        )
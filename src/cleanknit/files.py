@@ -0,0 +1,25 @@
+import hashlib
+import re
+
+# The files behind the databases, for the modules that need to know about them: the data
+# dictionary cache and the query cache both key on the SHA-256 of a file, and the profiler and
+# the query cache both need the CSV that a vsv virtual table reads.
+# xref https://docs.python.org/3/library/hashlib.html#hashlib.sha256
+
+# CREATE VIRTUAL TABLE "vsv_8wi4-bsy4" USING vsv(filename="/mnt/c/data/socrata/8wi4-bsy4.csv",...)
+_vsv_filename = re.compile(r"""filename\s*=\s*["']?([^"',)]+)""")
+
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def vsv_filename(ddl):
+    """
+    the file a vsv virtual table reads, from its CREATE VIRTUAL TABLE statement (or None)"""
+    m = _vsv_filename.search(ddl or "")
+    return m.group(1) if m else None
@@ -0,0 +1,178 @@
+import atexit
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import event
+from structlog import get_logger
+
+log = get_logger()
+
+# Where does a reload spend its time? Three sources of numbers, all collected in the one
+# in-process registry (metrics) which can be written out as JSON:
+#  * stage spans: `with stage("insert", table="resource", rows=n):` times a block and logs it
+#  * statement stats: hooks on an Engine's cursor execution aggregate latency and rowcount by
+#    normalized SQL (literals replaced by ? and IN lists collapsed) so the same statement with
+#    different parameters is counted together
+#  * a SQLite progress handler that counts VM steps per statement and reports statements
+#    that are still running after slow_seconds
+# xref https://docs.sqlalchemy.org/en/14/core/events.html#sqlalchemy.events.ConnectionEvents.before_cursor_execute
+# xref https://www.sqlite.org/c3ref/progress_handler.html
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.utcnow()
+            self.t0 = time.perf_counter()
+            self.stages = {}
+            self.statements = {}
+            self.slow_statements = []
+
+    def add_stage(self, name, seconds, rows=None, bytes=None):
+        with self.lock:
+            s = self.stages.setdefault(name, dict(count=0, seconds=0.0, rows=0, bytes=0))
+            s["count"] += 1
+            s["seconds"] += seconds
+            s["rows"] += rows or 0
+            s["bytes"] += bytes or 0
+
+    def add_statement(self, statement, seconds, rowcount, executemany, vm_steps=0):
+        with self.lock:
+            s = self.statements.get(statement, None)
+            if s is None:
+                s = self.statements[statement] = dict(
+                    count=0, executemany=0, seconds=0.0, max_seconds=0.0, rowcount=0, vm_steps=0
+                )
+            s["count"] += 1
+            s["executemany"] += 1 if executemany else 0
+            s["seconds"] += seconds
+            s["max_seconds"] = max(s["max_seconds"], seconds)
+            # rowcount is -1 for SELECTs and the like
+            s["rowcount"] += rowcount if rowcount and rowcount > 0 else 0
+            s["vm_steps"] += vm_steps
+
+    def add_slow_statement(self, statement, seconds):
+        with self.lock:
+            self.slow_statements.append(dict(statement=statement, seconds=round(seconds, 3)))
+
+    def as_dict(self, top=50):
+        with self.lock:
+            statements = sorted(
+                (dict(statement=k, **v) for k, v in self.statements.items()),
+                key=lambda s: -s["seconds"],
+            )
+            return dict(
+                started_at=self.started_at.isoformat(),
+                wall_seconds=time.perf_counter() - self.t0,
+                stages=dict((k, dict(v)) for k, v in self.stages.items()),
+                statements=statements[:top] if top else statements,
+                slow_statements=list(self.slow_statements),
+            )
+
+    def dump(self, path, top=50):
+        with open(path, "w") as fp:
+            json.dump(self.as_dict(top), fp, indent=2)
+        log.info("Done writing metrics", path=path)
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def stage(name, rows=None, bytes=None, **fields):
+    """
+    time the block as the named stage and log it. The yielded dict can be used to fill in
+    rows/bytes once they are known, e.g. with stage("decode") as s: ... s["rows"] = n, and
+    has the seconds in it afterwards"""
+    span = dict(rows=rows, bytes=bytes)
+    t0 = time.perf_counter()
+    try:
+        yield span
+    finally:
+        seconds = span["seconds"] = time.perf_counter() - t0
+        metrics.add_stage(name, seconds, span["rows"], span["bytes"])
+        counts = dict((k, span[k]) for k in ("rows", "bytes") if span[k] is not None)
+        log.info("stage", stage=name, seconds=round(seconds, 3), **dict(fields, **counts))
+
+
+def write_metrics_at_exit(path, top=50):
+    atexit.register(metrics.dump, path, top)
+
+
+# quoted identifiers (group 1) are kept, string and numeric literals are replaced
+_sql_token = re.compile(
+    r"""("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b"""
+)
+_in_list = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """
+    the statement with literals replaced by ? (quoted identifiers are left alone), lists of
+    placeholders collapsed to (?, ...) and the whitespace squeezed"""
+    s = _sql_token.sub(lambda m: m.group(1) or "?", statement)
+    s = _in_list.sub("(?, ...)", s)
+    return _whitespace.sub(" ", s).strip()
+
+
+def instrument_engine(engine, progress_every=None, slow_seconds=1.0):
+    """
+    aggregate every statement executed through engine into metrics. If progress_every is
+    given (a number of SQLite VM instructions) a progress handler is installed on each new
+    connection which counts the work done by each statement and logs a warning when one has
+    been running for more than slow_seconds.
+    Note that for a SELECT the time is to the first row as the rows are fetched afterwards."""
+
+    # per-connection state, shared between the hooks and the progress handler through the
+    # pool's per-connection info dict
+    def state(info):
+        return info.setdefault("instrument", dict(statement=None))
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        s = state(conn.connection.info)
+        s.update(statement=statement, t0=time.perf_counter(), vm_steps=0, reported=False)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        s = state(conn.connection.info)
+        seconds = time.perf_counter() - s.get("t0", time.perf_counter())
+        metrics.add_statement(
+            normalize_sql(statement), seconds, cursor.rowcount, executemany, s.get("vm_steps", 0)
+        )
+        s["statement"] = None
+
+    if progress_every and engine.dialect.name == "sqlite":
+
+        @event.listens_for(engine, "connect")
+        def set_progress_handler(dbapi_connection, connection_record):
+            s = state(connection_record.info)
+
+            def progress():
+                if s["statement"] is None:
+                    return 0
+                s["vm_steps"] += progress_every
+                elapsed = time.perf_counter() - s["t0"]
+                if elapsed > slow_seconds and not s["reported"]:
+                    s["reported"] = True
+                    statement = normalize_sql(s["statement"])
+                    metrics.add_slow_statement(statement, elapsed)
+                    log.warning("long running statement", statement=statement[:200])
+                # anything other than 0 would abort the statement
+                return 0
+
+            dbapi_connection.set_progress_handler(progress, progress_every)
+            # SQLite has one progress handler per connection and no way of asking for it, so
+            # anything that swaps in its own (e.g. the shell) finds this one here to put back
+            connection_record.info["progress_handler"] = (progress, progress_every)
+
+    return engine
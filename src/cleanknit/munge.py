@@ -1,14 +1,54 @@
+import os
+import time
+
 import pysqlite3
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, MetaData, Table, Column
+from sqlalchemy.types import Integer, Text, Float, Numeric, NullType
 from structlog import get_logger
 
+from .socrata.model import _type_map
+
 log = get_logger()
 
 
 # Copy the named schema from our application to a file-based database
 # xref https://stackoverflow.com/a/67162137/40387
+#
+# The copy is done a chunk of pages at a time (the pages= form of the backup API) so that the
+# source is only locked for the duration of each step. Pausing between steps gives other
+# connections a chance to get at the database; note that if another connection writes to the
+# source the backup starts over (writes through this same connection are picked up in place).
+# xref https://www.sqlite.org/backup.html
+# xref https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.backup
+
+def _stepped_backup(source, target, name, pages, pause, label):
+    t0 = time.perf_counter()
+    last = [t0]
+    page_size = source.execute(f'PRAGMA "{name}".page_size').fetchone()[0]
+
+    def progress(status, remaining, total):
+        now = time.perf_counter()
+        done = total - remaining
+        # don't flood the log for big databases
+        if now - last[0] >= 1.0 or remaining == 0:
+            last[0] = now
+            log.info(
+                f"backup progress {label}",
+                pages_done=done,
+                pages_total=total,
+                mb_per_second=round(done * page_size / 1e6 / max(now - t0, 1e-9), 1),
+            )
+        if pause and remaining:
+            time.sleep(pause)
 
-def backup_schema(S, schema_name, url):
+    source.backup(target, pages=pages, progress=progress, name=name)
+    return time.perf_counter() - t0
+
+
+def backup_schema(S, schema_name, url, pages=1024, pause=0.0):
+    """
+    copy schema_name to the database at url in steps of pages pages, sleeping pause seconds
+    between steps. pages=-1 copies everything in one step"""
     engine_backup_file = create_engine(
         url, module=pysqlite3
     )
@@ -16,10 +56,91 @@ def backup_schema(S, schema_name, url):
     raw_connection_socrata_resource = S.bind.raw_connection()
 
     log.info(f"Backing up {schema_name} to {url}")
-    raw_connection_socrata_resource.backup(
-        raw_connection_backup_file.connection, name=schema_name
+    elapsed = _stepped_backup(
+        raw_connection_socrata_resource.connection,
+        raw_connection_backup_file.connection,
+        schema_name,
+        pages,
+        pause,
+        schema_name,
+    )
+    raw_connection_backup_file.close()
+    log.info(f"done with {schema_name}", seconds=round(elapsed, 3))
+
+
+def snapshot_schema(S, schema_name, path):
+    """
+    write a compacted copy of schema_name to path with VACUUM INTO. Unlike a backup this
+    drops free pages and defragments the b-trees so the snapshot is usually smaller and
+    faster to scan, but it is a single statement.
+    xref https://www.sqlite.org/lang_vacuum.html#vacuuminto"""
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    t0 = time.perf_counter()
+    S.connection().exec_driver_sql(f'VACUUM "{schema_name}" INTO ?', (path,))
+    elapsed = time.perf_counter() - t0
+    size = os.path.getsize(path)
+    log.info(
+        f"done with snapshot of {schema_name}",
+        path=path,
+        bytes=size,
+        mb_per_second=round(size / 1e6 / max(elapsed, 1e-9), 1),
+    )
+    return path
+
+
+def restore_schema(S, path, schema_name, copy_to=None, pages=1024, pause=0.0):
+    """
+    make a snapshot (or backup) available as schema_name. By default the file is simply
+    ATTACHed, which costs nothing however big it is. If copy_to is given the snapshot is first
+    copied there with the stepped backup (so the snapshot itself stays pristine) and the copy
+    is attached instead."""
+    if copy_to is not None:
+        source = pysqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        target = pysqlite3.connect(copy_to)
+        try:
+            _stepped_backup(source, target, "main", pages, pause, path)
+        finally:
+            source.close()
+            target.close()
+        path = copy_to
+    S.connection().exec_driver_sql(f'ATTACH DATABASE ? AS "{schema_name}"', (path,))
+    log.info(f"restored {schema_name}", path=path)
+
+
+def insert_tuples(S, table, rows):
+    """
+    executemany of positional tuples (in table column order) straight through the DBAPI.
+    Any JSON columns are expected to be serialized already as this bypasses the SQLAlchemy
+    type processing (which would otherwise encode them a second time)."""
+    if not rows:
+        return
+    prep = S.bind.dialect.identifier_preparer
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        prep.format_table(table),
+        ", ".join(prep.quote(c.name) for c in table.columns),
+        ", ".join("?" * len(table.columns)),
+    )
+    S.connection().exec_driver_sql(sql, rows)
+
+
+def upsert_tuples(S, table, rows, key):
+    """
+    insert_tuples, updating the row in place (so keeping its rowid) where the key column
+    matches one already there. The key column needs a unique index"""
+    if not rows:
+        return
+    prep = S.bind.dialect.identifier_preparer
+    names = [prep.quote(c.name) for c in table.columns]
+    sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s" % (
+        prep.format_table(table),
+        ", ".join(names),
+        ", ".join("?" * len(names)),
+        prep.quote(key),
+        ", ".join("%s = excluded.%s" % (n, n) for n in names if n != prep.quote(key)),
     )
-    log.info(f"done with {schema_name}")
+    S.connection().exec_driver_sql(sql, rows)
+
 
 def create_tables_in_schema(S, schema_name, metadata):
     # get rid of the password. See about using certificates instead.
@@ -38,5 +159,103 @@ def create_tables_in_schema(S, schema_name, metadata):
     # schema_map = {"socrata": None}
     # e.connect().execution_options(schema_translate_map=schema_map)
     # e.execution_options(schema_translate_map=schema_map)
-    tables = filter(lambda t: t.schema==schema_name, metadata.tables)
-    metadata.create_all(bind=S.bind, tables=tables)
+    # metadata.tables is keyed by name so filter the Table objects themselves, and use the
+    # session's connection as that is the one the schema is attached to.
+    tables = [t for t in metadata.tables.values() if t.schema == schema_name]
+    metadata.create_all(bind=S.connection(), tables=tables)
+
+
+# Set-based replacement for MetaData(schema=...).reflect() on an ATTACHed database.
+# Rather than issuing several PRAGMAs per table we get every column of every table in
+# one query using the table-valued pragma functions
+# xref https://www.sqlite.org/pragma.html#pragfunc
+_reflect_query = """
+SELECT s.name AS table_name, c.cid, c.name AS column_name, c.type, c."notnull", c.pk{rc_select}
+FROM "{schema}".sqlite_schema AS s
+    JOIN pragma_table_info(s.name, '{schema}') AS c{rc_join}
+WHERE s.type = 'table'
+    AND s.name NOT LIKE 'sqlite\\_%' ESCAPE '\\'
+ORDER BY s.name, c.cid
+"""
+
+# The data tables are named after the Socrata resource id, possibly with a prefix
+# (e.g. the vsv_ virtual tables) so match the metadata on the last 9 characters.
+_reflect_rc_select = ", rc.data_type"
+_reflect_rc_join = """
+    LEFT OUTER JOIN "{rule4_schema}".resource_column AS rc
+        ON (rc.resource_id = substr(s.name, -9) AND rc.field_name = c.name)"""
+
+
+def _affinity_type(declared_type):
+    # https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+    t = (declared_type or "").upper()
+    if "INT" in t:
+        return Integer
+    if "CHAR" in t or "CLOB" in t or "TEXT" in t:
+        return Text
+    if t == "" or "BLOB" in t:
+        return NullType
+    if "REAL" in t or "FLOA" in t or "DOUB" in t:
+        return Float
+    return Numeric
+
+
+def reflect_schema(S, schema_name, rule4_schema="socrata"):
+    """
+    reflect all the tables in an attached schema into a new MetaData. Where the table is
+    described in rule4_schema.resource_column the Socrata data type is used via _type_map,
+    otherwise the SQLite declared type is mapped by affinity.
+    The result is cached on the connection (what is attached and under which name is only
+    known to it) for as long as neither schema changes. That is PRAGMA schema_version for the
+    tables, and for the rule4 types also PRAGMA data_version (commits by other connections)
+    and total_changes() (writes through this one)."""
+    conn = S.connection()
+    databases = dict((r[1], r[2]) for r in conn.exec_driver_sql("PRAGMA database_list"))
+    have_rule4 = (
+        rule4_schema in databases
+        and conn.exec_driver_sql(
+            f"SELECT count(*) FROM \"{rule4_schema}\".sqlite_schema WHERE name = 'resource_column'"
+        ).scalar()
+        > 0
+    )
+    version = (conn.exec_driver_sql(f'PRAGMA "{schema_name}".schema_version').scalar(),)
+    if have_rule4:
+        version += (
+            conn.exec_driver_sql(f'PRAGMA "{rule4_schema}".schema_version').scalar(),
+            conn.exec_driver_sql(f'PRAGMA "{rule4_schema}".data_version').scalar(),
+            conn.exec_driver_sql("SELECT total_changes()").scalar(),
+        )
+    key = (schema_name, databases.get(schema_name), rule4_schema)
+    cache = conn.connection.info.setdefault("reflect_schema", {})
+    cached = cache.get(key, None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    q = _reflect_query.format(
+        schema=schema_name,
+        rc_select=_reflect_rc_select if have_rule4 else "",
+        rc_join=_reflect_rc_join.format(rule4_schema=rule4_schema) if have_rule4 else "",
+    )
+
+    metadata = MetaData(schema=schema_name)
+    columns = {}
+    for row in S.execute(q):
+        socrata_type = row.data_type if have_rule4 else None
+        if socrata_type is not None:
+            type_ = _type_map.get(socrata_type, Text)
+        else:
+            type_ = _affinity_type(row.type)
+        columns.setdefault(row.table_name, []).append(
+            Column(
+                row.column_name,
+                type_,
+                primary_key=row.pk > 0,
+                nullable=not row.notnull,
+            )
+        )
+    for table_name, cols in columns.items():
+        Table(table_name, metadata, *cols, schema=schema_name)
+    log.info(f"reflected {len(columns)} tables from {schema_name}")
+
+    cache[key] = (version, metadata)
+    return metadata
@@ -0,0 +1,382 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+import pysqlite3
+from sqlalchemy.orm import Session
+from structlog import get_logger
+
+from .files import file_hash, vsv_filename
+
+log = get_logger()
+
+# Opt-in cache of query results that outlives the process, for the type surveys, category
+# rollups and the like that the shell and the notebooks run over and over. The results are
+# kept (as zlib compressed JSON) in a side SQLite file under a key made of
+#  * the statement, with the whitespace outside of the literals squeezed, and its parameters
+#  * for each database the statement reads: its file, PRAGMA schema_version and the size and
+#    mtime of the file and its -wal, which change with every commit from any connection
+#  * for each file-backed virtual table it reads (the vsv_* tables over the CSV exports): the
+#    file's size, mtime and SHA-256, the checksum only being recomputed when those change
+# so a result is never served once anything it was computed from has changed. PRAGMA
+# data_version is no use here as it only means anything to the one connection that asked.
+#
+# Which databases and tables a statement reads comes from the authorizer callback while
+# SQLite prepares it (through EXPLAIN, so the statement is not run). Only plain reads are
+# cached: anything that writes, reads a temporary or in-memory database (which has no version
+# that means anything to another process) or calls a function like random() is just run.
+#
+# The file is bounded in size: the least recently used results are evicted to make room.
+# Stale entries are never hit again and so age out the same way, or the loaders drop them
+# straight away with invalidate_session. The cache used by the loaders and by default is the
+# file named by $CLEANKNIT_QUERY_CACHE, if it is set.
+#
+#   cache = QueryCache("query_cache.db")
+#   columns, rows = cache.query(S, "SELECT category, count(*) FROM ... GROUP BY category")
+# xref https://www.sqlite.org/c3ref/set_authorizer.html
+# xref https://www.sqlite.org/pragma.html#pragma_schema_version
+
+environment_variable = "CLEANKNIT_QUERY_CACHE"
+
+_ddl = [
+    """CREATE TABLE IF NOT EXISTS query_result(
+        key TEXT PRIMARY KEY,
+        statement TEXT NOT NULL,
+        -- JSON list of the database and source files the result depends on
+        dependencies TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        used_at REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        row_count INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS ix_query_result_used_at ON query_result(used_at)",
+    """CREATE TABLE IF NOT EXISTS source_checksum(
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        checksum TEXT NOT NULL)""",
+]
+
+_read_actions = (pysqlite3.SQLITE_SELECT, pysqlite3.SQLITE_READ, pysqlite3.SQLITE_RECURSIVE)
+_volatile_functions = frozenset(
+    """random randomblob changes last_insert_rowid total_changes current_date current_time
+    current_timestamp""".split()
+)
+_date_functions = frozenset("date time datetime julianday unixepoch strftime timediff".split())
+_now = re.compile(r"'now'", re.IGNORECASE)
+# pysqlite would BEGIN ahead of an EXPLAIN INSERT, say, so only these even get that far
+_query = re.compile(r"^\s*(SELECT|WITH|VALUES)\b", re.IGNORECASE)
+_virtual_q = """SELECT sql FROM "%s".sqlite_schema WHERE type = 'table' AND name = ?"""
+
+# literals and quoted identifiers (kept as they are) or a run of whitespace
+_sql_token = re.compile(r"""("(?:[^"]|"")*"|'(?:[^']|'')*'|`[^`]*`|\[[^\]]*\])|\s+""")
+
+
+def normalize_statement(statement):
+    """
+    the statement with the whitespace outside of the literals squeezed and any trailing ;
+    removed. Unlike instrument.normalize_sql the literals are kept"""
+    s = _sql_token.sub(lambda m: m.group(1) or " ", statement).strip()
+    return s[:-1].rstrip() if s.endswith(";") else s
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _default(o):
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return {"$bytes": base64.b64encode(bytes(o)).decode("ascii")}
+    raise TypeError("can't cache a %s" % type(o).__name__)
+
+
+def _object_hook(d):
+    return base64.b64decode(d["$bytes"]) if len(d) == 1 and "$bytes" in d else d
+
+
+def encode_result(columns, rows):
+    text = json.dumps(dict(columns=columns, rows=rows), separators=(",", ":"), default=_default)
+    return zlib.compress(text.encode("utf-8"))
+
+
+def decode_result(data):
+    d = json.loads(zlib.decompress(data).decode("utf-8"), object_hook=_object_hook)
+    return d["columns"], [tuple(r) for r in d["rows"]]
+
+
+def _connection(S):
+    return S.connection() if isinstance(S, Session) else S
+
+
+class Lookup:
+    """
+    what QueryCache.lookup found out about a statement. key is None if the statement can't
+    be cached; result is the (columns, rows) if it was"""
+
+    __slots__ = ("statement", "key", "dependencies", "result")
+
+    def __init__(self, statement, key=None, dependencies=(), result=None):
+        self.statement = statement
+        self.key = key
+        self.dependencies = dependencies
+        self.result = result
+
+
+class QueryCache:
+    def __init__(self, path, max_bytes=256 << 20, max_entry_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        # one result may not push out more than a quarter of the others
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 4
+        # autocommit: every hit, store and eviction is its own short transaction so shells,
+        # notebooks and loaders can share the file
+        self.c = pysqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.c.execute("PRAGMA journal_mode=WAL")
+        self.c.execute("PRAGMA synchronous=NORMAL")
+        self.c.execute("PRAGMA busy_timeout=5000")
+        for ddl in _ddl:
+            self.c.execute(ddl)
+        self.hits = self.misses = self.uncacheable = self.evictions = 0
+
+    def close(self):
+        self.c.close()
+
+    def _source_checksum(self, path, stat):
+        row = self.c.execute(
+            "SELECT checksum FROM source_checksum WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat[0], stat[1]),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        checksum = file_hash(path)
+        self.c.execute(
+            "INSERT OR REPLACE INTO source_checksum(path, mtime_ns, size, checksum) "
+            "VALUES (?, ?, ?, ?)",
+            (path, stat[1], stat[0], checksum),
+        )
+        return checksum
+
+    def _reads(self, dbapi_connection, statement, params):
+        """
+        the (database, table) pairs the statement reads or None if it is not a plain read"""
+        if not _query.match(statement):
+            return None
+        reads = set()
+        ok = [True]
+        now = bool(_now.search(statement)) or any(
+            isinstance(p, str) and p.lower() == "now"
+            for p in (params.values() if isinstance(params, dict) else params)
+        )
+
+        def authorizer(action, arg1, arg2, database, trigger):
+            if action == pysqlite3.SQLITE_READ:
+                reads.add((database, arg1))
+            elif action == pysqlite3.SQLITE_FUNCTION:
+                name = arg2.lower()
+                if name in _volatile_functions or (now and name in _date_functions):
+                    ok[0] = False
+            elif action not in _read_actions:
+                ok[0] = False
+            return pysqlite3.SQLITE_OK
+
+        dbapi_connection.set_authorizer(authorizer)
+        try:
+            dbapi_connection.execute("EXPLAIN " + statement, params).fetchall()
+        except (pysqlite3.Error, pysqlite3.Warning):
+            # more than one statement, or one that fails: let running it report that
+            return None
+        finally:
+            dbapi_connection.set_authorizer(None)
+        return reads if ok[0] else None
+
+    def _versions(self, dbapi_connection, reads):
+        """
+        (versions, dependencies) for the key, or None if something read has no version"""
+        files = dict((r[1], r[2]) for r in dbapi_connection.execute("PRAGMA database_list"))
+        versions, dependencies = [], []
+        for database in sorted(set(d for d, _ in reads)):
+            path = files.get(database, "")
+            if not path:
+                return None
+            path = os.path.realpath(path)
+            schema_version = dbapi_connection.execute(
+                'PRAGMA "%s".schema_version' % database.replace('"', '""')
+            ).fetchone()[0]
+            versions.append([path, schema_version, _stat(path), _stat(path + "-wal")])
+            dependencies.append(path)
+        for database, table in sorted(reads):
+            row = dbapi_connection.execute(
+                _virtual_q % database.replace('"', '""'), (table,)
+            ).fetchone()
+            if row is None or not (row[0] or "").upper().startswith("CREATE VIRTUAL"):
+                continue
+            source = vsv_filename(row[0])
+            if source is None:
+                continue
+            source = os.path.realpath(source)
+            stat = _stat(source)
+            if stat is None:
+                return None
+            versions.append([source, stat, self._source_checksum(source, stat)])
+            dependencies.append(source)
+        return versions, dependencies
+
+    def lookup(self, S, statement, params=()):
+        """
+        look the statement up for a Session (or Connection). If the Lookup has a key but
+        no result, run the statement and hand the result to store"""
+        statement = normalize_statement(statement)
+        conn = _connection(S)
+        dbapi_connection = conn.connection.connection
+        # uncommitted changes of our own are not in any version
+        reads = None if dbapi_connection.in_transaction else self._reads(
+            dbapi_connection, statement, params
+        )
+        versions = self._versions(dbapi_connection, reads) if reads else None
+        if versions is None:
+            self.uncacheable += 1
+            return Lookup(statement)
+        key = hashlib.sha1(
+            json.dumps([statement, params, versions[0]], default=repr).encode("utf-8")
+        ).hexdigest()
+        lookup = Lookup(statement, key, versions[1])
+        row = self.c.execute("SELECT data FROM query_result WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return lookup
+        self.hits += 1
+        self.c.execute(
+            "UPDATE query_result SET used_at = ?, hits = hits + 1 WHERE key = ?",
+            (time.time(), key),
+        )
+        lookup.result = decode_result(row[0])
+        return lookup
+
+    def store(self, lookup, columns, rows):
+        """
+        keep the result of a statement that lookup missed"""
+        if lookup.key is None:
+            return False
+        try:
+            data = encode_result(list(columns), [list(r) for r in rows])
+        except TypeError:
+            return False
+        if len(data) > self.max_entry_bytes:
+            return False
+        now = time.time()
+        self.c.execute("BEGIN IMMEDIATE")
+        try:
+            self.c.execute(
+                "INSERT OR REPLACE INTO query_result(key, statement, dependencies, created_at, "
+                "used_at, hits, row_count, size, data) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                (
+                    lookup.key,
+                    lookup.statement,
+                    json.dumps(lookup.dependencies),
+                    now,
+                    now,
+                    len(rows),
+                    len(data),
+                    data,
+                ),
+            )
+            self._evict()
+            self.c.execute("COMMIT")
+        except BaseException:
+            self.c.execute("ROLLBACK")
+            raise
+        lookup.result = (list(columns), [tuple(r) for r in rows])
+        return True
+
+    def _evict(self):
+        total = self.c.execute("SELECT coalesce(sum(size), 0) FROM query_result").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # the least recently used, as many as it takes to get back under max_bytes
+        n = self.c.execute(
+            """
+DELETE FROM query_result WHERE key IN (
+    SELECT key FROM (
+        SELECT key, sum(size) OVER (ORDER BY used_at, key) - size AS freed_before
+        FROM query_result)
+    WHERE freed_before < ?)
+""",
+            (total - self.max_bytes,),
+        ).rowcount
+        self.evictions += n
+
+    def query(self, S, statement, params=()):
+        """
+        (columns, rows) for the statement, from the cache if it has them already"""
+        lookup = self.lookup(S, statement, params)
+        if lookup.result is not None:
+            return lookup.result
+        result = _connection(S).exec_driver_sql(lookup.statement, params)
+        columns, rows = list(result.keys()), [tuple(r) for r in result.fetchall()]
+        self.store(lookup, columns, rows)
+        return columns, rows
+
+    def invalidate(self, path=None):
+        """
+        drop the results that depend on the database (or source) file at path, or all of
+        them. Returns the number dropped"""
+        if path is None:
+            n = self.c.execute("DELETE FROM query_result").rowcount
+        else:
+            n = self.c.execute(
+                "DELETE FROM query_result WHERE EXISTS ("
+                "SELECT 1 FROM json_each(query_result.dependencies) WHERE value = ?)",
+                (os.path.realpath(path),),
+            ).rowcount
+        log.info("Done invalidating query cache", path=path, results=n)
+        return n
+
+    def stats(self):
+        entries, size, hits = self.c.execute(
+            "SELECT count(*), coalesce(sum(size), 0), coalesce(sum(hits), 0) FROM query_result"
+        ).fetchone()
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            uncacheable=self.uncacheable,
+            evictions=self.evictions,
+            entries=entries,
+            bytes=size,
+            total_hits=hits,
+        )
+
+
+def default_cache():
+    """
+    the QueryCache named by $CLEANKNIT_QUERY_CACHE or None"""
+    path = os.environ.get(environment_variable, None)
+    return QueryCache(path) if path else None
+
+
+def invalidate_session(S, schema=None, cache=None):
+    """
+    for the loaders: drop the cached results that depend on the database files attached to
+    S (only schema if given) from cache, by default the one named by $CLEANKNIT_QUERY_CACHE.
+    Does nothing if there is no cache"""
+    own = cache is None
+    cache = default_cache() if own else cache
+    if cache is None:
+        return 0
+    n = 0
+    try:
+        for _, name, path in S.connection().exec_driver_sql("PRAGMA database_list"):
+            if path and (schema is None or name == schema):
+                n += cache.invalidate(path)
+    finally:
+        if own:
+            cache.close()
+    return n
@@ -16,6 +16,22 @@ CREATE TABLE resource(
     FOREIGN KEY(domain) REFERENCES domain (domain)
 );
 
+-- The queries read the JSON through resource_json so that they work just as well against a
+-- rule4 database written by cleanknit. There resource.resource and resource.metadata only hold
+-- the sha1 of the JSON, which is kept compressed in payload, and resource_json is a view that
+-- decodes it with payload_json() (see cleanknit/socrata/payload.py). Its [resource] is the
+-- whole result object, which is put back together here.
+CREATE VIEW resource_json AS
+SELECT
+    domain,
+    resource_id,
+    [name],
+    permalink,
+    metadata,
+    json_object('resource', json([resource]), 'metadata', json(metadata)) AS [resource]
+FROM
+    resource;
+
 -- see https://www.sqlite.org/fts5.html
 CREATE VIRTUAL TABLE resource_fts USING fts5([name], [description], content = resource);
 
@@ -287,18 +303,18 @@ WITH T AS (
         r.resource_id,
         i + 1 as field_number,
         -- the JSON is zero-based but we want the fields to be 1-based
-        r.resource -> '$.columns_field_name' ->> i AS field_name,
-        r.resource -> '$.columns_datatype' ->> i AS data_type,
-        r.resource -> '$.columns_name' ->> i AS [name],
-        r.resource -> '$.columns_description' ->> i AS [description]
+        r.resource -> '$.resource.columns_field_name' ->> i AS field_name,
+        r.resource -> '$.resource.columns_datatype' ->> i AS data_type,
+        r.resource -> '$.resource.columns_name' ->> i AS [name],
+        r.resource -> '$.resource.columns_description' ->> i AS [description]
     FROM
-        resource as r -- this contains the resource blobs as shredded from the catalog blob for a domain
+        resource_json as r -- this contains the resource blobs as shredded from the catalog blob for a domain
         JOIN nums ON (
             -- note the < .. nums is zero-based
-            nums.i < json_array_length(r.resource, '$.columns_name')
+            nums.i < json_array_length(r.resource, '$.resource.columns_name')
         )
     where
-        json_array_length(r.resource, '$.columns_name') <> 0 -- want to pick out the resources that have column
+        json_array_length(r.resource, '$.resource.columns_name') <> 0 -- want to pick out the resources that have column
         -- we might be able to use $.lens_view_type = 'tabular'
 )
 INSERT INTO
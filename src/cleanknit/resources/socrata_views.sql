@@ -1,3 +1,6 @@
+-- The views expect socrata.resource to hold the JSON itself. A rule4 database written by
+-- cleanknit keeps only the sha1 of it there (see cleanknit/socrata/payload.py), so copy the
+-- resource and metadata columns of its resource_json view across rather than the table.
 USE [tgrid4all]
 GO
     /****** Object:  Schema [city_of_newyork_us]    Script Date: 12/22/2021 10:11:13 PM ******/
@@ -10,7 +13,8 @@ GO
 SET ANSI_NULLS ON
 GO
 SET QUOTED_IDENTIFIER ON
-GO CREATE VIEW [socrata].[resource_category] AS
+GO
+CREATE VIEW [socrata].[resource_category] AS
 select r.resource_id,
     CAST(j.[key] as smallint) as category_ordinal,
     CAST(j.[value] as varchar(max)) as category
@@ -21,7 +25,8 @@ GO
 SET ANSI_NULLS ON
 GO
 SET QUOTED_IDENTIFIER ON
-GO CREATE VIEW [socrata].[resource_cooked] AS -- extract out some of the commonly populated and perhaps frequently accessed fields from the resource
+GO
+CREATE VIEW [socrata].[resource_cooked] AS -- extract out some of the commonly populated and perhaps frequently accessed fields from the resource
 select r.domain,
     r.resource_id,
     r.permalink,
@@ -61,7 +66,8 @@ GO
 SET ANSI_NULLS ON
 GO
 SET QUOTED_IDENTIFIER ON
-GO CREATE VIEW [socrata].[resource_domain_tag] AS
+GO
+CREATE VIEW [socrata].[resource_domain_tag] AS
 select r.resource_id,
     CAST(j.[key] as smallint) as domain_tag_ordinal,
     CAST(j.[value] as varchar(max)) as domain_tag
@@ -72,7 +78,8 @@ GO
 SET ANSI_NULLS ON
 GO
 SET QUOTED_IDENTIFIER ON
-GO CREATE VIEW [socrata].[resource_page_view] AS
+GO
+CREATE VIEW [socrata].[resource_page_view] AS
 select r.domain,
     r.resource_id,
     u.[updated_at],
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import time
+
+from sqlalchemy import Column, MetaData, String, Table, Text, sql
+
+from .model import (
+    log,
+    payload,
+    resource,
+    resource_column,
+    resource_cooked,
+    resource_category,
+    resource_domain_tag,
+    resource_page_view,
+)
+from .payload import encode, payload_json, register_functions
+
+# The catalog files for the big domains are tens of megabytes of JSON and the whole
+# of Socrata is ~157k resources. Rather than json.loads() each file in one go, we walk
+# the top-level object with the stdlib decoder and hand back the elements of
+# $.results one at a time so that only a single result object is ever materialized.
+# xref https://docs.python.org/3/library/json.html#json.JSONDecoder.raw_decode
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+
+class _Scanner:
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # discard what we have already consumed so the buffer stays bounded
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of JSON input")
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError(
+                "expected %r at offset %d, got %r" % (ch, self.pos, self.buf[self.pos])
+            )
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self._fill():
+                    raise
+                continue
+            # a scalar that runs to the end of the buffer may have been cut short
+            # (e.g. 12 out of 1234) so only trust it if there is something after it
+            if end < len(self.buf) or self.eof:
+                self.pos = end
+                return obj
+            if not self._fill():
+                self.pos = end
+                return obj
+
+
+def iter_catalog_results(fp, envelope=None, chunk_size=1 << 16):
+    """
+    yield the elements of $.results from a Socrata catalog response one at a time.
+    Any other top-level members (resultSetSize, timings) are put into envelope if given."""
+    s = _Scanner(fp, chunk_size)
+    s.expect("{")
+    if s.peek() == "}":
+        return
+    while True:
+        key = s.value()
+        s.expect(":")
+        if key == "results":
+            s.expect("[")
+            if s.peek() == "]":
+                s.pos += 1
+            else:
+                while True:
+                    yield s.value()
+                    if s.peek() == ",":
+                        s.pos += 1
+                        continue
+                    s.expect("]")
+                    break
+        else:
+            v = s.value()
+            if envelope is not None:
+                envelope[key] = v
+        if s.peek() == ",":
+            s.pos += 1
+            continue
+        s.expect("}")
+        break
+
+
+# These are the fields that resource_page_view in socrata_views.sql pulls out. They
+# change every time anyone looks at a dataset so they bust any checksum taken over the
+# whole result object (as upsert_socrata_resource.sql found out).
+_volatile_resource_keys = ("page_views",)
+
+
+def fingerprint_resource(r):
+    """
+    sha1 over a canonical serialization of the result object with the volatile keys removed"""
+    res = r.get("resource", {})
+    if any(k in res for k in _volatile_resource_keys):
+        res = dict((k, v) for k, v in res.items() if k not in _volatile_resource_keys)
+        r = dict(r, resource=res)
+    canonical = json.dumps(r, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def shred_resource(r):
+    return dict(
+        resource_id=r["resource"]["id"],
+        domain=r["metadata"]["domain"],
+        name=r["resource"]["name"],
+        metadata=r["metadata"],
+        permalink=r["permalink"],
+        resource=r,
+        fingerprint=fingerprint_resource(r),
+    )
+
+
+_resource_cols = list([c.name for c in resource.columns])
+_rc_cols = list([c.name for c in resource_column.columns])
+
+
+def _resource_column_tuples(r):
+    res = r["resource"]
+    if not "columns_field_name" in res:
+        log.debug(
+            "no columns_field_name",
+            domain=r["metadata"]["domain"],
+            resource_id=res["id"],
+            name=res["name"],
+        )
+        return []
+
+    number_of_columns = len(res["columns_field_name"])
+    if number_of_columns == 0:
+        log.debug(
+            "zero columns",
+            domain=r["metadata"]["domain"],
+            resource_id=res["id"],
+            name=res["name"],
+        )
+        return []
+
+    return list(
+        zip(
+            (res["id"],) * number_of_columns,
+            range(1, number_of_columns + 1),
+            res["columns_field_name"],
+            res["columns_datatype"],
+            res["columns_name"],
+            res["columns_description"],
+        )
+    )
+
+
+def shred_resource_columns(r):
+    """
+    zip the columns_* arrays of a result object into resource_column rows"""
+    return [dict(zip(_rc_cols, t)) for t in _resource_column_tuples(r)]
+
+
+def catalog_envelope(catalog):
+    """
+    the members of a decoded catalog other than results (resultSetSize, timings), which is
+    what domain._resources keeps"""
+    return dict((k, v) for k, v in catalog.items() if k != "results")
+
+
+def iter_catalog_rows(fp, envelope=None):
+    """
+    yield (resource_row, [resource_column_row, ...]) for each result in a catalog file"""
+    for r in iter_catalog_results(fp, envelope=envelope):
+        yield shred_resource(r), shred_resource_columns(r)
+
+
+def shred_catalog_file(domain_name, path):
+    """
+    decode and shred one domain catalog file into compact row tuples (in table column
+    order) with the JSON payloads already serialized and replaced by their hashes. This is the
+    unit of work handed out to worker processes by the parallel loader so it has to be a
+    picklable top-level function. Returns a dict with the rows, the payloads by hash and the
+    time spent in each stage."""
+    t0 = time.perf_counter()
+    try:
+        with open(path, "r") as fp:
+            catalog = json.load(fp)
+    except (OSError, ValueError) as e:
+        return dict(domain=domain_name, error=str(e))
+    t1 = time.perf_counter()
+
+    envelope = catalog_envelope(catalog)
+    resources, columns, payloads = [], [], {}
+    try:
+        for r in catalog["results"]:
+            row = shred_resource(r)
+            for c in ("metadata", "resource"):
+                h, text = encode(row[c])
+                payloads.setdefault(h, text)
+                row[c] = h
+            resources.append(tuple(row[c] for c in _resource_cols))
+            columns.extend(_resource_column_tuples(r))
+    except KeyError as e:
+        return dict(domain=domain_name, error="missing key %s" % e)
+    t2 = time.perf_counter()
+
+    h, text = encode(envelope)
+    payloads.setdefault(h, text)
+    return dict(
+        domain=domain_name,
+        envelope=h,
+        resources=resources,
+        resource_columns=columns,
+        payloads=payloads,
+        decode_seconds=t1 - t0,
+        shred_seconds=t2 - t1,
+    )
+
+
+# Set-based shred of the resource JSON into resource_cooked and friends (the equivalent of the
+# OPENJSON views in socrata_views.sql). Run over everything after a full load or over just
+# the resources that changed after a refresh.
+_cooked_paths = [
+    ("name", "$.resource.name"),
+    ("description", "$.resource.description"),
+    ("attribution", "$.resource.attribution"),
+    ("attribution_link", "$.resource.attribution_link"),
+    ("type", "$.resource.type"),
+    ("lens_view_type", "$.resource.lens_view_type"),
+    ("lens_display_type", "$.resource.lens_display_type"),
+    ("blob_mime_type", "$.resource.blob_mime_type"),
+    ("updated_at", "$.resource.updatedAt"),
+    ("created_at", "$.resource.createdAt"),
+    ("metadata_updated_at", "$.resource.metadata_updated_at"),
+    ("data_updated_at", "$.resource.data_updated_at"),
+    ("publication_date", "$.resource.publication_date"),
+]
+_page_view_paths = [
+    ("page_views_last_week", "$.resource.page_views.page_views_last_week"),
+    ("page_views_last_month", "$.resource.page_views.page_views_last_month"),
+    ("page_views_total", "$.resource.page_views.page_views_total"),
+]
+
+
+cooked_tables = (resource_cooked, resource_page_view, resource_category, resource_domain_tag)
+
+
+# resource.resource is the hash of the result object in payload (see payload.py). Each of
+# the cooked tables reads every result object so they are decompressed just the once, into
+# a temporary table that the selects below read from
+_cook_source = Table(
+    "cook_source",
+    MetaData(),
+    Column("resource_id", String(9), primary_key=True),
+    Column("domain", Text),
+    Column("permalink", Text),
+    Column("json", Text),
+    prefixes=["TEMPORARY"],
+)
+
+
+def _json_extract(path, type_):
+    e = sql.func.json_extract(_cook_source.c.json, path)
+    # e.g. 2021-12-22T22:11:13.000Z -> 2021-12-22 22:11:13 which is what DateTime reads back
+    return sql.func.datetime(e) if type_ == "DateTime" else e
+
+
+def _cooked_selects():
+    yield resource_cooked, sql.select(
+        _cook_source.c.resource_id,
+        _cook_source.c.domain,
+        _cook_source.c.permalink,
+        *[
+            _json_extract(path, type(resource_cooked.c[col].type).__name__).label(col)
+            for col, path in _cooked_paths
+        ],
+    )
+    yield resource_page_view, sql.select(
+        _cook_source.c.resource_id,
+        *[_json_extract(path, None).label(col) for col, path in _page_view_paths],
+    )
+    for table, path in (
+        (resource_category, "$.classification.categories"),
+        (resource_domain_tag, "$.classification.domain_tags"),
+    ):
+        j = sql.func.json_each(_cook_source.c.json, path).table_valued("key", "value")
+        yield table, sql.select(_cook_source.c.resource_id, j.c.key, j.c.value).select_from(
+            _cook_source.join(j, sql.true())
+        )
+
+
+def cook_resources(S, resource_ids=None):
+    """
+    (re)populate resource_cooked, resource_page_view, resource_category and
+    resource_domain_tag from resource.resource, either for everything or for the given
+    resource_ids. Runs in the caller's transaction."""
+    conn = S.connection()
+    register_functions(conn.connection)
+    source = sql.select(
+        resource.c.resource_id, resource.c.domain, resource.c.permalink, payload_json()
+    ).select_from(resource.join(payload, payload.c.hash == resource.c.resource))
+    if resource_ids is not None:
+        source = source.where(resource.c.resource_id.in_(resource_ids))
+    _cook_source.drop(conn, checkfirst=True)
+    _cook_source.create(conn)
+    S.execute(_cook_source.insert().from_select([c.name for c in _cook_source.columns], source))
+    for table, select in _cooked_selects():
+        delete = table.delete()
+        if resource_ids is not None:
+            delete = delete.where(table.c.resource_id.in_(resource_ids))
+        S.execute(delete)
+        S.execute(table.insert().from_select([c.name for c in table.columns], select))
+    _cook_source.drop(conn)
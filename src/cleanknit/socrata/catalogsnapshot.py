@@ -0,0 +1,416 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+# A read-only snapshot of the rule4 catalog (domains, resources and their columns) for the
+# tools that only need "the columns of resource X" or "the resources of domain Y" and would
+# otherwise go through the ORM (Domain.resources, Resource.columns, lazily loaded one resource
+# at a time and carrying the JSON payloads) or at least a round-trip to SQLite. It is written
+# after each ingest to a single file which is memory-mapped: opening it reads the header and
+# nothing else, and the pages are shared by every process that has it open.
+#
+# The file is
+#   b"CKCATLG1", the length of the header as a little-endian uint32, the header (JSON), then
+#   the sections, each an array of native uint32 (int32 for field_number) 8-byte aligned.
+# Every string (domain, resource id, name, description, data type, ...) is stored once in a
+# string pool sorted by code point (UTF-8 byte order is the same) and referred to by its
+# number, so comparing numbers compares the strings. The records are parallel arrays:
+#   domain_*       sorted by name, with the range of the domain's resources
+#   resource_*     sorted by (domain, resource_id), with the range of the resource's columns
+#   column_*       in field_number order within each resource
+#   resource_id_*  the resource id strings sorted, with the position of each resource
+# Strings are decoded (and interned) on first use and the records handed out are __slots__
+# objects. Only the standard library is imported up front so that the lightweight soc
+# subcommands can use it (see cleanknit.bench.startup).
+#
+#   write_catalog_snapshot(S, "rule4.catalog")
+#   with CatalogSnapshot("rule4.catalog") as catalog:
+#       catalog.resource("erm2-nwe9").columns()
+#       catalog.resources("data.cityofnewyork.us")
+#       catalog.as_sa_table("erm2-nwe9", MetaData())
+# xref https://docs.python.org/3/library/mmap.html
+# xref https://docs.python.org/3/library/stdtypes.html#memoryview.cast
+
+magic = b"CKCATLG1"
+version = 1
+# the pool number of a NULL
+null = 0xFFFFFFFF
+
+_resource_fields = (
+    "resource_id",
+    "domain",
+    "name",
+    "description",
+    "attribution",
+    "type",
+    "lens_view_type",
+    "permalink",
+    "updated_at",
+    "data_updated_at",
+)
+_column_fields = ("field_number", "field_name", "name", "data_type", "description")
+
+
+def catalog_snapshot_path(database):
+    """
+    where the snapshot of a rule4 database file goes: rule4.db -> rule4.catalog"""
+    return os.path.splitext(database)[0] + ".catalog"
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _sources(database):
+    """
+    the size and mtime of the database file, and the size of its -wal (which is truncated by
+    the checkpoint before a snapshot is written)"""
+    if not database:
+        return None
+    try:
+        st = os.stat(database)
+    except OSError:
+        return None
+    try:
+        wal = os.path.getsize(database + "-wal")
+    except OSError:
+        wal = 0
+    return dict(database=os.path.realpath(database), stat=[st.st_size, st.st_mtime_ns], wal=wal)
+
+
+def _text(value):
+    if value is None:
+        return None
+    return value if isinstance(value, str) else value.isoformat()
+
+
+def _catalog_rows(S):
+    # the model (and SQLAlchemy) only when writing
+    from sqlalchemy import sql
+
+    from .model import resource, resource_column, resource_cooked
+
+    cooked = resource_cooked.c
+    resources = S.execute(
+        sql.select(
+            resource.c.resource_id,
+            resource.c.domain,
+            resource.c.name,
+            cooked.description,
+            cooked.attribution,
+            cooked.type,
+            cooked.lens_view_type,
+            resource.c.permalink,
+            cooked.updated_at,
+            cooked.data_updated_at,
+        )
+        .select_from(resource.outerjoin(resource_cooked))
+        .where(resource.c.domain.isnot(None))
+        .order_by(resource.c.domain, resource.c.resource_id)
+    ).fetchall()
+    columns = {}
+    for r in S.execute(
+        sql.select(
+            resource_column.c.resource_id,
+            resource_column.c.field_number,
+            resource_column.c.field_name,
+            resource_column.c.name,
+            resource_column.c.data_type,
+            resource_column.c.description,
+        ).order_by(resource_column.c.resource_id, resource_column.c.field_number)
+    ):
+        columns.setdefault(r[0], []).append(tuple(r[1:]))
+    return [tuple(_text(v) for v in r) for r in resources], columns
+
+
+def write_catalog_snapshot(S, path, database=None):
+    """
+    write the snapshot of the rule4 catalog attached to S (as socrata) to path, replacing
+    any snapshot there atomically. database is the rule4 file, for is_stale.
+    Returns the number of resources"""
+    from .model import log
+
+    t0 = time.perf_counter()
+    if database is not None:
+        # so that closing the last connection does not then change the file under the snapshot
+        S.commit()
+        S.connection().exec_driver_sql("PRAGMA socrata.wal_checkpoint(TRUNCATE)")
+    resources, columns = _catalog_rows(S)
+    S.rollback()
+
+    strings = set()
+    for r in resources:
+        strings.update(r)
+    for cols in columns.values():
+        for c in cols:
+            strings.update(c[1:])
+    strings.discard(None)
+    pool = sorted(strings)
+    number = dict((s, i) for i, s in enumerate(pool))
+    number[None] = null
+
+    sections = {}
+    data = [s.encode("utf-8") for s in pool]
+    offsets = array("I", [0])
+    for b in data:
+        offsets.append(offsets[-1] + len(b))
+    sections["string_offset"] = offsets
+    sections["string_data"] = array("B", b"".join(data))
+
+    domain_name, domain_first, domain_count = array("I"), array("I"), array("I")
+    fields = dict((f, array("I")) for f in _resource_fields)
+    resource_first, resource_count = array("I"), array("I")
+    column_fields = dict((f, array("i" if f == "field_number" else "I")) for f in _column_fields)
+    for i, r in enumerate(resources):
+        if not domain_name or pool[domain_name[-1]] != r[1]:
+            domain_name.append(number[r[1]])
+            domain_first.append(i)
+            domain_count.append(0)
+        domain_count[-1] += 1
+        for f, v in zip(_resource_fields, r):
+            fields[f].append(number[v])
+        cols = columns.get(r[0], ())
+        resource_first.append(len(column_fields["field_number"]))
+        resource_count.append(len(cols))
+        for c in cols:
+            column_fields["field_number"].append(c[0])
+            for f, v in zip(_column_fields[1:], c[1:]):
+                column_fields[f].append(number[v])
+    order = sorted(range(len(resources)), key=lambda i: fields["resource_id"][i])
+
+    sections.update(domain_name=domain_name, domain_first=domain_first, domain_count=domain_count)
+    sections.update(("resource_" + f, a) for f, a in fields.items())
+    sections.update(resource_first=resource_first, resource_count=resource_count)
+    sections.update(("column_" + f, a) for f, a in column_fields.items())
+    sections["resource_id_string"] = array("I", [fields["resource_id"][i] for i in order])
+    sections["resource_id_position"] = array("I", order)
+
+    toc, offset = {}, 0
+    for name, a in sections.items():
+        toc[name] = [offset, a.typecode, len(a)]
+        offset = _align(offset + len(a) * a.itemsize)
+    header = json.dumps(
+        dict(
+            version=version,
+            byteorder=sys.byteorder,
+            sources=_sources(database),
+            strings=len(pool),
+            domains=len(domain_name),
+            resources=len(resources),
+            columns=len(column_fields["field_number"]),
+            sections=toc,
+        )
+    ).encode("utf-8")
+    start = _align(len(magic) + 4 + len(header))
+
+    tmp = "%s.tmp-%d" % (path, os.getpid())
+    with open(tmp, "wb") as fp:
+        fp.write(magic + struct.pack("<I", len(header)) + header)
+        for name, a in sections.items():
+            fp.write(b"\0" * (start + toc[name][0] - fp.tell()))
+            a.tofile(fp)
+    os.replace(tmp, path)
+    log.info(
+        "Done writing catalog snapshot",
+        path=path,
+        resources=len(resources),
+        columns=len(column_fields["field_number"]),
+        strings=len(pool),
+        size=os.path.getsize(path),
+        seconds=round(time.perf_counter() - t0, 3),
+    )
+    return len(resources)
+
+
+class ColumnRecord:
+    __slots__ = _column_fields
+
+    def as_sa_column(self):
+        from .model import sa_column_for
+
+        return sa_column_for(self.field_name, self.data_type, self.description)
+
+    def __repr__(self):
+        return "ColumnRecord(%d, %r, %r)" % (self.field_number, self.field_name, self.data_type)
+
+
+class ResourceRecord:
+    __slots__ = _resource_fields + ("_catalog", "_position")
+
+    def columns(self):
+        return self._catalog._columns(self._position)
+
+    def as_sa_table(self, metadata, schema=None):
+        """
+        the same Table as Resource.as_sa_table"""
+        from sqlalchemy import Table
+
+        t = Table(self.resource_id, metadata, schema=schema)
+        for c in self.columns():
+            t.append_column(c.as_sa_column())
+        return t
+
+    def __repr__(self):
+        return "ResourceRecord(%r, %r, %r)" % (self.resource_id, self.domain, self.name)
+
+
+class CatalogSnapshot:
+    """
+    a snapshot written by write_catalog_snapshot, memory-mapped. Use as a context manager or
+    close it, as the mapping stays open while any of the arrays are referenced"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        try:
+            if self._buffer[: len(magic)] != magic:
+                raise ValueError("not a catalog snapshot: %s" % path)
+            (n,) = struct.unpack_from("<I", self._buffer, len(magic))
+            header = json.loads(bytes(self._buffer[len(magic) + 4 : len(magic) + 4 + n]))
+            if header["version"] != version or header["byteorder"] != sys.byteorder:
+                raise ValueError("catalog snapshot from another version or machine: %s" % path)
+        except:
+            self.close()
+            raise
+        self.header = header
+        start = _align(len(magic) + 4 + n)
+        self._arrays = {}
+        for name, (offset, typecode, length) in header["sections"].items():
+            size = array(typecode).itemsize
+            b = self._buffer[start + offset : start + offset + length * size]
+            self._arrays[name] = b.cast(typecode)
+        self._offsets = self._arrays["string_offset"]
+        # the strings are sliced out of the mmap itself, which gives bytes in one copy
+        self._data = start + header["sections"]["string_data"][0]
+        self._strings = {}
+
+    def close(self):
+        for a in getattr(self, "_arrays", {}).values():
+            a.release()
+        self._arrays = {}
+        self._buffer.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.header["resources"]
+
+    def __contains__(self, resource_id):
+        return self._position(resource_id) is not None
+
+    def is_stale(self):
+        """
+        whether the rule4 file has changed since the snapshot was written, from the file
+        system alone. Always False if the snapshot wasn't written with its database"""
+        sources = self.header["sources"]
+        if sources is None:
+            return False
+        return _sources(sources["database"]) != sources
+
+    def _string(self, i):
+        if i == null:
+            return None
+        s = self._strings.get(i, None)
+        if s is None:
+            b = self._mmap[self._data + self._offsets[i] : self._data + self._offsets[i + 1]]
+            s = self._strings[i] = sys.intern(b.decode("utf-8"))
+        return s
+
+    def _number(self, s):
+        """
+        the pool number of a string, or None if it isn't in the pool"""
+        b = s.encode("utf-8")
+        m, data, offsets = self._mmap, self._data, self._offsets
+        lo, hi = 0, len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if m[data + offsets[mid] : data + offsets[mid + 1]] < b:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._offsets) - 1 and self._string(lo) == s:
+            return lo
+        return None
+
+    def _position(self, resource_id):
+        i = self._number(resource_id)
+        if i is None:
+            return None
+        index = self._arrays["resource_id_string"]
+        j = bisect_left(index, i)
+        if j < len(index) and index[j] == i:
+            return self._arrays["resource_id_position"][j]
+        return None
+
+    def _resource(self, position):
+        r = ResourceRecord()
+        for f in _resource_fields:
+            setattr(r, f, self._string(self._arrays["resource_" + f][position]))
+        r._catalog, r._position = self, position
+        return r
+
+    def _columns(self, position):
+        a, string = self._arrays, self._string
+        field_name, name = a["column_field_name"], a["column_name"]
+        data_type, description = a["column_data_type"], a["column_description"]
+        first = a["resource_first"][position]
+        out = []
+        for i in range(first, first + a["resource_count"][position]):
+            c = ColumnRecord()
+            c.field_number = a["column_field_number"][i]
+            c.field_name = string(field_name[i])
+            c.name = string(name[i])
+            c.data_type = string(data_type[i])
+            c.description = string(description[i])
+            out.append(c)
+        return out
+
+    def domains(self):
+        return [self._string(i) for i in self._arrays["domain_name"]]
+
+    def resource(self, resource_id):
+        """
+        the ResourceRecord, or None if there is no such resource"""
+        position = self._position(resource_id)
+        return None if position is None else self._resource(position)
+
+    def resources(self, domain=None):
+        """
+        the ResourceRecords of a domain (or all of them) in resource_id order"""
+        if domain is None:
+            positions = range(len(self))
+        else:
+            i = self._number(domain)
+            names = self._arrays["domain_name"]
+            j = bisect_left(names, i) if i is not None else len(names)
+            if j == len(names) or names[j] != i:
+                return []
+            first = self._arrays["domain_first"][j]
+            positions = range(first, first + self._arrays["domain_count"][j])
+        return [self._resource(p) for p in positions]
+
+    def columns(self, resource_id):
+        """
+        the ColumnRecords of a resource in field_number order"""
+        position = self._position(resource_id)
+        if position is None:
+            raise KeyError("unknown resource %s" % resource_id)
+        return self._columns(position)
+
+    def as_sa_table(self, resource_id, metadata, schema=None):
+        r = self.resource(resource_id)
+        if r is None:
+            raise KeyError("unknown resource %s" % resource_id)
+        return r.as_sa_table(metadata, schema)
@@ -0,0 +1,336 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy import sql
+
+from ..files import file_hash
+from ..instrument import stage
+from ..querycache import invalidate_session
+from .model import log, resource_column
+
+# Column descriptions from the PDF data dictionaries attached to resources (PLUTO's
+# pluto_datadictionary.pdf and friends) for when resource_column.description is empty, which
+# it very often is. Each document goes
+#   PDF -(pdftohtml -xml)-> pdf2xml XML -(iterparse)-> text boxes -> lines -> entries
+# and the entries (term, description, page) are then matched to the resource's columns by
+# field name or display name. The XML is read with iterparse a page at a time so a 500 page
+# dictionary never sits in memory. The text boxes are the rows textbox.xsl produces; with
+# stylesheets=True the TSVs of textbox.xsl, fontspec.xsl and pagespec.xsl are also written
+# next to the XML (with xsltproc) for poking at with the vsv virtual table.
+#
+# The extraction is pure CPU per document so the documents are spread over a process pool.
+# The entries are cached as JSON under the SHA-256 of the document so a re-run over hundreds of
+# attachments only converts the ones that are new or have changed.
+# xref https://www.mankier.com/1/pdftohtml
+# xref https://docs.python.org/3/library/xml.etree.elementtree.html#xml.etree.ElementTree.iterparse
+
+# bump when the extraction changes so that the cached entries are redone
+extractor_version = 1
+
+_resources = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
+_stylesheets = ("textbox.xsl", "fontspec.xsl", "pagespec.xsl")
+
+# e.g. "Field Name: BOROUGH (Borough)", "Description: The borough ..."
+_label = re.compile(r"^\s*([A-Z][A-Za-z /]{1,30}):\s*(.*)$")
+_term_labels = ("field name", "column name", "field", "column", "attribute", "name")
+_description_labels = ("description", "definition", "meaning")
+_parenthetical = re.compile(r"^(.*?)\s*\((.*)\)\s*$")
+
+
+def pdf_to_xml(pdf_path, xml_path):
+    """
+    convert with poppler's pdftohtml, headless, ignoring the images"""
+    with open(xml_path, "wb") as fp:
+        subprocess.run(
+            ["pdftohtml", "-xml", "-i", "-q", "-nodrm", "-stdout", pdf_path],
+            stdout=fp,
+            check=True,
+        )
+    return xml_path
+
+
+def apply_stylesheets(xml_path, directory):
+    """
+    write <stylesheet>.tsv for each of the stylesheets with xsltproc. Returns the paths"""
+    paths = []
+    for name in _stylesheets:
+        path = os.path.join(directory, os.path.splitext(name)[0] + ".tsv")
+        with open(path, "wb") as fp:
+            subprocess.run(
+                ["xsltproc", "--novalid", os.path.join(_resources, name), xml_path],
+                stdout=fp,
+                check=True,
+            )
+        paths.append(path)
+    return paths
+
+
+def text_boxes(xml_path):
+    """
+    the rows of textbox.xsl (page_number, top, left, width, height, font, payload) streamed
+    from pdf2xml XML, plus whether the box is bold"""
+    bold_fonts = set()
+    page_number = None
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "page":
+                page_number = int(elem.get("number"))
+            continue
+        if elem.tag == "fontspec":
+            if "bold" in elem.get("family", "").lower():
+                bold_fonts.add(elem.get("id"))
+        elif elem.tag == "text":
+            payload = " ".join("".join(elem.itertext()).split())
+            if payload:
+                bold = elem.find("b") is not None or elem.get("font") in bold_fonts
+                yield (
+                    page_number,
+                    int(float(elem.get("top"))),
+                    int(float(elem.get("left"))),
+                    int(float(elem.get("width"))),
+                    int(float(elem.get("height"))),
+                    elem.get("font"),
+                    payload,
+                    bold,
+                )
+        elif elem.tag == "page":
+            # everything on the page has been seen, let it go
+            elem.clear()
+
+
+def lines(boxes, tolerance=3):
+    """
+    group the text boxes of each page into lines, top to bottom and left to right. Boxes
+    whose tops are within tolerance points are on the same line"""
+    page, current = None, []
+
+    def flush():
+        current.sort(key=lambda b: (b[1], b[2]))
+        line = []
+        for b in current:
+            if line and b[1] - line[0][1] > tolerance:
+                yield page, sorted(line, key=lambda b: b[2])
+                line = []
+            line.append(b)
+        if line:
+            yield page, sorted(line, key=lambda b: b[2])
+
+    for b in boxes:
+        if b[0] != page:
+            yield from flush()
+            page, current = b[0], []
+        current.append(b)
+    yield from flush()
+
+
+def entries(xml_path, max_term_words=6):
+    """
+    the (term, description, page) entries of a data dictionary. Both of the common layouts
+    are recognized:
+     * labelled, "Field Name: X" followed by "Description: ..." (PLUTO)
+     * tabular, the term in the first cell (or in bold) and the description after it
+    Lines that follow an entry and are indented past its term continue the description"""
+    out = []
+    entry = None
+    for page, line in lines(text_boxes(xml_path)):
+        first = line[0]
+        text = " ".join(b[6] for b in line)
+        m = _label.match(text)
+        label = m.group(1).strip().lower() if m else None
+        labelled = entry is not None and entry["labelled"]
+        if label in _term_labels:
+            entry = dict(term=m.group(2).strip(), description=[], page=page, labelled=True)
+            entry["collecting"] = False
+            out.append(entry)
+        elif labelled and label in _description_labels:
+            entry["description"].append(m.group(2).strip())
+            entry["collecting"] = True
+        elif labelled and label is not None:
+            # Format:, Data Source: and so on
+            entry["collecting"] = False
+        elif labelled and entry["collecting"]:
+            entry["description"].append(text)
+        elif labelled:
+            continue
+        elif (len(line) > 1 or first[7]) and len(first[6].split()) <= max_term_words:
+            entry = dict(
+                term=first[6],
+                description=[b[6] for b in line[1:]],
+                page=page,
+                labelled=False,
+                collecting=True,
+                left=line[1][2] if len(line) > 1 else first[2] + 1,
+            )
+            out.append(entry)
+        elif entry is not None and first[2] >= entry["left"] - 3:
+            entry["description"].append(text)
+        else:
+            entry = None
+    return [
+        (e["term"], " ".join(e["description"]).strip(), e["page"])
+        for e in out
+        if e["description"]
+    ]
+
+
+def extract_document(path, stylesheets=False):
+    """
+    the entries of one document, a PDF or already converted pdf2xml XML. Run in the workers"""
+    t0 = time.perf_counter()
+    directory = tempfile.mkdtemp(prefix="datadictionary-")
+    try:
+        if path.lower().endswith(".xml"):
+            xml_path = path
+        else:
+            xml_path = pdf_to_xml(path, os.path.join(directory, "document.xml"))
+        if stylesheets:
+            # kept next to the document
+            tsv_directory = os.path.splitext(path)[0] + ".tsv.d"
+            os.makedirs(tsv_directory, exist_ok=True)
+            apply_stylesheets(xml_path, tsv_directory)
+        return dict(path=path, entries=entries(xml_path), seconds=time.perf_counter() - t0)
+    except Exception as e:
+        return dict(path=path, error=repr(e))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _cache_path(cache_dir, digest):
+    return os.path.join(cache_dir, "%s.json" % digest)
+
+
+def extract_documents(paths, cache_dir, max_workers=None, stylesheets=False):
+    """
+    {path: entries} for the documents, from the cache where the document has been seen
+    before and otherwise extracted on a process pool and cached"""
+    os.makedirs(cache_dir, exist_ok=True)
+    results, todo = {}, {}
+    with stage("hash", rows=len(paths)):
+        for path in paths:
+            digest = file_hash(path)
+            try:
+                with open(_cache_path(cache_dir, digest)) as fp:
+                    cached = json.load(fp)
+                if cached["extractor_version"] == extractor_version:
+                    results[path] = [tuple(e) for e in cached["entries"]]
+                    continue
+            except (OSError, ValueError, KeyError):
+                pass
+            todo[path] = digest
+
+    with stage("extract", rows=len(todo)), ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(extract_document, path, stylesheets) for path in todo]
+        for f in as_completed(futures):
+            r = f.result()
+            if "error" in r:
+                log.error("problem extracting data dictionary", path=r["path"], error=r["error"])
+                continue
+            results[r["path"]] = r["entries"]
+            # written to the side and renamed so that a concurrent run never reads half a file
+            path = _cache_path(cache_dir, todo[r["path"]])
+            with open(path + ".tmp-%d" % os.getpid(), "w") as fp:
+                json.dump(
+                    dict(
+                        extractor_version=extractor_version, path=r["path"], entries=r["entries"]
+                    ),
+                    fp,
+                )
+            os.replace(path + ".tmp-%d" % os.getpid(), path)
+            log.info(
+                "Done extracting data dictionary",
+                path=r["path"],
+                entries=len(r["entries"]),
+                seconds=round(r["seconds"], 3),
+            )
+    log.info("Done extracting data dictionaries", documents=len(paths), extracted=len(todo))
+    return results
+
+
+def _normalize(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+def _term_keys(term):
+    """
+    the names a term might go by: "BOROUGH (Borough)" is both BOROUGH and Borough"""
+    keys = [term]
+    m = _parenthetical.match(term)
+    if m:
+        keys.extend(m.groups())
+    return [_normalize(k) for k in keys if k.strip()]
+
+
+def match_columns(columns, entries):
+    """
+    [(field_number, description)] for the columns (field_number, field_name, name) that
+    an entry matches. The first entry for a column wins as the later ones tend to be
+    cross-references"""
+    by_name = {}
+    for field_number, field_name, name in columns:
+        for n in (field_name, name):
+            if n:
+                by_name.setdefault(_normalize(n), field_number)
+    found = {}
+    for term, description, page in entries:
+        for key in _term_keys(term):
+            field_number = by_name.get(key, None)
+            if field_number is not None:
+                found.setdefault(field_number, description)
+                break
+    return sorted(found.items())
+
+
+_columns_q = sql.select(
+    resource_column.c.field_number,
+    resource_column.c.field_name,
+    resource_column.c.name,
+    resource_column.c.description,
+).where(resource_column.c.resource_id == sql.bindparam("resource_id"))
+
+
+def apply_data_dictionaries(
+    S, documents, cache_dir, max_workers=None, overwrite=False, stylesheets=False
+):
+    """
+    fill in resource_column.description from the data dictionaries. documents is a list of
+    (resource_id, path) as a resource can have more than one dictionary and the one
+    dictionary can serve several resources. Only empty descriptions are filled unless
+    overwrite. Returns the number of columns updated"""
+    extracted = extract_documents(
+        sorted(set(path for _, path in documents)), cache_dir, max_workers, stylesheets
+    )
+    update = (
+        resource_column.update()
+        .where(resource_column.c.resource_id == sql.bindparam("b_resource_id"))
+        .where(resource_column.c.field_number == sql.bindparam("b_field_number"))
+        .values(description=sql.bindparam("b_description"))
+    )
+    n = 0
+    for resource_id, path in documents:
+        if path not in extracted:
+            continue
+        columns = S.execute(_columns_q, dict(resource_id=resource_id)).fetchall()
+        empty = set(
+            c.field_number for c in columns if overwrite or not (c.description or "").strip()
+        )
+        params = [
+            dict(b_resource_id=resource_id, b_field_number=f, b_description=d)
+            for f, d in match_columns([c[:3] for c in columns], extracted[path])
+            if f in empty
+        ]
+        if params:
+            S.execute(update, params)
+        n += len(params)
+        log.info(
+            "Done matching data dictionary", resource_id=resource_id, path=path, columns=len(params)
+        )
+    S.commit()
+    invalidate_session(S, "socrata")
+    return n
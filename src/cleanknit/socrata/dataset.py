@@ -0,0 +1,199 @@
+import csv
+import os
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Index, sql
+from sqlalchemy.types import Integer, Date, DateTime, Text
+
+from .geometry import Geometry, to_geojson
+from .model import log, resource_column, _type_map
+from .spatial import create_spatial_index
+from ..munge import insert_tuples
+from ..querycache import invalidate_session
+
+# Load a downloaded Socrata export (<4x4>.csv or <4x4>.tsv) into a real table named after the
+# resource id. This is the pure-Python alternative to the vsv virtual tables generated by
+# socrata_vsv_map.sql: the delimited text is parsed once at load time rather than on every query.
+
+# The exports use the display name (columns_name) in the header line rather than the field
+# name so we look the columns up by either.
+_columns_q = sql.select(
+    resource_column.c.field_name,
+    resource_column.c.name,
+    resource_column.c.data_type,
+    resource_column.c.description,
+).where(resource_column.c.resource_id == sql.bindparam("resource_id"))
+
+# The dates come out of the rows.csv export as 01/15/2020 12:00:00 AM but the SODA API and
+# the JSON exports use ISO 8601 so we accept both.
+_datetime_formats = (
+    "%m/%d/%Y %I:%M:%S %p",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%m/%d/%Y",
+    "%Y-%m-%d",
+)
+
+
+def _parse_datetime(v):
+    for fmt in _datetime_formats:
+        try:
+            return datetime.strptime(v, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+# The converters produce what the SQLAlchemy SQLite types would have stored, as the rows are
+# inserted straight through the DBAPI. Anything that does not convert is kept as text which
+# SQLite is quite happy to store in any column.
+def _to_number(v):
+    # the exports can have thousands separators, e.g. 1,234
+    n = v.replace(",", "")
+    try:
+        return int(n)
+    except ValueError:
+        pass
+    try:
+        return float(n)
+    except ValueError:
+        return v
+
+
+def _to_datetime(v):
+    d = _parse_datetime(v)
+    return v if d is None else d.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _to_date(v):
+    d = _parse_datetime(v)
+    return v if d is None else d.strftime("%Y-%m-%d")
+
+
+def _to_geojson(v):
+    try:
+        return to_geojson(v)
+    except ValueError:
+        return v
+
+
+def _converter(type_):
+    if issubclass(type_, Geometry):
+        return _to_geojson
+    if issubclass(type_, Integer):
+        return _to_number
+    if issubclass(type_, DateTime):
+        return _to_datetime
+    if issubclass(type_, Date):
+        return _to_date
+    return None
+
+
+def _convert_batch(batch, converters, width):
+    """
+    column-at-a-time conversion of a batch of rows. Empty strings become NULL"""
+    columns = []
+    for i in range(width):
+        conv = converters[i]
+        values = [row[i] if i < len(row) else "" for row in batch]
+        if conv is None:
+            columns.append([v if v != "" else None for v in values])
+        else:
+            columns.append([conv(v) if v != "" else None for v in values])
+    return list(zip(*columns))
+
+
+def resource_id_from_path(path):
+    return os.path.splitext(os.path.basename(path))[0][-9:]
+
+
+def load_delimited(
+    S, path, resource_id=None, schema=None, batch_size=50000, indexes=(), spatial_index=True
+):
+    """
+    stream a downloaded CSV/TSV into a typed table named after the resource id, replacing
+    any existing table of that name. Column types come from resource_column.data_type via
+    _type_map. The load runs with journal_mode=OFF/synchronous=OFF and the indexes (each a
+    column name or a tuple of column names) are created once the rows are in, as is an
+    R*Tree for each geometry column (see spatial.py) unless spatial_index is False.
+    Returns the number of rows loaded."""
+    resource_id = resource_id or resource_id_from_path(path)
+    delimiter = "\t" if path.endswith(".tsv") else ","
+
+    socrata_columns = {}
+    for c in S.execute(_columns_q, dict(resource_id=resource_id)):
+        socrata_columns.setdefault(c.name, c)
+        socrata_columns.setdefault(c.field_name, c)
+    S.rollback()
+
+    with open(path, "r", newline="", encoding="utf-8") as fp:
+        reader = csv.reader(fp, delimiter=delimiter)
+        header = next(reader)
+
+        metadata = MetaData()
+        columns, converters, seen = [], [], set()
+        for h in header:
+            c = socrata_columns.get(h, None)
+            name = c.field_name if c is not None and c.field_name else h
+            # the headers are not guaranteed to be unique
+            base, n = name, 1
+            while name in seen:
+                n += 1
+                name = "%s_%d" % (base, n)
+            seen.add(name)
+            type_ = _type_map.get(c.data_type, Text) if c is not None else Text
+            columns.append(
+                Column(name, type_, comment=c.description if c is not None else None)
+            )
+            converters.append(_converter(type_))
+        table = Table(resource_id, metadata, *columns, schema=schema)
+
+        # pysqlite only opens a SQLite transaction in front of DML so the PRAGMAs (which
+        # can't be changed inside a transaction) are still outside the real transaction here.
+        pragma_schema = '"%s".' % schema if schema else ""
+        conn = S.connection()
+        saved = dict(
+            (p, conn.exec_driver_sql("PRAGMA %s%s" % (pragma_schema, p)).scalar())
+            for p in ("journal_mode", "synchronous")
+        )
+        conn.exec_driver_sql("PRAGMA %sjournal_mode=OFF" % pragma_schema)
+        conn.exec_driver_sql("PRAGMA %ssynchronous=OFF" % pragma_schema)
+        n_rows = 0
+        try:
+            table.drop(bind=conn, checkfirst=True)
+            table.create(bind=conn)
+            width = len(columns)
+            batch = []
+            for row in reader:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    insert_tuples(S, table, _convert_batch(batch, converters, width))
+                    n_rows += len(batch)
+                    batch = []
+            insert_tuples(S, table, _convert_batch(batch, converters, width))
+            n_rows += len(batch)
+
+            for i, cols in enumerate(indexes):
+                cols = (cols,) if isinstance(cols, str) else tuple(cols)
+                Index("ix_%s_%d" % (resource_id, i), *[table.c[c] for c in cols]).create(
+                    bind=conn
+                )
+            if spatial_index:
+                for c in columns:
+                    if isinstance(c.type, Geometry):
+                        create_spatial_index(S, resource_id, c.name, schema)
+            S.commit()
+        except:
+            # with journal_mode=OFF a rollback can't be relied on so a failed load may leave
+            # a partially loaded table behind. Re-running the load replaces it.
+            S.rollback()
+            raise
+        finally:
+            conn = S.connection()
+            for p, v in saved.items():
+                conn.exec_driver_sql("PRAGMA %s%s=%s" % (pragma_schema, p, v))
+            S.commit()
+
+    log.info("Done loading dataset", resource_id=resource_id, path=path, rows=n_rows)
+    invalidate_session(S, schema or "main")
+    return n_rows
@@ -0,0 +1,282 @@
+import hashlib
+import struct
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from itertools import combinations
+
+import numpy as np
+import pysqlite3
+from sqlalchemy import sql
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .model import log, column_signature
+from .profiling import tables_to_profile, _Worker, _quote, _sample_source
+
+# Join-key discovery across loaded datasets. For every column we keep two small sketches:
+#  * a MinHash signature, from which the Jaccard similarity of the value sets of any two
+#    columns can be estimated, and
+#  * a HyperLogLog register array, which estimates the number of distinct values.
+# Candidate pairs of joinable columns are found with locality-sensitive hashing on the MinHash
+# signatures (columns are only compared if they collide in at least one band) so we never do
+# the all-pairs comparison.
+# xref http://infolab.stanford.edu/~ullman/mmds/ch3.pdf (3.4 LSH for minhash signatures)
+# xref https://en.wikipedia.org/wiki/HyperLogLog
+
+num_perm = 128
+_mersenne_prime = (1 << 31) - 1
+_rng = np.random.RandomState(1)
+_perm_a = _rng.randint(1, _mersenne_prime, size=(num_perm, 1)).astype(np.uint64)
+_perm_b = _rng.randint(0, _mersenne_prime, size=(num_perm, 1)).astype(np.uint64)
+
+hll_precision = 12
+_hll_m = 1 << hll_precision
+
+# names that are worth flagging as keys even if they are not unique in this dataset
+# (e.g. bbl in a table of sales). borough/block/lot is the pre-bbl spelling of the same thing.
+key_name_hints = ("bbl", "bin", "borough", "boro", "block", "lot", "zip", "zipcode", "id")
+
+
+def _normalize(v):
+    # the same key can arrive as 1000010001, 1000010001.0 or '1000010001 '
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    elif isinstance(v, bytes):
+        return v
+    return str(v).strip().lower().encode("utf-8")
+
+
+def hash_values(values):
+    """
+    64-bit hashes of the normalized values"""
+    return np.fromiter(
+        (
+            struct.unpack("<Q", hashlib.blake2b(_normalize(v), digest_size=8).digest())[0]
+            for v in values
+        ),
+        dtype=np.uint64,
+    )
+
+
+def minhash(hashes, chunk_size=1 << 15):
+    sig = np.full(num_perm, _mersenne_prime, dtype=np.uint64)
+    for i in range(0, len(hashes), chunk_size):
+        x = hashes[i : i + chunk_size] & np.uint64(0xFFFFFFFF)
+        v = (_perm_a * x + _perm_b) % np.uint64(_mersenne_prime)
+        sig = np.minimum(sig, v.min(axis=1))
+    return sig.astype(np.uint32)
+
+
+def hll_registers(hashes):
+    registers = np.zeros(_hll_m, dtype=np.uint8)
+    if len(hashes) == 0:
+        return registers
+    idx = (hashes >> np.uint64(64 - hll_precision)).astype(np.int64)
+    w = hashes & np.uint64((1 << (64 - hll_precision)) - 1)
+    # rank = position of the leftmost 1 bit in the remaining 64 - p bits
+    nz = w > 0
+    rank = np.full(len(w), 64 - hll_precision + 1, dtype=np.uint8)
+    rank[nz] = (64 - hll_precision) - np.floor(np.log2(w[nz].astype(np.float64))).astype(np.uint8)
+    np.maximum.at(registers, idx, rank)
+    return registers
+
+
+def hll_estimate(registers):
+    m = float(len(registers))
+    alpha = 0.7213 / (1 + 1.079 / m)
+    e = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if e <= 2.5 * m and zeros:
+        # small range correction (linear counting)
+        e = m * np.log(m / zeros)
+    return int(round(e))
+
+
+def jaccard(a, b):
+    return float(np.count_nonzero(a == b)) / len(a)
+
+
+def _signatures(worker, table, sample, chunk_size=1 << 15):
+    c = worker.connection()
+    columns = table["columns"]
+    # one scan for all the columns, which with a sample also means the one set of rowids, with
+    # the sketches of each column merged a chunk of rows at a time (the minimum of the
+    # MinHash signatures and the maximum of the HyperLogLog registers)
+    empty = np.empty(0, dtype=np.uint64)
+    counts = [0] * len(columns)
+    signatures = [minhash(empty) for _ in columns]
+    registers = [hll_registers(empty) for _ in columns]
+    cursor = c.execute(
+        "SELECT %s FROM %s"
+        % (
+            ", ".join(_quote(column) for column in columns),
+            _sample_source(table["name"], sample, table["is_virtual"]),
+        )
+    )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for i, values in enumerate(zip(*rows)):
+            hashes = hash_values(v for v in values if v is not None)
+            counts[i] += len(hashes)
+            np.minimum(signatures[i], minhash(hashes), out=signatures[i])
+            np.maximum(registers[i], hll_registers(hashes), out=registers[i])
+    computed_at = datetime.now(timezone.utc)
+    return [
+        dict(
+            table_name=table["name"],
+            column_name=column,
+            resource_id=table["resource_id"],
+            value_count=counts[i],
+            cardinality=hll_estimate(registers[i]),
+            minhash=signatures[i].tobytes(),
+            hll=registers[i].tobytes(),
+            computed_at=computed_at,
+        )
+        for i, column in enumerate(columns)
+    ]
+
+
+def compute_signatures(
+    S, database, name_like="%", max_workers=None, sample=None, max_columns=None, extensions=()
+):
+    """
+    compute and store the column signatures for the tables in database, in the caller's
+    transaction. Same worker-pool arrangement as profiling.profile_tables. Returns the number
+    of columns signed."""
+    tables = tables_to_profile(database, name_like, max_columns, extensions)
+    ins = sqlite_insert(column_signature)
+    upsert = ins.on_conflict_do_update(
+        index_elements=[column_signature.c.table_name, column_signature.c.column_name],
+        set_=dict(
+            (c.name, ins.excluded[c.name]) for c in column_signature.columns if not c.primary_key
+        ),
+    )
+    worker = _Worker(database, extensions)
+    n = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = dict(
+                (pool.submit(_signatures, worker, t, sample), t["name"]) for t in tables
+            )
+            for f in as_completed(futures):
+                try:
+                    rows = f.result()
+                except pysqlite3.Error as e:
+                    log.error("problem signing table", table_name=futures[f], error=str(e))
+                    continue
+                if rows:
+                    S.execute(upsert, rows)
+                n += len(rows)
+    finally:
+        worker.close()
+    log.info("Done computing column signatures", tables=len(tables), columns=n)
+    return n
+
+
+def _load_signatures(S, min_cardinality):
+    q = sql.select(column_signature).where(column_signature.c.cardinality >= min_cardinality)
+    rows = S.execute(q).fetchall()
+    S.rollback()
+    return rows
+
+
+def candidate_keys(S, min_uniqueness=0.95, min_cardinality=10):
+    """
+    columns that look like keys: (nearly) every value distinct, or named like a key. The
+    default threshold leaves room for the few percent error of the HyperLogLog estimate.
+    Returns dicts sorted so the most key-like come first"""
+    keys = []
+    for r in _load_signatures(S, min_cardinality):
+        uniqueness = min(1.0, float(r.cardinality) / r.value_count) if r.value_count else 0.0
+        hinted = r.column_name.lower() in key_name_hints
+        if uniqueness >= min_uniqueness or hinted:
+            keys.append(
+                dict(
+                    table_name=r.table_name,
+                    column_name=r.column_name,
+                    uniqueness=uniqueness,
+                    cardinality=r.cardinality,
+                    name_hint=hinted,
+                )
+            )
+    keys.sort(key=lambda k: (-k["uniqueness"], not k["name_hint"], k["table_name"]))
+    return keys
+
+
+def composite_keys(S, table_name, columns, schema=None, max_width=3, min_uniqueness=0.99):
+    """
+    test the combinations of up to max_width of the given columns (e.g. borough, block, lot)
+    for uniqueness with count(DISTINCT). Only meant for a handful of columns at a time."""
+    qt = _quote(table_name) if schema is None else "%s.%s" % (_quote(schema), _quote(table_name))
+    total = S.execute("SELECT count(*) FROM %s" % qt).scalar()
+    found = []
+    for width in range(2, max_width + 1):
+        for combo in combinations(columns, width):
+            # skip supersets of combinations that are already unique
+            if any(set(f[0]) <= set(combo) for f in found):
+                continue
+            cols = ", ".join(_quote(c) for c in combo)
+            n = S.execute("SELECT count(*) FROM (SELECT DISTINCT %s FROM %s)" % (cols, qt)).scalar()
+            if total and float(n) / total >= min_uniqueness:
+                found.append((combo, float(n) / total))
+    S.rollback()
+    return found
+
+
+def join_candidates(S, bands=32, min_jaccard=0.1, min_cardinality=10, max_bucket=1000):
+    """
+    pairs of columns in different tables whose value sets overlap, found by banding the MinHash
+    signatures. Returns dicts with the estimated Jaccard similarity and containment (the
+    fraction of the smaller column's values found in the larger one, which is what matters for
+    a foreign key) sorted best first."""
+    rows_per_band = num_perm // bands
+    signatures = []
+    buckets = defaultdict(list)
+    for r in _load_signatures(S, min_cardinality):
+        sig = np.frombuffer(r.minhash, dtype=np.uint32)
+        i = len(signatures)
+        signatures.append((r, sig))
+        for b in range(bands):
+            band = sig[b * rows_per_band : (b + 1) * rows_per_band].tobytes()
+            buckets[(b, band)].append(i)
+
+    pairs = set()
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        if len(members) > max_bucket:
+            # a band shared by this many columns is noise (e.g. empty-ish value sets)
+            continue
+        for i, j in combinations(members, 2):
+            if signatures[i][0].table_name != signatures[j][0].table_name:
+                pairs.add((i, j) if i < j else (j, i))
+
+    candidates = []
+    for i, j in pairs:
+        (a, sa), (b, sb) = signatures[i], signatures[j]
+        jac = jaccard(sa, sb)
+        if jac < min_jaccard:
+            continue
+        # |A n B| = J (|A| + |B|) / (1 + J)
+        intersection = jac * (a.cardinality + b.cardinality) / (1.0 + jac)
+        containment = min(1.0, intersection / max(1, min(a.cardinality, b.cardinality)))
+        candidates.append(
+            dict(
+                table_a=a.table_name,
+                column_a=a.column_name,
+                table_b=b.table_name,
+                column_b=b.column_name,
+                jaccard=jac,
+                containment=containment,
+            )
+        )
+    candidates.sort(key=lambda c: (-c["containment"], -c["jaccard"]))
+    log.info(
+        "Done finding join candidates",
+        columns=len(signatures),
+        compared=len(pairs),
+        candidates=len(candidates),
+    )
+    return candidates
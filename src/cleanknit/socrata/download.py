@@ -0,0 +1,276 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import urlparse
+
+import aiohttp
+from sqlalchemy import sql
+
+from .model import log, resource_cooked
+
+# asyncio replacement for the curl commands generated by socrata2curl.sh and the notebook.
+# All the requests go through one aiohttp session so connections are pooled and kept alive,
+# with a cap on the number of connections overall and per host, and an optional per-host
+# request rate so that we stay on the right side of the Socrata throttling.
+# xref https://docs.aiohttp.org/en/stable/client_advanced.html#limiting-connection-pool-size
+
+catalog_url = "https://api.us.socrata.com/api/catalog/v1"
+export_url = "https://{domain}/api/views/{resource_id}/rows.csv?accessType=DOWNLOAD"
+soda_url = "https://{domain}/resource/{resource_id}.json"
+
+
+def _parse_socrata_timestamp(v):
+    # e.g. 2021-12-22T22:11:13.000Z, or the naive UTC datetime of resource_cooked
+    if v is None:
+        return None
+    if isinstance(v, datetime):
+        return v.replace(tzinfo=timezone.utc) if v.tzinfo is None else v
+    return datetime.fromisoformat(v.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class _HostRateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.locks = {}
+        self.next_slot = {}
+
+    async def wait(self, host):
+        if not self.interval:
+            return
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+
+class Downloader:
+    """
+    fetch catalog pages and rows.csv exports into output_dir, and run SODA queries. Use as an
+    async context manager. The URL templates can be pointed at a local server for testing."""
+
+    def __init__(
+        self,
+        output_dir=".",
+        max_connections=16,
+        max_connections_per_host=4,
+        requests_per_second=None,
+        catalog_url=catalog_url,
+        export_url=export_url,
+        soda_url=soda_url,
+        app_token=None,
+        chunk_size=1 << 16,
+    ):
+        self.output_dir = output_dir
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.limiter = _HostRateLimiter(requests_per_second)
+        self.catalog_url = catalog_url
+        self.export_url = export_url
+        self.soda_url = soda_url
+        # without one the SODA requests are throttled much harder
+        self.app_token = app_token
+        self.chunk_size = chunk_size
+        self.session = None
+        self.bytes_downloaded = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, limit_per_host=self.max_connections_per_host
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_read=300)
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def _get(self, url, **kwargs):
+        await self.limiter.wait(urlparse(url).netloc)
+        return await self.session.get(url, **kwargs)
+
+    async def soda(self, domain, resource_id, **params):
+        """
+        the rows (dicts) of a SODA query, e.g. soda(domain, resource_id, **{"$limit": 10}).
+        Counted in bytes_downloaded"""
+        url = self.soda_url.format(domain=domain, resource_id=resource_id)
+        headers = {"X-App-Token": self.app_token} if self.app_token else {}
+        async with await self._get(url, params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            body = await resp.read()
+        self.bytes_downloaded += len(body)
+        return json.loads(body)
+
+    async def fetch_catalog(self, domain, page_size=1000):
+        """
+        fetch every page of the catalog for a domain into <domain>.json in the shape that
+        create_socrata_rule4 expects. The first page gives resultSetSize and the remaining
+        pages are then fetched concurrently and streamed into the file as they arrive."""
+
+        async def page(offset):
+            params = dict(domains=domain, offset=offset, limit=page_size)
+            async with await self._get(self.catalog_url, params=params) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+
+        path = os.path.join(self.output_dir, domain + ".json")
+        tmp = path + ".part"
+        first = await page(0)
+        total = first.get("resultSetSize", len(first["results"]))
+        rest = [
+            asyncio.ensure_future(page(offset)) for offset in range(page_size, total, page_size)
+        ]
+        n = 0
+        try:
+            with open(tmp, "w") as fp:
+                fp.write('{"results": [')
+                results = first["results"]
+                for p in rest + [None]:
+                    for r in results:
+                        fp.write("," if n else "")
+                        json.dump(r, fp)
+                        n += 1
+                    results = (await p)["results"] if p is not None else []
+                fp.write('], "resultSetSize": %d}' % total)
+            os.replace(tmp, path)
+        finally:
+            # a failed page leaves the others running and a partial file behind
+            for p in rest:
+                p.cancel()
+            await asyncio.gather(*rest, return_exceptions=True)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        log.info("Done fetching catalog", domain=domain, resources=n)
+        return path
+
+    async def fetch_export(self, domain, resource_id, data_updated_at=None):
+        """
+        fetch the rows.csv export for a resource into <resource_id>.csv.
+        * if we already have a copy at least as new as data_updated_at no request is made
+        * otherwise If-Modified-Since/If-None-Match are sent based on the copy we have
+        * a leftover .part file is resumed with a Range request, if we have the validator
+          (strong ETag or Last-Modified) of the download it came from to send in If-Range
+        Returns one of 'current', 'not-modified', 'downloaded' or 'resumed'."""
+        path = os.path.join(self.output_dir, resource_id + ".csv")
+        tmp = path + ".part"
+        etag_path = path + ".etag"
+        # the If-Range validator of the download that tmp is part of
+        validator_path = tmp + ".etag"
+        updated = _parse_socrata_timestamp(data_updated_at)
+
+        headers = {}
+        if os.path.exists(path):
+            mtime = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+            if updated is not None and mtime >= updated:
+                return "current"
+            headers["If-Modified-Since"] = format_datetime(mtime, usegmt=True)
+            if os.path.exists(etag_path):
+                with open(etag_path) as fp:
+                    headers["If-None-Match"] = fp.read().strip()
+
+        # without a validator there is no telling whether the server still has the version
+        # that tmp is the start of, so that is started over
+        offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+        if offset and os.path.exists(validator_path):
+            with open(validator_path) as fp:
+                headers["If-Range"] = fp.read().strip()
+            headers["Range"] = "bytes=%d-" % offset
+
+        url = self.export_url.format(domain=domain, resource_id=resource_id)
+        async with await self._get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return "not-modified"
+            if resp.status == 416 and "Range" in headers:
+                # the export is shorter than the .part now, which can't be a part of it
+                log.info("Discarding partial export", resource_id=resource_id, offset=offset)
+                _remove(tmp, validator_path)
+                return await self.fetch_export(domain, resource_id, data_updated_at)
+            resp.raise_for_status()
+            status = "resumed" if resp.status == 206 else "downloaded"
+            etag = resp.headers.get("ETag", None)
+            last_modified = resp.headers.get("Last-Modified", None)
+            # a 200 in response to a Range request means the server is sending the whole
+            # thing, and the validator of the download that is being replaced is stale
+            if resp.status != 206:
+                _remove(validator_path)
+                validator = etag if etag and not etag.startswith("W/") else last_modified
+                if validator is not None:
+                    with open(validator_path, "w") as fp:
+                        fp.write(validator)
+            with open(tmp, "ab" if resp.status == 206 else "wb") as fp:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    fp.write(chunk)
+                    self.bytes_downloaded += len(chunk)
+
+        os.replace(tmp, path)
+        _remove(validator_path)
+        if etag is not None:
+            with open(etag_path, "w") as fp:
+                fp.write(etag)
+        # stamp the file with the version of the data so the next refresh can compare
+        # data_updated_at against it without going to the network
+        stamp = updated or (parsedate_to_datetime(last_modified) if last_modified else None)
+        if stamp is not None:
+            os.utime(path, (time.time(), stamp.timestamp()))
+        log.debug("Done fetching export", resource_id=resource_id, status=status)
+        return status
+
+    async def fetch_exports(self, exports):
+        """
+        fetch (domain, resource_id, data_updated_at) tuples concurrently. The connection pool
+        does the throttling. Returns a dict of resource_id to status (or the exception)"""
+        results = await asyncio.gather(
+            *[self.fetch_export(*e) for e in exports], return_exceptions=True
+        )
+        statuses = dict(zip([e[1] for e in exports], results))
+        for resource_id, status in statuses.items():
+            if isinstance(status, Exception):
+                log.error("problem fetching export", resource_id=resource_id, error=str(status))
+        return statuses
+
+
+def exports_to_fetch(S, domains=None, resource_ids=None):
+    """
+    (domain, resource_id, data_updated_at) for the tabular resources in the rule4 database.
+    Read from resource_cooked so that none of the payloads need decompressing"""
+    q = sql.select(
+        resource_cooked.c.domain, resource_cooked.c.resource_id, resource_cooked.c.data_updated_at
+    ).where(resource_cooked.c.lens_view_type == "tabular")
+    if domains is not None:
+        q = q.where(resource_cooked.c.domain.in_(domains))
+    if resource_ids is not None:
+        q = q.where(resource_cooked.c.resource_id.in_(resource_ids))
+    return [tuple(r) for r in S.execute(q)]
+
+
+def download(exports=(), domains=(), output_dir=".", **kwargs):
+    """
+    synchronous entry point: fetch the catalogs for domains and then the exports"""
+
+    async def run():
+        async with Downloader(output_dir=output_dir, **kwargs) as d:
+            t0 = time.perf_counter()
+            await asyncio.gather(*[d.fetch_catalog(domain) for domain in domains])
+            statuses = await d.fetch_exports(list(exports))
+            elapsed = time.perf_counter() - t0
+            log.info(
+                "Done downloading",
+                exports=len(statuses),
+                bytes=d.bytes_downloaded,
+                seconds=round(elapsed, 3),
+            )
+            return statuses
+
+    return asyncio.run(run())
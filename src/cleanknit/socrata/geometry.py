@@ -0,0 +1,249 @@
+import json
+import re
+
+from sqlalchemy.types import Text, TypeDecorator
+
+# Geometry without SpatiaLite. The Socrata exports give geometry as WKT (rows.csv, e.g.
+# POINT (-73.96 40.78), MULTIPOLYGON (((...)))) or GeoJSON (the JSON exports and SODA) and the
+# Location type as "(lat, lon)" optionally after an address. Everything is normalized to
+# compact GeoJSON text at load time, which SQLite's JSON functions can pick apart (see
+# spatial.py for the R*Tree of bounding boxes built from it).
+# xref https://en.wikipedia.org/wiki/Well-known_text_representation_of_geometry
+# xref https://datatracker.ietf.org/doc/html/rfc7946
+
+_wkt = re.compile(
+    r"^\s*(POINT|MULTIPOINT|LINESTRING|MULTILINESTRING|POLYGON|MULTIPOLYGON)\s*(?:ZM|Z|M)?\s*"
+    r"(EMPTY|\(.*\))\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_number = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+# x y with any z/m dropped
+_position = re.compile(r"(%s)\s+(%s)(?:\s+%s)*" % (_number, _number, _number))
+_location = re.compile(r"\(\s*(%s)\s*,\s*(%s)\s*\)\s*$" % (_number, _number))
+
+_wkt_types = {
+    "POINT": "Point",
+    "MULTIPOINT": "MultiPoint",
+    "LINESTRING": "LineString",
+    "MULTILINESTRING": "MultiLineString",
+    "POLYGON": "Polygon",
+    "MULTIPOLYGON": "MultiPolygon",
+}
+_depth = dict(
+    Point=0, MultiPoint=1, LineString=1, MultiLineString=2, Polygon=2, MultiPolygon=3
+)
+
+
+def _from_wkt(geometry_type, body):
+    if body.upper() == "EMPTY":
+        return None
+    text = _position.sub(lambda m: "[%r,%r]" % (float(m.group(1)), float(m.group(2))), body)
+    coordinates = json.loads(text.replace("(", "[").replace(")", "]"))
+    if geometry_type == "Point":
+        coordinates = coordinates[0]
+    elif geometry_type == "MultiPoint":
+        # both MULTIPOINT (1 2, 3 4) and MULTIPOINT ((1 2), (3 4)) are in use
+        coordinates = [c[0] if isinstance(c[0], list) else c for c in coordinates]
+    return coordinates
+
+
+def _valid(geometry_type, coordinates):
+    c = coordinates
+    for _ in range(_depth[geometry_type]):
+        if not isinstance(c, list) or not c:
+            return False
+        c = c[0]
+    return isinstance(c, list) and len(c) >= 2 and all(isinstance(v, (int, float)) for v in c[:2])
+
+
+def parse_geometry(value):
+    """
+    (type, coordinates) in GeoJSON terms from WKT, GeoJSON (text or dict) or a Socrata
+    location. None if the value is empty; ValueError if it is not geometry."""
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        g = value
+    else:
+        value = value.strip()
+        if not value:
+            return None
+        if value.startswith("{"):
+            g = json.loads(value)
+        else:
+            m = _wkt.match(value)
+            if m is not None:
+                geometry_type = _wkt_types[m.group(1).upper()]
+                coordinates = _from_wkt(geometry_type, m.group(2))
+                if coordinates is None:
+                    return None
+                g = dict(type=geometry_type, coordinates=coordinates)
+            else:
+                m = _location.search(value)
+                if m is None:
+                    raise ValueError("not geometry: %r" % value[:80])
+                # latitude first
+                g = dict(type="Point", coordinates=[float(m.group(2)), float(m.group(1))])
+    geometry_type = g.get("type", None)
+    coordinates = g.get("coordinates", None)
+    if geometry_type not in _depth or not _valid(geometry_type, coordinates):
+        raise ValueError("not geometry: %r" % (value if isinstance(value, str) else g))
+    return geometry_type, coordinates
+
+
+def to_geojson(value):
+    """
+    the compact GeoJSON text for a WKT/GeoJSON/location value, or None"""
+    g = parse_geometry(value)
+    if g is None:
+        return None
+    return json.dumps(dict(type=g[0], coordinates=g[1]), separators=(",", ":"))
+
+
+def _positions(geometry_type, coordinates):
+    depth = _depth[geometry_type]
+    stack = [(coordinates, depth)]
+    while stack:
+        c, d = stack.pop()
+        if d == 0:
+            yield c
+        else:
+            stack.extend((x, d - 1) for x in c)
+
+
+def bbox(value):
+    """
+    (minx, maxx, miny, maxy), the column order of the R*Tree"""
+    g = parse_geometry(value)
+    if g is None:
+        return None
+    xs, ys = zip(*((p[0], p[1]) for p in _positions(*g)))
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def _ring_contains(ring, x, y):
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _polygons_contain(polygons, x, y):
+    for rings in polygons:
+        inside = False
+        for ring in rings:
+            if _ring_contains(ring, x, y):
+                inside = not inside
+        if inside:
+            return True
+    return False
+
+
+def contains_point(value, x, y):
+    """
+    whether the (Multi)Polygon value contains the point x, y. Even-odd over all the rings of
+    a polygon, so holes are respected. Registered with SQLite by spatial.py."""
+    g = parse_geometry(value)
+    if g is None or x is None or y is None:
+        return None
+    geometry_type, coordinates = g
+    if geometry_type == "Polygon":
+        polygons = [coordinates]
+    elif geometry_type == "MultiPolygon":
+        polygons = coordinates
+    else:
+        return False
+    return _polygons_contain(polygons, x, y)
+
+
+def _orientation(p, q, r):
+    v = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+    return (v > 0) - (v < 0)
+
+
+def _on_segment(p, q, r):
+    # q on the segment p-r given the three are collinear
+    return min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and min(p[1], r[1]) <= q[1] <= max(p[1], r[1])
+
+
+def _segments_intersect(p1, q1, p2, q2):
+    o1 = _orientation(p1, q1, p2)
+    o2 = _orientation(p1, q1, q2)
+    o3 = _orientation(p2, q2, p1)
+    o4 = _orientation(p2, q2, q1)
+    if o1 != o2 and o3 != o4:
+        return True
+    return (
+        (o1 == 0 and _on_segment(p1, p2, q1))
+        or (o2 == 0 and _on_segment(p1, q2, q1))
+        or (o3 == 0 and _on_segment(p2, p1, q2))
+        or (o4 == 0 and _on_segment(p2, q1, q2))
+    )
+
+
+def _parts(g):
+    """
+    (lines, polygons) of a parsed geometry. A point is a line of one position"""
+    geometry_type, coordinates = g
+    if geometry_type == "Point":
+        lines = [[coordinates]]
+    elif geometry_type == "MultiPoint":
+        lines = [[p] for p in coordinates]
+    elif geometry_type == "LineString":
+        lines = [coordinates]
+    elif geometry_type in ("MultiLineString", "Polygon"):
+        lines = coordinates
+    else:
+        lines = [ring for polygon in coordinates for ring in polygon]
+    polygons = {"Polygon": [coordinates], "MultiPolygon": coordinates}.get(geometry_type, [])
+    return lines, polygons
+
+
+def _segments(lines):
+    for line in lines:
+        if len(line) == 1:
+            yield line[0], line[0]
+        for p, q in zip(line, line[1:]):
+            yield p, q
+
+
+def intersects(a, b):
+    """
+    whether the two geometries share any point: an edge of one touches an edge of the other
+    or one lies inside a polygon of the other"""
+    ga, gb = parse_geometry(a), parse_geometry(b)
+    if ga is None or gb is None:
+        return None
+    lines_a, polygons_a = _parts(ga)
+    lines_b, polygons_b = _parts(gb)
+    segments_b = list(_segments(lines_b))
+    for p1, q1 in _segments(lines_a):
+        for p2, q2 in segments_b:
+            if _segments_intersect(p1, q1, p2, q2):
+                return True
+    # no edges meet so each line (or ring, or point) is either entirely inside the other's
+    # polygons or entirely outside, and any one of its positions tells which
+    for lines, polygons in ((lines_a, polygons_b), (lines_b, polygons_a)):
+        if polygons and any(_polygons_contain(polygons, *line[0][:2]) for line in lines):
+            return True
+    return False
+
+
+class Geometry(TypeDecorator):
+    """
+    geometry stored as GeoJSON text. Accepts WKT, GeoJSON or a dict on the way in and gives
+    back the GeoJSON dict"""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return to_geojson(value)
+
+    def process_result_value(self, value, dialect):
+        return json.loads(value) if value else None
@@ -1,11 +1,7 @@
-import logging
-import structlog
 from structlog import get_logger
 
-# https://stackoverflow.com/a/66537038
-structlog.configure(
-    wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
-)
+# Importing the model has no side effects: the log level etc. is configured by whatever is
+# running (see cleanknit.cli.main.configure_logging)
 log = get_logger('cleanknit.socrata')
 
 import sqlalchemy
@@ -15,6 +11,7 @@ from sqlalchemy import (
     Column,
     sql,
     ForeignKey,
+    Index,
     event,
 )
 from sqlalchemy.engine import URL, Engine
@@ -29,24 +26,18 @@ from sqlalchemy.orm import (
 )
 
 
-
-
-import pdb
 from itertools import chain
 
 # See https://github.com/coleifer/pysqlite3
 import pysqlite3
-from sqlalchemy.types import String, Text, Integer, JSON, Date, DateTime, Float
+from sqlalchemy.types import String, Text, Integer, JSON, Date, DateTime, Float, Boolean, LargeBinary
 from sqlalchemy import create_engine
 import json
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    log.info("hello from set_sqlite_pragma", connection_record=connection_record)
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+from .geometry import Geometry
 
+# The PRAGMAs (foreign_keys etc.) are no longer set globally on every Engine. Pick a
+# connection profile for the engine instead: see cleanknit.connection
 _socrata_sqlalchemy_metadata = MetaData(schema="socrata")
 mapper_registry = registry()
 
@@ -54,11 +45,40 @@ mapper_registry = registry()
 # add in tables for 'domain'. Start with string/JSON
 SocrataDomain = String(512)
 
+# The JSON of the catalog tables (domain._resources, resource.resource and resource.metadata)
+# is stored once per distinct text, compressed, and referred to by its sha1. See payload.py
+PayloadHash = String(40)
+
+# Kept in PRAGMA user_version of a rule4 database so that a file with another layout is not
+# misread. 1 had the JSON inline in the catalog tables, 2 keeps it in payload. Files from
+# before the version was recorded say 0 (see cli.soc.rule4_session)
+rule4_version = 2
+
+payload_dictionary = Table(
+    "payload_dictionary",
+    _socrata_sqlalchemy_metadata,
+    Column("hash", PayloadHash, primary_key=True),
+    Column("codec", String(16), nullable=False),
+    Column("trained_at", DateTime, nullable=False),
+    Column("data", LargeBinary, nullable=False),
+)
+payload = Table(
+    "payload",
+    _socrata_sqlalchemy_metadata,
+    # sha1 of the JSON text
+    Column("hash", PayloadHash, primary_key=True),
+    # NULL for payloads compressed without a dictionary
+    Column("dictionary", PayloadHash, ForeignKey(payload_dictionary.c.hash)),
+    # length of the JSON text in bytes
+    Column("size", Integer, nullable=False),
+    Column("data", LargeBinary, nullable=False),
+)
+
 domain = Table(
     "domain",
     _socrata_sqlalchemy_metadata,
     Column("domain", SocrataDomain, primary_key=True),
-    Column("_resources", JSON, nullable=False),
+    Column("_resources", PayloadHash, ForeignKey(payload.c.hash), nullable=False),
 )
 resource = Table(
     "resource",
@@ -67,8 +87,11 @@ resource = Table(
     Column("resource_id", String(9), primary_key=True),
     Column("name", String),
     Column("permalink", String),
-    Column("metadata", JSON),
-    Column("resource", JSON, nullable=False),
+    Column("metadata", PayloadHash, ForeignKey(payload.c.hash)),
+    Column("resource", PayloadHash, ForeignKey(payload.c.hash), nullable=False),
+    # sha1 of the result object less the volatile fields (see catalog.fingerprint_resource)
+    # so that a refresh can tell which resources have really changed.
+    Column("fingerprint", String(40)),
 )
 
 resource_column = Table(
@@ -84,15 +107,143 @@ resource_column = Table(
     Column("description", String, nullable=False),
 )
 
+# The commonly used attributes of the resource JSON projected out into real columns so that
+# catalog queries can use indexes rather than calling json_extract on every row. These are the
+# SQLite equivalents of the views in socrata_views.sql and are filled by catalog.cook_resources
+resource_cooked = Table(
+    "resource_cooked",
+    _socrata_sqlalchemy_metadata,
+    Column("resource_id", String(9), ForeignKey(resource.c.resource_id), primary_key=True),
+    Column("domain", SocrataDomain),
+    Column("permalink", String),
+    Column("name", String),
+    Column("description", String),
+    Column("attribution", String),
+    Column("attribution_link", String),
+    Column("type", String(64)),
+    Column("lens_view_type", String(64)),
+    Column("lens_display_type", String(64)),
+    Column("blob_mime_type", String(128)),
+    Column("updated_at", DateTime),
+    Column("created_at", DateTime),
+    Column("metadata_updated_at", DateTime),
+    Column("data_updated_at", DateTime),
+    Column("publication_date", DateTime),
+    # e.g. "tabular NYC datasets updated this week"
+    Index("ix_resource_cooked_domain_view_updated", "domain", "lens_view_type", "updated_at"),
+    Index("ix_resource_cooked_updated_at", "updated_at"),
+    Index("ix_resource_cooked_data_updated_at", "data_updated_at"),
+)
+
+resource_category = Table(
+    "resource_category",
+    _socrata_sqlalchemy_metadata,
+    Column("resource_id", String(9), ForeignKey(resource.c.resource_id), primary_key=True),
+    Column("category_ordinal", Integer, primary_key=True),
+    Column("category", String),
+    Index("ix_resource_category_category", "category", "resource_id"),
+)
+
+resource_domain_tag = Table(
+    "resource_domain_tag",
+    _socrata_sqlalchemy_metadata,
+    Column("resource_id", String(9), ForeignKey(resource.c.resource_id), primary_key=True),
+    Column("domain_tag_ordinal", Integer, primary_key=True),
+    Column("domain_tag", String),
+    Index("ix_resource_domain_tag_domain_tag", "domain_tag", "resource_id"),
+)
+
+# Note that the page views are deliberately left out of the resource fingerprint so these
+# are only as fresh as the last time the rest of the resource changed.
+resource_page_view = Table(
+    "resource_page_view",
+    _socrata_sqlalchemy_metadata,
+    Column("resource_id", String(9), ForeignKey(resource.c.resource_id), primary_key=True),
+    Column("page_views_last_week", Integer),
+    Column("page_views_last_month", Integer),
+    Column("page_views_total", Integer),
+)
+
+# Per-column survey of the data in a loaded (or vsv-mapped) dataset table. See profiling.py
+column_profile = Table(
+    "column_profile",
+    _socrata_sqlalchemy_metadata,
+    Column("table_name", String, primary_key=True),
+    Column("column_name", String, primary_key=True),
+    Column("resource_id", String(9)),
+    Column("cid", Integer, nullable=False),
+    # number of rows examined. Less than the size of the table if it was sampled
+    Column("row_count", Integer, nullable=False),
+    Column("sampled", Boolean, nullable=False),
+    # e.g. {"integer": 1000, "text": 3, "null": 12} from typeof()
+    Column("type_histogram", JSON, nullable=False),
+    Column("null_count", Integer, nullable=False),
+    Column("distinct_estimate", Integer),
+    # the delimited file behind the table (if any) as it was when profiled
+    Column("source_path", String),
+    Column("source_mtime", Float),
+    Column("source_size", Integer),
+    Column("profiled_at", DateTime, nullable=False),
+)
+
+# Compact value signatures for a column of a loaded dataset. See discovery.py
+column_signature = Table(
+    "column_signature",
+    _socrata_sqlalchemy_metadata,
+    Column("table_name", String, primary_key=True),
+    Column("column_name", String, primary_key=True),
+    Column("resource_id", String(9)),
+    # number of non-null values the signature was computed over
+    Column("value_count", Integer, nullable=False),
+    # HyperLogLog estimate of the number of distinct values
+    Column("cardinality", Integer, nullable=False),
+    Column("minhash", LargeBinary, nullable=False),
+    Column("hll", LargeBinary, nullable=False),
+    Column("computed_at", DateTime, nullable=False),
+)
+
+
+_missing = object()
+
+
+@mapper_registry.mapped
+class Payload:
+    __table__ = payload
+
+    @property
+    def value(self):
+        """
+        the decoded JSON, decompressed on first use"""
+        value = self.__dict__.get("_value", _missing)
+        if value is _missing:
+            from .payload import decode
+
+            value = json.loads(decode(session.object_session(self), self.data, self.dictionary))
+            self.__dict__["_value"] = value
+        return value
+
+
+def _payload(column):
+    # many-to-one so that a payload shared by many rows is only loaded once per Session
+    return relationship(Payload, foreign_keys=[column], lazy="select", viewonly=True)
+
 
 @mapper_registry.mapped
 class Domain:
     __table__ = domain
 
     __mapper_args__ = {  # type: ignore
-        "properties": {"resources": relationship("Resource")}
+        "properties": {
+            "resources": relationship("Resource"),
+            "resources_hash": domain.c._resources,
+            "resources_payload": _payload(domain.c._resources),
+        }
     }
 
+    @property
+    def _resources(self):
+        return self.resources_payload.value
+
 
 @mapper_registry.mapped
 class Resource:
@@ -101,10 +252,23 @@ class Resource:
         "properties": {
             "columns": relationship(
                 "ResourceColumn", order_by="ResourceColumn.field_number"
-            )
+            ),
+            "resource_hash": resource.c.resource,
+            "metadata_hash": resource.c.metadata,
+            "resource_payload": _payload(resource.c.resource),
+            "metadata_payload": _payload(resource.c.metadata),
         }
     }
 
+    # the payloads are only read (and decompressed) when these are
+    @property
+    def resource(self):
+        return self.resource_payload.value
+
+    @property
+    def metadata(self):
+        return None if self.metadata_payload is None else self.metadata_payload.value
+
     def as_sa_table(self, metadata, schema=None):
         t = Table(self.resource_id, metadata, schema=schema)
         for c in self.columns:
@@ -117,15 +281,17 @@ _type_map = {
     "Date": DateTime,
     "Calendar date": Date,
     "Number": Integer,
-    # These are GeoAlchemy2 type and should work with PostgreSQL and SpatiaLite.
-    # However, SpatiaLite is a pain in the neck to build as a dynamically loadable
-    # extension so will not include it for the moment. It may be possible to
-    # rig SQLAlchemy to render the column as TEXT (for example) when emitting DDL to SQLite but
-    # I am not sure what the 'right' thing to do is.
-    # "Polygon": Geometry("POLYGON"),
-    # "MultiPoint": Geometry("MULTIPOINT"),
-    # "MultiLine": Geometry("MULTILINESTRING"),
-    # "Point": Geometry("POINT"),
+    # These would be GeoAlchemy2 types with PostgreSQL and SpatiaLite. However, SpatiaLite is
+    # a pain in the neck to build as a dynamically loadable extension so instead the geometry
+    # is kept as GeoJSON TEXT (parsed from the WKT at load time) with an R*Tree of bounding
+    # boxes alongside. See geometry.py and spatial.py
+    "Point": Geometry,
+    "MultiPoint": Geometry,
+    "Line": Geometry,
+    "MultiLine": Geometry,
+    "Polygon": Geometry,
+    "MultiPolygon": Geometry,
+    "Location": Geometry,
     "URL": Text,
 }
 
@@ -150,8 +316,15 @@ class ResourceColumn:
         )
 
     def as_sa_column(self):
-        return Column(
-            "%s" % (self.field_name),
-            type_=_type_map.get(self.data_type, Text),
-            comment=self.description,
-        )
+        return sa_column_for(self.field_name, self.data_type, self.description)
+
+
+def sa_column_for(field_name, data_type, description):
+    """
+    the Column for a resource_column row. Split out from ResourceColumn.as_sa_column so that
+    set-based code can build tables without going through the ORM"""
+    return Column(
+        "%s" % (field_name),
+        type_=_type_map.get(data_type, Text),
+        comment=description,
+    )
@@ -0,0 +1,322 @@
+import hashlib
+import json
+import re
+import zlib
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+from sqlalchemy import sql
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .model import domain, log, payload, payload_dictionary, resource
+
+# Content-addressed, compressed store for the JSON kept by the catalog tables. The same JSON
+# used to be stored several times over as plain text: the raw domain blob in
+# domain._resources, every result object in resource.resource and the result's metadata again
+# in resource.metadata. Those columns now hold the sha1 of the JSON text and the text itself is
+# in payload, once, however many rows refer to it (the metadata of every resource of a domain
+# is usually the same couple of payloads).
+#
+# The result objects are small and very alike, which plain zlib can make little of as each
+# one starts from an empty window. So they are deflated with a preset dictionary (zdict)
+# trained from a sample of the payloads: the fragments (keys, "key":value members, strings)
+# found in the most samples, the best last as deflate reaches back to those most cheaply.
+# zlib has no trainer of its own (zstd does, but is not in the standard library) and the
+# dictionary is stored in payload_dictionary, keyed by its own sha1, so that any database
+# can be read by itself. The trained dictionary is used from then on; payloads written before
+# there was one have a NULL dictionary.
+#
+# SQL gets at the JSON with payload_json(data, dictionary), registered on the connection by
+# register_functions, e.g.
+#   SELECT json_extract(payload_json(p.data, p.dictionary), '$.resource.name')
+#   FROM socrata.resource AS r JOIN socrata.payload AS p ON p.hash = r.resource
+# and the ORM only decodes (see Payload.value) when the attribute is read.
+# xref https://docs.python.org/3/library/zlib.html#zlib.compressobj
+# xref https://www.rfc-editor.org/rfc/rfc1950#section-2.2
+# xref https://www.sqlite.org/appfunc.html
+
+codec = "zlib"
+# deflate can only refer back 32KiB so there is no point in a bigger dictionary
+dictionary_size = 32768
+# the loaders compress on their single writer so speed matters more than the last few
+# percent: with the dictionary level 1 is about 7x quicker than 9 for ~12% more bytes
+compression_level = 1
+# payloads looked at when training and the fewest worth training on. Anything as big as a
+# whole catalog file is too big to be typical. More samples than this make training slower
+# without making the dictionary any better
+train_samples = 500
+min_train_samples = 32
+max_sample_size = 1 << 20
+
+# a JSON string, with the value that follows it if it is a member's key and the value is a
+# scalar (or the opening bracket if it is not)
+_fragment = re.compile(r'"(?:[^"\\]|\\.)*"(?::(?:"(?:[^"\\]|\\.)*"|[-+\w.]+|[\[{]))?')
+
+
+def dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def payload_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def encode(value):
+    """
+    (hash, text) of a payload. A str is taken to be JSON text already and is kept as it is"""
+    text = value if isinstance(value, str) else dumps(value)
+    return payload_hash(text), text
+
+
+def train_dictionary(samples, size=dictionary_size):
+    """
+    a zlib preset dictionary of at most size bytes from sample JSON texts"""
+    document_frequency = Counter()
+    for text in samples:
+        document_frequency.update(set(_fragment.findall(text)))
+    # a fragment seen in only the one sample won't help with the next payload
+    fragments = [f for f, n in document_frequency.items() if n > 1 and len(f) > 3]
+    fragments.sort(key=lambda f: document_frequency[f] * len(f), reverse=True)
+    chosen, n = [], 0
+    for f in fragments:
+        n += len(f.encode("utf-8")) + 1
+        if n > size:
+            break
+        chosen.append(f)
+    chosen.reverse()
+    return ",".join(chosen).encode("utf-8")
+
+
+@lru_cache(maxsize=8)
+def _primed(zdict, level):
+    # setting the dictionary costs about as much as compressing a payload, so it is done
+    # once and the compressor copied for each payload
+    return zlib.compressobj(level, zdict=zdict)
+
+
+def compress(raw, zdict=None):
+    """
+    deflate the UTF-8 bytes of a payload"""
+    if zdict is None:
+        return zlib.compress(raw, compression_level)
+    c = _primed(zdict, compression_level).copy()
+    return c.compress(raw) + c.flush()
+
+
+def decompress(data, zdict=None):
+    if zdict is None:
+        return zlib.decompress(data).decode("utf-8")
+    d = zlib.decompressobj(zdict=zdict)
+    return (d.decompress(data) + d.flush()).decode("utf-8")
+
+
+# The dictionaries by their sha1, for every database this process has read. Being content
+# addressed they can't clash and are few and never change.
+_dictionaries = {}
+
+
+def _dictionary_q(dictionary_hash):
+    return sql.select(payload_dictionary.c.codec, payload_dictionary.c.data).where(
+        payload_dictionary.c.hash == dictionary_hash
+    )
+
+
+def dictionary(S, dictionary_hash):
+    """
+    the zdict with the given sha1 (from the cache or S)"""
+    if dictionary_hash is None:
+        return None
+    zdict = _dictionaries.get(dictionary_hash, None)
+    if zdict is None:
+        row = S.execute(_dictionary_q(dictionary_hash)).first()
+        if row is None:
+            raise KeyError("unknown payload dictionary %s" % dictionary_hash)
+        if row.codec != codec:
+            raise ValueError("unsupported payload codec %s" % row.codec)
+        zdict = _dictionaries[dictionary_hash] = row.data
+    return zdict
+
+
+def decode(S, data, dictionary_hash):
+    """
+    the JSON text of a payload"""
+    return decompress(data, dictionary(S, dictionary_hash))
+
+
+def current_dictionary(S):
+    """
+    (hash, zdict) of the most recently trained dictionary in S, or None"""
+    row = S.execute(
+        sql.select(payload_dictionary.c.hash, payload_dictionary.c.data)
+        .where(payload_dictionary.c.codec == codec)
+        .order_by(payload_dictionary.c.trained_at.desc())
+        .limit(1)
+    ).first()
+    if row is None:
+        return None
+    _dictionaries[row.hash] = row.data
+    return row.hash, row.data
+
+
+def register_functions(dbapi_connection):
+    """
+    register payload_json(data, dictionary) with a SQLite connection. Dictionaries that are
+    not cached already are read through the same connection (from payload_dictionary in
+    whichever of the attached databases has it)"""
+    # the pool's proxy for the connection is emptied when it is checked back in, whereas the
+    # function stays registered for as long as the connection itself is open
+    dbapi_connection = getattr(dbapi_connection, "dbapi_connection", dbapi_connection)
+
+    @lru_cache(maxsize=256)
+    def payload_json(data, dictionary_hash):
+        # called once for each json_extract so the same payload comes in several times in a row
+        if data is None:
+            return None
+        if dictionary_hash is None:
+            return decompress(data)
+        zdict = _dictionaries.get(dictionary_hash, None)
+        if zdict is None:
+            row = dbapi_connection.execute(
+                "SELECT data FROM payload_dictionary WHERE hash = ?", (dictionary_hash,)
+            ).fetchone()
+            if row is None:
+                raise KeyError("unknown payload dictionary %s" % dictionary_hash)
+            zdict = _dictionaries[dictionary_hash] = row[0]
+        return decompress(data, zdict)
+
+    dbapi_connection.create_function("payload_json", 2, payload_json, deterministic=True)
+
+
+# The result objects as JSON text for SQL that does not go through the ORM, e.g. the scripts
+# in resources/. Reading it needs payload_json registered on the connection
+resource_json_ddl = """
+CREATE VIEW IF NOT EXISTS "{schema}".resource_json AS
+SELECT r.domain, r.resource_id, r.name, r.permalink,
+    payload_json(m.data, m.dictionary) AS metadata,
+    payload_json(p.data, p.dictionary) AS resource
+FROM resource AS r
+    JOIN payload AS p ON (p.hash = r.resource)
+    LEFT OUTER JOIN payload AS m ON (m.hash = r.metadata)
+"""
+
+
+def payload_json(table=payload):
+    """
+    the SQL expression for the JSON text of the payload table (or an alias of it)"""
+    return sql.func.payload_json(table.c.data, table.c.dictionary)
+
+
+class PayloadStore:
+    """
+    collects the payloads of a load and writes each one (compressed) once. put gives the
+    hash that goes in the referring row straight away; call flush before inserting the rows
+    that refer to what was put. The first flush with enough payloads trains the dictionary if
+    the database has none yet"""
+
+    def __init__(self, S):
+        self.S = S
+        self.pending = {}
+        self.dictionary_hash = self.zdict = None
+        # the dictionary is looked up on the first flush, in the caller's transaction
+        self.stale = True
+        self.payloads = self.size = self.stored = 0
+
+    def add(self, payload_hash, text):
+        self.pending.setdefault(payload_hash, text)
+        return payload_hash
+
+    def put(self, value):
+        return self.add(*encode(value))
+
+    def put_columns(self, rows, columns):
+        """
+        replace the values of the given columns of the row dicts with their hashes"""
+        for row in rows:
+            for c in columns:
+                if row[c] is not None:
+                    row[c] = self.put(row[c])
+        return rows
+
+    def train(self, samples):
+        samples = [text for text in samples if len(text) <= max_sample_size][:train_samples]
+        if len(samples) < min_train_samples:
+            return None
+        zdict = train_dictionary(samples)
+        if not zdict:
+            return None
+        dictionary_hash = hashlib.sha1(zdict).hexdigest()
+        self.S.execute(
+            sqlite_insert(payload_dictionary)
+            .values(hash=dictionary_hash, codec=codec, trained_at=datetime.now(), data=zdict)
+            .on_conflict_do_nothing()
+        )
+        _dictionaries[dictionary_hash] = zdict
+        self.dictionary_hash, self.zdict = dictionary_hash, zdict
+        log.info("Done training payload dictionary", samples=len(samples), size=len(zdict))
+        return dictionary_hash
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        if self.stale:
+            current = current_dictionary(self.S)
+            self.dictionary_hash, self.zdict = current if current else (None, None)
+            self.stale = False
+        if self.zdict is None:
+            self.train(list(self.pending.values()))
+        rows = []
+        for h, text in self.pending.items():
+            raw = text.encode("utf-8")
+            rows.append(
+                dict(
+                    hash=h,
+                    dictionary=self.dictionary_hash,
+                    size=len(raw),
+                    data=compress(raw, self.zdict),
+                )
+            )
+        self.S.execute(sqlite_insert(payload).on_conflict_do_nothing(), rows)
+        self.payloads += len(rows)
+        self.size += sum(r["size"] for r in rows)
+        self.stored += sum(len(r["data"]) for r in rows)
+        self.pending.clear()
+        return len(rows)
+
+    def rollback(self):
+        """
+        forget what was put since the last flush, and the dictionary if it was trained in
+        the transaction that was rolled back. Call after rolling back the Session"""
+        self.pending.clear()
+        self.stale = True
+
+
+# the hashes that the catalog rows refer to. No NULLs as NOT IN a set with a NULL in it is
+# never true
+_referenced = sql.union(
+    sql.select(domain.c._resources),
+    sql.select(resource.c.resource),
+    sql.select(resource.c.metadata).where(resource.c.metadata.isnot(None)),
+)
+
+
+def prune_payloads(S):
+    """
+    delete the payloads left behind by updated and deleted resources, in the caller's
+    transaction. Returns the number deleted"""
+    n = S.execute(payload.delete().where(payload.c.hash.not_in(_referenced))).rowcount
+    log.info("Done pruning payloads", payloads=n)
+    return n
+
+
+def payload_stats(S):
+    """
+    number of payloads and their total size in bytes as JSON text and as stored"""
+    row = S.execute(
+        sql.select(
+            sql.func.count(),
+            sql.func.coalesce(sql.func.sum(payload.c.size), 0),
+            sql.func.coalesce(sql.func.sum(sql.func.length(payload.c.data)), 0),
+        )
+    ).first()
+    return dict(payloads=row[0], size=row[1], stored=row[2])
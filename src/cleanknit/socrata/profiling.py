@@ -0,0 +1,247 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+# See https://github.com/coleifer/pysqlite3
+import pysqlite3
+from sqlalchemy import sql
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .model import log, column_profile
+from ..files import vsv_filename
+
+# Python version of profiling_codegen_query.sql. Rather than grouping on the combination of
+# typeof() of the first 10 columns we survey every column independently, which lets us do all
+# the columns of a table in one pass:
+#   count(*), sum(typeof(c) = 'integer'), ..., sum(typeof(c) = 'null'), count(DISTINCT c)
+# The surveys for different tables are independent so they are run on a pool of threads each
+# with its own read-only connection. SQLite releases the GIL while it is stepping a statement
+# so the threads really do run in parallel.
+
+_sqlite_types = ("integer", "real", "text", "blob", "null")
+
+_resource_id = re.compile(r"[a-z0-9]{4}-[a-z0-9]{4}$")
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def survey_sql(columns, source):
+    """
+    the single-pass survey for a table. source is the FROM clause (which may be a sample)"""
+    terms = ["count(*)"]
+    for c in columns:
+        qc = _quote(c)
+        terms.extend("sum(typeof(%s) = '%s')" % (qc, t) for t in _sqlite_types)
+        terms.append("count(DISTINCT %s)" % qc)
+    return "SELECT %s FROM %s" % (", ".join(terms), source)
+
+
+def _sample_source(table_name, sample, is_virtual):
+    qt = _quote(table_name)
+    if sample is None:
+        return qt
+    if is_virtual:
+        # the virtual tables over delimited files can only be read front to back so the
+        # cheapest sample is the first N rows
+        return "(SELECT * FROM %s LIMIT %d)" % (qt, sample)
+    # otherwise pick N random rowids and let the b-tree do the work
+    return (
+        "(SELECT * FROM %s WHERE rowid IN ("
+        "WITH RECURSIVE r(n, id) AS (SELECT 0, NULL UNION ALL "
+        "SELECT n + 1, 1 + abs(random()) %% (SELECT max(rowid) FROM %s) FROM r WHERE n < %d) "
+        "SELECT id FROM r WHERE id IS NOT NULL))" % (qt, qt, sample)
+    )
+
+
+class _Worker:
+    """
+    one read-only connection per thread. close() once the pool has been shut down"""
+
+    def __init__(self, database, extensions):
+        self.database = database
+        self.extensions = extensions
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        c = getattr(self.local, "connection", None)
+        if c is None:
+            c = pysqlite3.connect(
+                "file:%s?mode=ro" % self.database, uri=True, check_same_thread=False
+            )
+            if self.extensions:
+                c.enable_load_extension(True)
+                for e in self.extensions:
+                    c.load_extension(e)
+                c.enable_load_extension(False)
+            self.local.connection = c
+            with self.lock:
+                self.connections.append(c)
+        return c
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for c in connections:
+            c.close()
+
+    def profile(self, table):
+        c = self.connection()
+        columns = table["columns"]
+        source = _sample_source(table["name"], table["sample"], table["is_virtual"])
+        row = c.execute(survey_sql(columns, source)).fetchone()
+        n = row[0]
+        total = None
+        if table["sample"] is not None and not table["is_virtual"]:
+            total = c.execute("SELECT max(rowid) FROM %s" % _quote(table["name"])).fetchone()[0]
+        width = len(_sqlite_types) + 1
+        profiled_at = datetime.now(timezone.utc)
+        profiles = []
+        for i, name in enumerate(columns):
+            counts = row[1 + i * width : 1 + (i + 1) * width]
+            histogram = dict((t, k) for t, k in zip(_sqlite_types, counts[:-1]) if k)
+            distinct = counts[-1]
+            non_null = n - histogram.get("null", 0)
+            # count(DISTINCT) over a sample says little about the table as a whole except
+            # when the sample is (nearly) all distinct values, which is the case we care about
+            # for candidate keys, so only then do we scale it up.
+            if total and n and distinct >= 0.95 * non_null:
+                distinct = int(distinct * float(total) / n)
+            profiles.append(
+                dict(
+                    table_name=table["name"],
+                    column_name=name,
+                    resource_id=table["resource_id"],
+                    cid=i,
+                    row_count=n,
+                    sampled=table["sample"] is not None,
+                    type_histogram=histogram,
+                    null_count=histogram.get("null", 0),
+                    distinct_estimate=distinct,
+                    source_path=table["source_path"],
+                    source_mtime=table["source_mtime"],
+                    source_size=table["source_size"],
+                    profiled_at=profiled_at,
+                )
+            )
+        return profiles
+
+
+def tables_to_profile(database, name_like="%", max_columns=None, extensions=()):
+    """
+    describe the tables in database matching name_like along with the file behind them"""
+    c = pysqlite3.connect("file:%s?mode=ro" % database, uri=True)
+    try:
+        if extensions:
+            c.enable_load_extension(True)
+            for e in extensions:
+                c.load_extension(e)
+            c.enable_load_extension(False)
+        q = """
+        SELECT s.name, s.sql, c.cid, c.name
+        FROM sqlite_schema AS s, pragma_table_info(s.name) AS c
+        WHERE s.type = 'table' AND s.name LIKE ? AND s.name NOT LIKE 'sqlite\\_%' ESCAPE '\\'
+            AND c.name <> '{' -- some of the files may not actually be in CSV format
+        ORDER BY s.name, c.cid
+        """
+        tables = {}
+        for name, ddl, cid, column in c.execute(q, (name_like,)):
+            if max_columns is not None and cid >= max_columns:
+                continue
+            t = tables.get(name, None)
+            if t is None:
+                path = vsv_filename(ddl)
+                st = os.stat(path) if path and os.path.exists(path) else None
+                rid = _resource_id.search(name)
+                t = tables[name] = dict(
+                    name=name,
+                    resource_id=rid.group(0) if rid else None,
+                    is_virtual=(ddl or "").upper().startswith("CREATE VIRTUAL"),
+                    source_path=path,
+                    source_mtime=st.st_mtime if st else None,
+                    source_size=st.st_size if st else None,
+                    columns=[],
+                )
+            t["columns"].append(column)
+        return list(tables.values())
+    finally:
+        c.close()
+
+
+def profile_tables(
+    S,
+    database,
+    name_like="%",
+    max_workers=None,
+    sample=None,
+    max_columns=None,
+    extensions=(),
+    force=False,
+):
+    """
+    profile the tables in database (a file name) and upsert the results into column_profile
+    through S, in the caller's transaction. sample is a number of rows per table or None for a
+    full scan. Tables backed by a file that has not changed since it was last profiled are
+    skipped unless force is set. Returns the names of the tables profiled."""
+    tables = tables_to_profile(database, name_like, max_columns, extensions)
+    n_candidates = len(tables)
+
+    if not force:
+        previous = dict(
+            (r.table_name, (r.source_mtime, r.source_size))
+            for r in S.execute(
+                sql.select(
+                    column_profile.c.table_name,
+                    column_profile.c.source_mtime,
+                    column_profile.c.source_size,
+                ).distinct()
+            )
+        )
+        tables = [
+            t
+            for t in tables
+            if t["source_path"] is None
+            or previous.get(t["name"], None) != (t["source_mtime"], t["source_size"])
+        ]
+
+    ins = sqlite_insert(column_profile)
+    upsert = ins.on_conflict_do_update(
+        index_elements=[column_profile.c.table_name, column_profile.c.column_name],
+        set_=dict(
+            (c.name, ins.excluded[c.name]) for c in column_profile.columns if not c.primary_key
+        ),
+    )
+
+    worker = _Worker(database, extensions)
+    done = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = dict(
+                (pool.submit(worker.profile, dict(t, sample=sample)), t["name"]) for t in tables
+            )
+            # the workers only read; all the writing happens here
+            for f in as_completed(futures):
+                try:
+                    profiles = f.result()
+                except pysqlite3.Error as e:
+                    log.error("problem profiling table", table_name=futures[f], error=str(e))
+                    continue
+                S.execute(column_profile.delete().where(column_profile.c.table_name == futures[f]))
+                S.execute(upsert, profiles)
+                done.append(futures[f])
+                log.debug("Done profiling table", table_name=futures[f], columns=len(profiles))
+    finally:
+        worker.close()
+
+    log.info(
+        "Done profiling",
+        tables=len(done),
+        unchanged=n_candidates - len(tables),
+        failed=len(tables) - len(done),
+    )
+    return done
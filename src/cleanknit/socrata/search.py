@@ -0,0 +1,202 @@
+import re
+import time
+from collections import OrderedDict
+
+# See https://github.com/coleifer/pysqlite3
+import pysqlite3
+
+# Full-text search over the rule4 resource and resource_column tables, along the lines of
+# socrata_resource_tabular_fts/socrata_resource_column_fts in socrata_ddl.sql.
+# see https://www.sqlite.org/fts5.html for general background on FTS
+#
+# The indexes are external-content FTS5 tables so the text is not stored twice. Unlike
+# socrata_ddl.sql there are no triggers: after a load the index is rebuilt in one go with the
+# 'rebuild' command which is much quicker than maintaining it a row at a time.
+# The prefix indexes make the "search as you type" prefix queries (e.g. hous*) cheap.
+#
+# `soc search` imports this module and is run from scripts thousands of times a day so the
+# module level imports are kept to the standard library and pysqlite3. SQLAlchemy and
+# structlog are only imported by the functions that need them.
+
+_ddl = [
+    # resource has no description column of its own so the FTS content is a view over it. The
+    # description comes from resource_cooked as resource.resource is compressed (payload.py).
+    # Dropped first as the view used to json_extract it from resource.resource. The names in
+    # the body are unqualified: a view can only refer to its own database, and one that
+    # names the attached schema can't be read when the file is opened by itself
+    "DROP VIEW IF EXISTS {schema}.resource_text",
+    """CREATE VIEW {schema}.resource_text AS
+    SELECT r.rowid AS resource_rowid, r.resource_id, r.name, c.description
+    FROM resource AS r
+        LEFT JOIN resource_cooked AS c ON (c.resource_id = r.resource_id)""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.resource_fts USING fts5(
+        name, description,
+        content = 'resource_text', content_rowid = 'resource_rowid',
+        prefix = '2 3', tokenize = 'unicode61 remove_diacritics 2')""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.resource_column_fts USING fts5(
+        field_name, name, description,
+        content = 'resource_column',
+        prefix = '2 3', tokenize = 'unicode61 remove_diacritics 2')""",
+]
+
+# bm25 weights: a hit in the name counts for more than one in the description. The ranking
+# and LIMIT are done inside the FTS table so only the winning rows are joined back.
+_resource_q = """
+SELECT 'resource' AS kind, r.resource_id, r.name, NULL AS field_name, f.rank
+FROM (
+    SELECT rowid, bm25(resource_fts, 10.0, 1.0) AS rank
+    FROM {schema}.resource_fts
+    WHERE resource_fts MATCH :q
+    ORDER BY rank
+    LIMIT :limit
+) AS f
+    JOIN {schema}.resource AS r ON (r.rowid = f.rowid)
+ORDER BY f.rank
+"""
+_resource_column_q = """
+SELECT 'column' AS kind, rc.resource_id, rc.name, rc.field_name, f.rank
+FROM (
+    SELECT rowid, bm25(resource_column_fts, 5.0, 10.0, 1.0) AS rank
+    FROM {schema}.resource_column_fts
+    WHERE resource_column_fts MATCH :q
+    ORDER BY rank
+    LIMIT :limit
+) AS f
+    JOIN {schema}.resource_column AS rc ON (rc.rowid = f.rowid)
+ORDER BY f.rank
+"""
+
+_token = re.compile(r"\w+", re.UNICODE)
+
+
+def match_expression(query):
+    """
+    turn what the user typed into an FTS5 query: each word is quoted (so punctuation and
+    FTS5 operators in the input are harmless) and the last one is a prefix query as it is
+    probably still being typed"""
+    words = _token.findall(query)
+    if not words:
+        return None
+    terms = ['"%s"' % w for w in words]
+    if not query[-1:].isspace():
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+# bm25 scores depend on the statistics of the table they come from so the two lists are not
+# on the same scale. Each is put relative to its own best match (1.0 for the best, falling
+# towards 0) before they are merged; the rows keep their raw rank.
+def _relative(rows):
+    rows = [tuple(r) for r in rows]
+    best = min((r[4] for r in rows), default=0.0)
+    return [(r[4] / best if best else 1.0, r) for r in rows]
+
+
+def _best(resource_rows, column_rows, limit):
+    scored = _relative(resource_rows) + _relative(column_rows)
+    scored.sort(key=lambda s: -s[0])
+    return [r for _, r in scored[:limit]]
+
+
+def search_file(path, query, limit=20, schema="socrata"):
+    """
+    SearchIndex.search straight through pysqlite3 against a rule4 database file (read-only
+    and without SQLAlchemy), for the command line. The file is ATTACHed under schema as
+    that is what the views in it expect."""
+    q = match_expression(query)
+    if q is None:
+        return []
+    c = pysqlite3.connect(":memory:", uri=True)
+    try:
+        c.execute(f'ATTACH DATABASE ? AS "{schema}"', ("file:%s?mode=ro" % path,))
+        params = dict(q=q, limit=limit)
+        return _best(
+            c.execute(_resource_q.format(schema=schema), params),
+            c.execute(_resource_column_q.format(schema=schema), params),
+            limit,
+        )
+    finally:
+        c.close()
+
+
+def create_search_index(S, schema="socrata"):
+    for ddl in _ddl:
+        S.execute(ddl.format(schema=schema))
+    S.commit()
+
+
+def rebuild_search_index(S, schema="socrata"):
+    """
+    repopulate the indexes from the resource/resource_column tables. Call after a load"""
+    from .model import log
+
+    t0 = time.perf_counter()
+    for fts in ("resource_fts", "resource_column_fts"):
+        S.execute(f"INSERT INTO {schema}.{fts}({fts}) VALUES('rebuild')")
+        S.execute(f"INSERT INTO {schema}.{fts}({fts}) VALUES('optimize')")
+    S.commit()
+    log.info("Done rebuilding search index", seconds=round(time.perf_counter() - t0, 3))
+
+
+class SearchIndex:
+    """
+    ranked search with an LRU cache of recent results. The cache is dropped whenever the
+    database changes, either through this connection (total_changes) or another one
+    (PRAGMA data_version)."""
+
+    def __init__(self, S, schema="socrata", cache_size=1024):
+        self.S = S
+        self.schema = schema
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.version = None
+        self.hits = self.misses = 0
+        from sqlalchemy import sql
+
+        self._resource_q = sql.text(_resource_q.format(schema=schema))
+        self._resource_column_q = sql.text(_resource_column_q.format(schema=schema))
+
+    def _current_version(self):
+        conn = self.S.connection()
+        data_version = conn.exec_driver_sql(f"PRAGMA {self.schema}.data_version").scalar()
+        return (data_version, conn.connection.total_changes)
+
+    def invalidate(self):
+        self.cache.clear()
+        self.version = None
+
+    def rebuild(self):
+        rebuild_search_index(self.S, self.schema)
+        self.invalidate()
+
+    def search(self, query, limit=20):
+        """
+        the best limit matches over resource names/descriptions and column
+        names/descriptions as (kind, resource_id, name, field_name, rank) tuples, best first"""
+        version = self._current_version()
+        if version != self.version:
+            self.cache.clear()
+            self.version = version
+
+        key = (query, limit)
+        hit = self.cache.get(key, None)
+        if hit is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return hit
+        self.misses += 1
+
+        q = match_expression(query)
+        if q is None:
+            return []
+        params = dict(q=q, limit=limit)
+        results = _best(
+            self.S.execute(self._resource_q, params),
+            self.S.execute(self._resource_column_q, params),
+            limit,
+        )
+
+        self.cache[key] = results
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return results
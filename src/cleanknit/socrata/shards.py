@@ -0,0 +1,283 @@
+import heapq
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pysqlite3
+from sqlalchemy import sql
+
+from ..connection import apply_pragmas
+from .model import _domain_to_schema_map, domain, log, resource
+
+# One SQLite file per Socrata domain for the dataset tables, instead of everything in one huge
+# file or in ATTACHed :memory: schemas. A ShardRouter sits on a rule4 Session (rule4 attached
+# as socrata) and maps a domain, or a resource id through socrata.resource, to the shard's
+# schema, ATTACHing the file on demand. SQLite allows only so many attached databases
+# (SQLITE_MAX_ATTACHED, 10 by default) so the attached shards are kept in LRU order and the
+# least recently used one is DETACHed to make room. A DETACH is refused while the shard is in
+# the connection's open transaction, in which case the next least recently used is tried.
+#
+# Queries across domains are fanned out to the shards, each on its own read-only connection
+# (rule4 attached as socrata) rather than through the ATTACH pool, and the rows are merged.
+# Loading and VACUUM are per shard and so run in parallel on a process pool, and a single
+# domain is rebuilt into a new file that is swapped in when it is complete, so the other
+# shards are never locked and readers of the old shard see the old data until the swap.
+#
+#   router = ShardRouter(S, "shards")
+#   load_delimited(S, "erm2-nwe9.csv", schema=router.resolve(resource_id="erm2-nwe9"))
+#   S.execute(f"SELECT count(*) FROM {router.table('erm2-nwe9')}")
+#   router.fan_out('SELECT count(*) FROM "{resource_id}"', resource_ids=[...])
+# xref https://www.sqlite.org/limits.html#max_attached
+# xref https://www.sqlite.org/lang_detach.html
+
+
+def shard_schema(domain_name):
+    """
+    the schema name for a domain: _domain_to_schema_map or the domain with the dots (and
+    anything else that needs quoting) replaced"""
+    schema = _domain_to_schema_map.get(domain_name, None)
+    if schema is None:
+        schema = re.sub(r"[^a-z0-9]+", "_", domain_name.lower()).strip("_")
+    return schema
+
+
+def max_attached(dbapi_connection):
+    for (option,) in dbapi_connection.execute("PRAGMA compile_options"):
+        if option.startswith("MAX_ATTACHED="):
+            return int(option.split("=", 1)[1])
+    return 10
+
+
+def _threadsafe(dbapi_connection):
+    # compile_sqlite.sh builds with SQLITE_THREADSAFE=0, where even separate connections
+    # can't be used from different threads
+    return ("THREADSAFE=0",) not in dbapi_connection.execute("PRAGMA compile_options").fetchall()
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _query_shard(path, rule4, query, params):
+    c = pysqlite3.connect("file:%s?mode=ro" % path, uri=True, check_same_thread=False)
+    try:
+        if rule4:
+            c.execute("ATTACH DATABASE ? AS socrata", ("file:%s?mode=ro" % rule4,))
+        return c.execute(query, params).fetchall()
+    finally:
+        c.close()
+
+
+def vacuum_shard(domain_name, path):
+    """
+    VACUUM and ANALYZE a shard. Module level so it can be run on a process pool"""
+    c = pysqlite3.connect(path, isolation_level=None)
+    try:
+        before = os.path.getsize(path)
+        c.execute("VACUUM")
+        c.execute("PRAGMA optimize")
+        return os.path.getsize(path) - before
+    finally:
+        c.close()
+
+
+def _finish(path):
+    # a rebuilt shard is swapped in as a single file so it can't be left in WAL mode
+    c = pysqlite3.connect(path, isolation_level=None)
+    try:
+        c.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        c.close()
+
+
+class ShardRouter:
+    def __init__(self, S, directory, max_shards=None, connection_profile="bulk-load"):
+        self.S = S
+        self.directory = directory
+        self.connection_profile = connection_profile
+        os.makedirs(directory, exist_ok=True)
+        dbapi_connection = S.connection().connection
+        databases = dict((r[1], r[2]) for r in S.execute("PRAGMA database_list"))
+        self.rule4 = databases.get("socrata", None) or None
+        # main, temp is not counted, and whatever else is attached already (socrata)
+        limit = max_attached(dbapi_connection) - (len(databases) - 1)
+        self.max_shards = min(max_shards, limit) if max_shards else limit
+        self.threadsafe = _threadsafe(dbapi_connection)
+        # schema -> domain, least recently used first
+        self.attached = OrderedDict()
+        self._domains = {}
+
+    def path(self, domain_name):
+        return os.path.join(self.directory, shard_schema(domain_name) + ".db")
+
+    def domains(self, existing=True):
+        """
+        the rule4 domains, only those that have a shard unless existing is False"""
+        names = self.S.execute(sql.select(domain.c.domain).order_by(domain.c.domain)).scalars()
+        return [d for d in names if not existing or os.path.exists(self.path(d))]
+
+    def domain_of(self, resource_id):
+        d = self._domains.get(resource_id, None)
+        if d is None:
+            d = self.S.execute(
+                sql.select(resource.c.domain).where(resource.c.resource_id == resource_id)
+            ).scalar()
+            if d is None:
+                raise KeyError("unknown resource %s" % resource_id)
+            self._domains[resource_id] = d
+        return d
+
+    def _detach_one(self):
+        conn = self.S.connection()
+        for schema in list(self.attached):
+            try:
+                conn.exec_driver_sql("DETACH DATABASE %s" % _quote(schema))
+            except Exception as e:
+                # "database x is locked": it is part of the open transaction
+                log.debug("shard busy", schema=schema, error=str(e))
+                continue
+            del self.attached[schema]
+            return schema
+        raise RuntimeError(
+            "all %d attached shards are in the open transaction, commit first"
+            % len(self.attached)
+        )
+
+    def attach(self, domain_name):
+        """
+        the schema of the domain's shard, ATTACHing it (and creating the file) if need be"""
+        schema = shard_schema(domain_name)
+        if schema in self.attached:
+            self.attached.move_to_end(schema)
+            return schema
+        if len(self.attached) >= self.max_shards:
+            self._detach_one()
+        conn = self.S.connection()
+        conn.exec_driver_sql(
+            "ATTACH DATABASE ? AS %s" % _quote(schema), (self.path(domain_name),)
+        )
+        if not conn.connection.in_transaction:
+            # otherwise the shard keeps what is persistent (journal_mode=WAL from its load)
+            # and the defaults, as synchronous and the like can't be changed in a transaction
+            apply_pragmas(conn.connection, self.connection_profile, schema=schema)
+        self.attached[schema] = domain_name
+        log.debug("attached shard", domain=domain_name, schema=schema)
+        return schema
+
+    def detach(self, domain_name):
+        schema = shard_schema(domain_name)
+        if schema in self.attached:
+            self.S.connection().exec_driver_sql("DETACH DATABASE %s" % _quote(schema))
+            del self.attached[schema]
+
+    def detach_all(self):
+        for schema, domain_name in list(self.attached.items()):
+            self.detach(domain_name)
+
+    def resolve(self, domain_name=None, resource_id=None):
+        """
+        the (attached) schema for a domain or for the domain of a resource"""
+        if domain_name is None:
+            domain_name = self.domain_of(resource_id)
+        return self.attach(domain_name)
+
+    def table(self, resource_id):
+        """
+        the quoted schema.table of a resource's dataset table, for use in SQL text"""
+        return "%s.%s" % (_quote(self.resolve(resource_id=resource_id)), _quote(resource_id))
+
+    def fan_out(
+        self,
+        query,
+        domains=None,
+        resource_ids=None,
+        params=(),
+        key=None,
+        limit=None,
+        max_workers=None,
+    ):
+        """
+        run query on each shard and merge the rows, each prefixed with its domain. The
+        query runs against the shard as main with rule4 attached as socrata, and
+        {resource_id} in it is filled in for each of resource_ids (which picks the shards)
+        otherwise it is run once on each of domains (default all the shards).
+        With key the query must return its rows ordered by key and the results are merged
+        in that order, otherwise they come in shard order; limit applies to the merged rows"""
+        if resource_ids is not None:
+            jobs = [
+                (self.domain_of(r), query.format(resource_id=r.replace('"', '""')))
+                for r in resource_ids
+            ]
+        else:
+            jobs = [(d, query) for d in (domains if domains is not None else self.domains())]
+        jobs = [(d, q) for d, q in jobs if os.path.exists(self.path(d))]
+
+        def run(job):
+            d, q = job
+            return [(d,) + tuple(r) for r in _query_shard(self.path(d), self.rule4, q, params)]
+
+        if self.threadsafe and len(jobs) > 1:
+            # SQLite releases the GIL while stepping so the shards are queried in parallel
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(run, jobs))
+        else:
+            results = [run(job) for job in jobs]
+        if key is not None:
+            rows = heapq.merge(*results, key=lambda r: key(r[1:]))
+        else:
+            rows = (r for result in results for r in result)
+        out = []
+        for r in rows:
+            if limit is not None and len(out) >= limit:
+                break
+            out.append(r)
+        return out
+
+    def run_parallel(self, f, domains=None, args=(), max_workers=None):
+        """
+        {domain: f(domain, shard path, *args)} on a process pool. Each call has its shard to
+        itself so the shards load (or vacuum) in parallel without contending for a lock. f must
+        be a module level function. The shards are detached here first"""
+        domains = domains if domains is not None else self.domains()
+        self.S.commit()
+        for d in domains:
+            self.detach(d)
+        results = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = dict((pool.submit(f, d, self.path(d), *args), d) for d in domains)
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def vacuum(self, domains=None, max_workers=None):
+        """
+        VACUUM the shards in parallel. Returns {domain: change in bytes}"""
+        results = self.run_parallel(vacuum_shard, domains, max_workers=max_workers)
+        log.info("Done vacuuming shards", shards=len(results), saved=-sum(results.values()))
+        return results
+
+    def rebuild(self, domain_name, build, args=()):
+        """
+        rebuild one domain's shard without touching the others: build(domain, path, *args)
+        writes a complete new shard to a side file which then replaces the old one. The
+        old shard is checkpointed first so that no -wal of it is left behind to be applied
+        to the new file; that fails (database is locked) if it is still open elsewhere"""
+        path = self.path(domain_name)
+        side = path + ".rebuild"
+        for p in (side, side + "-wal", side + "-shm", side + "-journal"):
+            if os.path.exists(p):
+                os.remove(p)
+        result = build(domain_name, side, *args)
+        _finish(side)
+
+        was_attached = shard_schema(domain_name) in self.attached
+        self.S.commit()
+        self.detach(domain_name)
+        if os.path.exists(path):
+            _finish(path)
+        os.replace(side, path)
+        if was_attached:
+            self.attach(domain_name)
+        log.info("Done rebuilding shard", domain=domain_name, path=path)
+        return result
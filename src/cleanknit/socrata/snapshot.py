@@ -0,0 +1,425 @@
+import json
+import os
+import shutil
+from collections import defaultdict
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from sqlalchemy.types import Boolean, Date, DateTime, Float, Integer, Numeric
+
+from ..instrument import stage
+from ..munge import reflect_schema
+from .model import log
+
+# Columnar snapshots of loaded datasets for the numeric-heavy passes (PLUTO, rolling sales)
+# where going through SQLite a row at a time, and building a tuple per row in Python, costs
+# far more than the arithmetic. A snapshot is a directory per table:
+#
+#   <directory>/<table>/manifest.json    the columns, their kinds and where they came from
+#   <directory>/<table>/<n>.npy          the values: int64, float64, datetime64 or bool, or the
+#                                        int32 codes into the (sorted) dictionary for strings
+#   <directory>/<table>/<n>.valid.npy    the null bitmap, packed 8 rows to a byte
+#   <directory>/<table>/<n>.dictionary.json
+#
+# The .npy files are opened with mmap so the arrays handed out are views of the page cache
+# rather than copies. The column kinds come from the Socrata data types in
+# rule4 resource_column (via reflect_schema), falling back on the SQLite declared type.
+#
+# A snapshot records the size and mtime of the database file (and its -wal file, as a write
+# in WAL mode does not touch the database file until a checkpoint) and of the source export if
+# there was one. Any change to those makes it stale. That is conservative, a write to any table
+# in the database invalidates all the snapshots of it, but it can be checked without SQLite.
+# xref https://numpy.org/doc/stable/reference/generated/numpy.lib.format.open_memmap.html
+
+_manifest = "manifest.json"
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _sources(database, source_path):
+    """
+    what the snapshot depends on, from the file system alone"""
+    sources = {}
+    if database:
+        sources[database] = _stat(database)
+        sources[database + "-wal"] = _stat(database + "-wal")
+    if source_path:
+        sources[source_path] = _stat(source_path)
+    return sources
+
+
+def _kind(type_):
+    if isinstance(type_, Boolean):
+        return "bool"
+    if isinstance(type_, Integer):
+        # Socrata "Number", which may turn out to be float64 (see write_snapshot)
+        return "int64"
+    if isinstance(type_, (Float, Numeric)):
+        return "float64"
+    if isinstance(type_, DateTime):
+        return "datetime64[us]"
+    if isinstance(type_, Date):
+        return "datetime64[D]"
+    return "string"
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _int_batch(values):
+    valid = np.array([type(v) is int for v in values], dtype=bool)
+    try:
+        data = np.array([0 if v is None else v for v in values], dtype=np.int64)
+    except (TypeError, ValueError):
+        # the loaders keep anything that does not convert as text
+        data = np.array([v if type(v) is int else 0 for v in values], dtype=np.int64)
+    return data, valid
+
+
+def _float_batch(values):
+    try:
+        # None comes out as nan
+        data = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        data = np.array([v if type(v) in (int, float) else np.nan for v in values], np.float64)
+    return data, ~np.isnan(data)
+
+
+def _datetime_batch(values, dtype):
+    strings = [v if isinstance(v, str) else "NaT" for v in values]
+    try:
+        data = np.array(strings, dtype=dtype)
+    except ValueError:
+        # the loaders keep anything that does not parse as text so go one at a time
+        data = np.empty(len(strings), dtype=dtype)
+        for i, v in enumerate(strings):
+            try:
+                data[i] = np.datetime64(v)
+            except ValueError:
+                data[i] = np.datetime64("NaT")
+    return data, ~np.isnat(data)
+
+
+def _bool_batch(values):
+    valid = np.array([v is not None for v in values], dtype=bool)
+    return np.array([bool(v) for v in values], dtype=bool), valid
+
+
+def _dictionary():
+    # value -> code in order of first appearance, the lookups of values already seen (almost
+    # all of them) stay in C through map(d.__getitem__, ...). NULL gets a code like any other
+    # value and is taken out again by _sorted_dictionary
+    d = defaultdict(lambda: len(d))
+    return d
+
+
+def _string_batch(values, dictionary):
+    codes = np.fromiter(map(dictionary.__getitem__, values), dtype=np.int32, count=len(values))
+    null = dictionary.get(None, None)
+    valid = codes != null if null is not None else np.ones(len(values), dtype=bool)
+    return codes, valid
+
+
+def _sorted_dictionary(dictionary):
+    """
+    the sorted strings and the array mapping the codes of first appearance onto them. Values
+    that were not strings in SQLite are taken as their str()"""
+    # the keys are in the order they were added so the position of a key is its code
+    keys = [v if isinstance(v, str) or v is None else str(v) for v in dictionary]
+    words = sorted(set(keys).difference((None,)))
+    position = dict(zip(words, range(len(words))))
+    position[None] = 0
+    remap = np.fromiter(map(position.__getitem__, keys), dtype=np.int32, count=len(keys))
+    return words, remap
+
+
+def _database_file(S, schema):
+    for _, name, path in S.execute("PRAGMA database_list"):
+        if name == schema:
+            return path or None
+    raise ValueError("no such schema %r" % schema)
+
+
+def write_snapshot(S, table, directory, schema="main", source_path=None, batch_size=50000):
+    """
+    write a columnar snapshot of schema.table under directory/table, replacing any earlier
+    one. source_path is the export the table was loaded from, if any, which the snapshot
+    then also depends on. Returns the Snapshot"""
+    # only read, and only end the transaction here if it was this that started it
+    owned = not S.in_transaction()
+    database = _database_file(S, schema)
+    t = reflect_schema(S, schema).tables.get("%s.%s" % (schema, table), None)
+    if t is None:
+        raise ValueError("no such table %s.%s" % (schema, table))
+    columns = [(c.name, _kind(c.type)) for c in t.columns]
+    source = "%s.%s" % (_quote(schema), _quote(table))
+
+    # one pass to size the arrays and to find out which of the Number columns have any
+    # non-integer values in them
+    terms = ["count(*)"] + [
+        "sum(typeof(%s) = 'real')" % _quote(name) for name, kind in columns if kind == "int64"
+    ]
+    counts = list(S.execute("SELECT %s FROM %s" % (", ".join(terms), source)).first())
+    n_rows = counts.pop(0)
+    columns = [
+        (name, "float64" if kind == "int64" and counts.pop(0) else kind)
+        for name, kind in columns
+    ]
+
+    final = os.path.join(directory, table)
+    path = final + ".tmp-%d" % os.getpid()
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    with stage("snapshot", table=table, rows=n_rows):
+        # the rowid is kept so that results can be joined back to the table
+        rowids = open_memmap(os.path.join(path, "rowid.npy"), "w+", np.int64, (n_rows,))
+        arrays, valids, dictionaries = [], [], []
+        for i, (name, kind) in enumerate(columns):
+            dtype = np.int32 if kind == "string" else np.dtype(kind)
+            arrays.append(open_memmap(os.path.join(path, "%d.npy" % i), "w+", dtype, (n_rows,)))
+            valids.append(np.zeros(n_rows, dtype=bool))
+            dictionaries.append(_dictionary() if kind == "string" else None)
+
+        q = "SELECT rowid, %s FROM %s ORDER BY rowid" % (
+            ", ".join(_quote(name) for name, _ in columns),
+            source,
+        )
+        result = S.connection().exec_driver_sql(q)
+        offset = 0
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            # the table may have grown since it was counted
+            rows = rows[: n_rows - offset]
+            n = len(rows)
+            values = list(zip(*rows))
+            rowids[offset : offset + n] = values[0]
+            for i, (name, kind) in enumerate(columns):
+                v = values[i + 1]
+                if kind == "int64":
+                    data, valid = _int_batch(v)
+                elif kind == "float64":
+                    data, valid = _float_batch(v)
+                elif kind == "bool":
+                    data, valid = _bool_batch(v)
+                elif kind == "string":
+                    data, valid = _string_batch(v, dictionaries[i])
+                else:
+                    data, valid = _datetime_batch(v, kind)
+                arrays[i][offset : offset + n] = data
+                valids[i][offset : offset + n] = valid
+            offset += n
+            if offset >= n_rows:
+                break
+        result.close()
+        if owned:
+            S.rollback()
+
+        manifest_columns = []
+        for i, (name, kind) in enumerate(columns):
+            if kind == "string":
+                # sorted so that the order of the codes is the order of the strings
+                words, remap = _sorted_dictionary(dictionaries[i])
+                if len(remap):
+                    arrays[i][:] = remap[arrays[i]]
+                with open(os.path.join(path, "%d.dictionary.json" % i), "w") as fp:
+                    # dumps rather than dump, which does not use the C encoder
+                    fp.write(json.dumps(words))
+            arrays[i].flush()
+            np.save(os.path.join(path, "%d.valid.npy" % i), np.packbits(valids[i]))
+            manifest_columns.append(
+                dict(name=name, kind=kind, nulls=int(n_rows - valids[i].sum()))
+            )
+        rowids.flush()
+        del arrays, rowids
+
+        with open(os.path.join(path, _manifest), "w") as fp:
+            json.dump(
+                dict(
+                    table=table,
+                    schema=schema,
+                    rows=n_rows,
+                    columns=manifest_columns,
+                    sources=_sources(database, source_path),
+                ),
+                fp,
+                indent=2,
+            )
+        shutil.rmtree(final, ignore_errors=True)
+        os.rename(path, final)
+    log.info("Done writing snapshot", table=table, rows=n_rows, path=final)
+    return Snapshot(final)
+
+
+def open_snapshot(directory, table):
+    """
+    the Snapshot of table under directory, or None if there is none or it is stale"""
+    path = os.path.join(directory, table)
+    if not os.path.exists(os.path.join(path, _manifest)):
+        return None
+    s = Snapshot(path)
+    return None if s.is_stale() else s
+
+
+def snapshot(S, table, directory, schema="main", source_path=None):
+    """
+    the cache stage: the Snapshot of schema.table, (re)written if it is missing or stale"""
+    s = open_snapshot(directory, table)
+    if s is not None and s.schema == schema:
+        return s
+    return write_snapshot(S, table, directory, schema, source_path)
+
+
+class Snapshot:
+    """
+    read-only access to a snapshot. Column values come back as memory-mapped views (codes
+    for strings) which numpy can filter and aggregate without copying the whole column in"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _manifest)) as fp:
+            self.manifest = json.load(fp)
+        self.table = self.manifest["table"]
+        self.schema = self.manifest["schema"]
+        self.n_rows = self.manifest["rows"]
+        self.columns = [c["name"] for c in self.manifest["columns"]]
+        self._index = dict((c["name"], i) for i, c in enumerate(self.manifest["columns"]))
+        self._cache = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def is_stale(self):
+        # nothing to go on for a snapshot of an in-memory database
+        if not self.manifest["sources"]:
+            return True
+        return any(_stat(p) != st for p, st in self.manifest["sources"].items())
+
+    def kind(self, name):
+        return self.manifest["columns"][self._index[name]]["kind"]
+
+    def _load(self, key, f):
+        v = self._cache.get(key, None)
+        if v is None:
+            v = self._cache[key] = f()
+        return v
+
+    @property
+    def rowid(self):
+        return self._load(
+            "rowid", lambda: np.load(os.path.join(self.path, "rowid.npy"), mmap_mode="r")
+        )
+
+    def __getitem__(self, name):
+        i = self._index[name]
+        return self._load(
+            ("values", i), lambda: np.load(os.path.join(self.path, "%d.npy" % i), mmap_mode="r")
+        )
+
+    def valid(self, name):
+        """
+        the bool array that is False where the value is NULL (or did not convert)"""
+        i = self._index[name]
+
+        def unpack():
+            packed = np.load(os.path.join(self.path, "%d.valid.npy" % i))
+            return np.unpackbits(packed, count=self.n_rows).view(bool)
+
+        return self._load(("valid", i), unpack)
+
+    def dictionary(self, name):
+        i = self._index[name]
+
+        def read():
+            with open(os.path.join(self.path, "%d.dictionary.json" % i)) as fp:
+                return np.array(json.load(fp), dtype=object)
+
+        return self._load(("dictionary", i), read)
+
+    def code(self, name, value):
+        """
+        the code of value in a string column, or -1 if it does not occur"""
+        words = self.dictionary(name)
+        i = int(np.searchsorted(words, value)) if len(words) else 0
+        return i if i < len(words) and words[i] == value else -1
+
+    def eq(self, name, value):
+        if self.kind(name) == "string":
+            value = self.code(name, value)
+        return (self[name] == value) & self.valid(name)
+
+    def isin(self, name, values):
+        if self.kind(name) == "string":
+            values = [self.code(name, v) for v in values]
+        return np.isin(self[name], values) & self.valid(name)
+
+    def between(self, name, low, high):
+        """
+        low <= value <= high. For a string column the comparison is of the strings"""
+        v = self[name]
+        if self.kind(name) == "string":
+            words = self.dictionary(name)
+            low = np.searchsorted(words, low, side="left")
+            high = np.searchsorted(words, high, side="right") - 1
+        elif self.kind(name).startswith("datetime64"):
+            low, high = np.datetime64(low), np.datetime64(high)
+        return (v >= low) & (v <= high) & self.valid(name)
+
+    def decode(self, name, mask=None):
+        """
+        the values of a string column as Python strings (None for NULL)"""
+        codes, valid = self[name], self.valid(name)
+        if mask is not None:
+            codes, valid = codes[mask], valid[mask]
+        words = self.dictionary(name)
+        out = words[codes] if len(words) else np.empty(len(codes), dtype=object)
+        out[~valid] = None
+        return out
+
+    def group_by(self, key, value=None, how="count", mask=None):
+        """
+        {key: aggregate} over the rows in mask (default all) where neither the key nor the
+        value is NULL. how is count, sum, mean, min or max"""
+        if how not in ("count", "sum", "mean", "min", "max"):
+            raise ValueError("unknown aggregate %r" % how)
+        keep = self.valid(key).copy()
+        if mask is not None:
+            keep &= mask
+        if value is not None:
+            keep &= self.valid(value)
+        k = self[key][keep]
+        if self.kind(key) == "string":
+            labels = self.dictionary(key)
+            groups = k
+        else:
+            labels, groups = np.unique(k, return_inverse=True)
+        size = len(labels)
+        counts = np.bincount(groups, minlength=size)
+        if how == "count":
+            out = counts
+        else:
+            if value is None:
+                raise ValueError("%s needs a value column" % how)
+            v = self[value][keep].astype(np.float64)
+            if how in ("sum", "mean"):
+                out = np.bincount(groups, weights=v, minlength=size)
+                if how == "mean":
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        out = out / counts
+            else:
+                out = np.full(size, np.inf if how == "min" else -np.inf)
+                (np.minimum if how == "min" else np.maximum).at(out, groups, v)
+        return dict((_scalar(labels[i]), _scalar(out[i])) for i in np.nonzero(counts)[0])
+
+
+def _scalar(v):
+    # numpy scalars to the Python equivalent, the dictionary strings already are
+    return v.item() if isinstance(v, np.generic) else v
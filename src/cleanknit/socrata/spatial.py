@@ -0,0 +1,212 @@
+import json
+from functools import lru_cache
+
+from .geometry import contains_point, intersects, parse_geometry
+from .model import log
+
+# Spatial indexing of the geometry (GeoJSON text, see geometry.py) columns of the loaded
+# datasets with SQLite's R*Tree rather than SpatiaLite. Each indexed column gets a companion
+# rtree virtual table <table>__<column>__rtree in the same schema holding the bounding box of
+# the geometry in each row keyed by the rowid. A spatial join then probes the R*Tree with each
+# row on the one side and only runs the exact test (a Python function registered with SQLite)
+# on the handful of candidates whose boxes overlap, instead of on every pair of rows.
+#
+#   create_spatial_index(S, "uf4q-4a3h", "the_geom")  # address points
+#   create_spatial_index(S, "64uk-42ks", "the_geom")  # PLUTO tax lots
+#   spatial_join(S, "uf4q-4a3h", "the_geom", "64uk-42ks", "the_geom", into="address_lot")
+#
+# The rowids of a table without an INTEGER PRIMARY KEY (which is how load_delimited creates
+# them) may change on VACUUM so the R*Tree has to be rebuilt after one.
+# xref https://www.sqlite.org/rtree.html
+# xref https://www.sqlite.org/lang_vacuum.html
+
+predicates = ("contains", "intersects", "bbox")
+
+
+def spatial_index_name(table, column):
+    return "%s__%s__rtree" % (table, column)
+
+
+def _qualified(name, schema):
+    return '"%s"."%s"' % (schema, name) if schema else '"%s"' % name
+
+
+# set based: every number in the coordinates is the x (key 0) or y (key 1, and any z or m is
+# ignored) of a position, whatever the nesting
+_index_rows = """
+INSERT INTO %(rtree)s (id, minx, maxx, miny, maxy)
+SELECT t.rowid,
+    min(CASE j.key WHEN 0 THEN j.atom END),
+    max(CASE j.key WHEN 0 THEN j.atom END),
+    min(CASE j.key WHEN 1 THEN j.atom END),
+    max(CASE j.key WHEN 1 THEN j.atom END)
+FROM %(table)s AS t, json_tree(t."%(column)s", '$.coordinates') AS j
+WHERE json_valid(t."%(column)s") AND j.type IN ('integer', 'real')%(rowids)s
+GROUP BY t.rowid
+"""
+
+
+def create_spatial_index(S, table, column, schema=None):
+    """
+    (re)create the R*Tree of the bounding boxes of table.column in the caller's transaction.
+    Rows whose value is not GeoJSON are left out. Returns the number of rows indexed."""
+    rtree = _qualified(spatial_index_name(table, column), schema)
+    conn = S.connection()
+    conn.exec_driver_sql("DROP TABLE IF EXISTS %s" % rtree)
+    conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE %s USING rtree(id, minx, maxx, miny, maxy)" % rtree
+    )
+    n = conn.exec_driver_sql(
+        _index_rows % dict(rtree=rtree, table=_qualified(table, schema), column=column, rowids="")
+    ).rowcount
+    log.info("Done creating spatial index", table=table, column=column, rows=n)
+    return n
+
+
+def has_spatial_index(S, table, column, schema=None):
+    master = _qualified("sqlite_master", schema)
+    return (
+        S.connection()
+        .exec_driver_sql(
+            "SELECT 1 FROM %s WHERE name = ?" % master, (spatial_index_name(table, column),)
+        )
+        .first()
+        is not None
+    )
+
+
+def refresh_spatial_index(S, table, column, rowids, schema=None):
+    """
+    bring the R*Tree up to date for the given rowids of table, which have been inserted,
+    updated or deleted, in the caller's transaction"""
+    if not rowids:
+        return 0
+    rtree = _qualified(spatial_index_name(table, column), schema)
+    ids = json.dumps(list(rowids))
+    conn = S.connection()
+    conn.exec_driver_sql(
+        "DELETE FROM %s WHERE id IN (SELECT value FROM json_each(?))" % rtree, (ids,)
+    )
+    return conn.exec_driver_sql(
+        _index_rows
+        % dict(
+            rtree=rtree,
+            table=_qualified(table, schema),
+            column=column,
+            rowids=" AND t.rowid IN (SELECT value FROM json_each(?))",
+        ),
+        (ids,),
+    ).rowcount
+
+
+# The same few polygons are tested against many points so the parsed geometry is cached by
+# the GeoJSON text rather than parsed on every call.
+@lru_cache(maxsize=4096)
+def _parsed(value):
+    g = parse_geometry(value)
+    return None if g is None else dict(type=g[0], coordinates=g[1])
+
+
+def _geom_contains_point(value, x, y):
+    try:
+        return contains_point(_parsed(value), x, y)
+    except (TypeError, ValueError):
+        return None
+
+
+def _geom_intersects(a, b):
+    try:
+        return intersects(_parsed(a), _parsed(b))
+    except (TypeError, ValueError):
+        return None
+
+
+def register_functions(dbapi_connection):
+    """
+    register geom_contains_point(polygon, x, y) and geom_intersects(a, b) with a SQLite
+    connection. Both are NULL for values that are not geometry"""
+    dbapi_connection.create_function(
+        "geom_contains_point", 3, _geom_contains_point, deterministic=True
+    )
+    dbapi_connection.create_function("geom_intersects", 2, _geom_intersects, deterministic=True)
+
+
+def spatial_join_query(
+    left, left_column, right, right_column, schema=None, predicate="contains"
+):
+    """
+    the SELECT of (left_rowid, right_rowid) pairs for spatial_join. contains is the rows on
+    the right (polygons) that contain the points on the left and needs the R*Tree of the right
+    column; intersects and bbox need the R*Trees of both columns"""
+    if predicate not in predicates:
+        raise ValueError("predicate must be one of %s" % ", ".join(predicates))
+    d = dict(
+        left=_qualified(left, schema),
+        right=_qualified(right, schema),
+        left_column=left_column,
+        right_column=right_column,
+        left_rtree=_qualified(spatial_index_name(left, left_column), schema),
+        right_rtree=_qualified(spatial_index_name(right, right_column), schema),
+    )
+    if predicate == "contains":
+        # the point is taken from the GeoJSON rather than the left R*Tree (if there is one)
+        # as the R*Tree coordinates are rounded out to 32 bit floats
+        return (
+            """
+SELECT l.rowid AS left_rowid, r.rowid AS right_rowid
+FROM %(left)s AS l
+JOIN %(right_rtree)s AS b
+    ON b.minx <= json_extract(l."%(left_column)s", '$.coordinates[0]')
+    AND b.maxx >= json_extract(l."%(left_column)s", '$.coordinates[0]')
+    AND b.miny <= json_extract(l."%(left_column)s", '$.coordinates[1]')
+    AND b.maxy >= json_extract(l."%(left_column)s", '$.coordinates[1]')
+JOIN %(right)s AS r ON r.rowid = b.id
+WHERE json_valid(l."%(left_column)s")
+    AND json_extract(l."%(left_column)s", '$.type') = 'Point'
+    AND geom_contains_point(
+        r."%(right_column)s",
+        json_extract(l."%(left_column)s", '$.coordinates[0]'),
+        json_extract(l."%(left_column)s", '$.coordinates[1]'))
+"""
+            % d
+        )
+    q = (
+        """
+SELECT a.id AS left_rowid, b.id AS right_rowid
+FROM %(left_rtree)s AS a
+JOIN %(right_rtree)s AS b
+    ON b.minx <= a.maxx AND b.maxx >= a.minx AND b.miny <= a.maxy AND b.maxy >= a.miny
+"""
+        % d
+    )
+    if predicate == "intersects":
+        q += (
+            """JOIN %(left)s AS l ON l.rowid = a.id
+JOIN %(right)s AS r ON r.rowid = b.id
+WHERE geom_intersects(l."%(left_column)s", r."%(right_column)s")
+"""
+            % d
+        )
+    return q
+
+
+def spatial_join(
+    S, left, left_column, right, right_column, schema=None, predicate="contains", into=None
+):
+    """
+    the (left_rowid, right_rowid) pairs of rows whose geometries satisfy predicate (see
+    spatial_join_query), filtered by bounding box through the R*Tree before the exact test.
+    Returns the rows, or with into creates (replacing) that table of pairs in schema and
+    returns the number of pairs, which keeps a million point join out of Python."""
+    conn = S.connection()
+    # the exact tests run on the Session's own DBAPI connection
+    register_functions(conn.connection)
+    q = spatial_join_query(left, left_column, right, right_column, schema, predicate)
+    if into is None:
+        return conn.exec_driver_sql(q).fetchall()
+    into = _qualified(into, schema)
+    conn.exec_driver_sql("DROP TABLE IF EXISTS %s" % into)
+    conn.exec_driver_sql("CREATE TABLE %s (left_rowid INTEGER, right_rowid INTEGER)" % into)
+    n = conn.exec_driver_sql("INSERT INTO %s (left_rowid, right_rowid) %s" % (into, q)).rowcount
+    log.info("Done spatial join", left=left, right=right, predicate=predicate, pairs=n)
+    return n
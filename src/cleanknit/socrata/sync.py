@@ -0,0 +1,501 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, Table, sql
+from sqlalchemy.types import Text
+
+from .dataset import _converter, _to_geojson
+from .download import Downloader, _parse_socrata_timestamp
+from .geometry import Geometry
+from .model import _type_map, log, resource, resource_column, sa_column_for
+from .spatial import (
+    _qualified,
+    create_spatial_index,
+    has_spatial_index,
+    refresh_spatial_index,
+)
+from ..munge import upsert_tuples
+from ..querycache import invalidate_session
+
+# Row-level sync of the loaded datasets from the SODA API instead of downloading the whole
+# rows.csv export again. Every SODA row has the system fields :id (stable for the life of the
+# row) and :updated_at, which the tables here keep as the ":id" and ":updated_at" columns with
+# a unique index on ":id". A sync asks for the rows changed since the high-water mark
+#   $where=:updated_at > 'mark' OR (:updated_at = 'mark' AND :id > 'last id')
+#   $order=:updated_at, :id
+# a page at a time (keyset rather than $offset paging, a bulk update gives thousands of rows
+# the same :updated_at) and upserts them by ":id". Each page is applied and the mark moved on
+# in the one transaction, in sync_state in the same database as the table, so an interrupted
+# sync resumes from the last page applied.
+#
+# SODA leaves deleted rows out rather than flagging them. They are found by comparing
+# count(*) over ranges of :id with the local table and only bisecting the ranges that differ,
+# down to a few hundred ids that are looked up with :id IN (...). Nothing changed is a single
+# count; d deletions cost about d log(n) counts.
+#
+# The first sync of a table has to pull every row as a rows.csv export has no :id to match the
+# changes to. A table loaded from one by load_delimited gets the two columns added and its rows
+# replaced, and one that has not been loaded at all is created from resource_column.
+#
+#   sync_datasets(S, ["erm2-nwe9", "64uk-42ks"], schema="datasets")
+#   sync_datasets(S, resource_ids, router=ShardRouter(S, "shards"))
+#   sync_datasets(S, resource_ids, soda_url="http://localhost:8080/{domain}/{resource_id}.json")
+# xref https://dev.socrata.com/docs/system-fields.html
+# xref https://dev.socrata.com/docs/paging.html
+# xref https://dev.socrata.com/docs/queries/
+
+id_column = ":id"
+updated_column = ":updated_at"
+page_size = 5000
+# bisect the ranges of :id down to this many rows before asking for the ids themselves
+leaf_size = 200
+# seconds re-read before the high-water mark, for rows committed late with an earlier stamp
+lookback = 300
+
+sync_state = Table(
+    "sync_state",
+    MetaData(),
+    Column("resource_id", Text, primary_key=True),
+    Column("domain", Text, nullable=False),
+    # the :updated_at and :id of the last row applied
+    Column("high_water_mark", Text),
+    Column("last_id", Text),
+    # the first, full, pull is complete
+    Column("seeded", Boolean, nullable=False),
+    Column("synced_at", DateTime),
+    Column("upserted", Integer, nullable=False),
+    Column("deleted", Integer, nullable=False),
+)
+
+
+def _state_table(S, schema):
+    table = sync_state.to_metadata(MetaData(), schema=schema)
+    table.create(bind=S.connection(), checkfirst=True)
+    return table
+
+
+def _literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def _after(mark, last_id):
+    """
+    the SoQL $where for the rows after (mark, last_id) in (:updated_at, :id) order"""
+    if mark is None:
+        return None
+    return "{u} > {m} OR ({u} = {m} AND {i} > {l})".format(
+        u=updated_column, m=_literal(mark), i=id_column, l=_literal(last_id or "")
+    )
+
+
+def _id_range(lo, hi, column=id_column):
+    """
+    lo <= :id < hi, in SoQL or with column the SQLite quoted name"""
+    clauses = ["%s IS NOT NULL" % column]
+    if lo is not None:
+        clauses.append("%s >= %s" % (column, _literal(lo)))
+    if hi is not None:
+        clauses.append("%s < %s" % (column, _literal(hi)))
+    return " AND ".join(clauses)
+
+
+def _rewind(mark, seconds):
+    t = _parse_socrata_timestamp(mark) - timedelta(seconds=seconds)
+    return t.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (t.microsecond // 1000)
+
+
+def _soda_value(v, conv):
+    """
+    a value from the SODA JSON as load_delimited would have stored it from the CSV"""
+    if v is None or v == "":
+        return None
+    if isinstance(v, dict):
+        if "latitude" in v and "longitude" in v:
+            # the legacy Location type
+            v = dict(type="Point", coordinates=[float(v["longitude"]), float(v["latitude"])])
+        g = _to_geojson(v)
+        return json.dumps(v, separators=(",", ":")) if isinstance(g, dict) else g
+    if isinstance(v, list):
+        return json.dumps(v, separators=(",", ":"))
+    if isinstance(v, bool):
+        # Checkbox, as it is in rows.csv
+        return "true" if v else "false"
+    if conv is None or not isinstance(v, str):
+        return v
+    return conv(v)
+
+
+class _Job:
+    __slots__ = (
+        "resource_id",
+        "domain",
+        "schema",
+        "table",
+        "converters",
+        "geometry",
+        "state",
+        "unknown",
+        "upserted",
+        "deleted",
+    )
+
+
+class DatasetSync:
+    """
+    sync loaded datasets through a Downloader. The tables are in schema, or in the shards of
+    router. Several resources can be synced at once on the one Session: each page is
+    applied and committed between requests so no transaction is ever open across an await"""
+
+    def __init__(
+        self,
+        S,
+        downloader,
+        schema=None,
+        router=None,
+        page_size=page_size,
+        leaf_size=leaf_size,
+        lookback=lookback,
+        spatial_index=True,
+    ):
+        self.S = S
+        self.downloader = downloader
+        self.schema = schema
+        self.router = router
+        self.page_size = page_size
+        self.leaf_size = leaf_size
+        self.lookback = lookback
+        self.spatial_index = spatial_index
+
+    def _resolve(self, job):
+        # the LRU pool may have detached the shard while another resource was being synced
+        if self.router is not None:
+            job.schema = self.router.resolve(domain_name=job.domain)
+        return job.schema
+
+    def _domain(self, resource_id):
+        if self.router is not None:
+            return self.router.domain_of(resource_id)
+        d = self.S.execute(
+            sql.select(resource.c.domain).where(resource.c.resource_id == resource_id)
+        ).scalar()
+        if d is None:
+            raise KeyError("unknown resource %s" % resource_id)
+        return d
+
+    def _column_names(self, resource_id, schema):
+        pragma = 'PRAGMA "%s".table_info' % schema if schema else "PRAGMA table_info"
+        rows = self.S.connection().exec_driver_sql('%s("%s")' % (pragma, resource_id))
+        return [r[1] for r in rows]
+
+    def _commit(self, f, *args):
+        try:
+            result = f(*args)
+            self.S.commit()
+            return result
+        except:
+            self.S.rollback()
+            raise
+
+    def _prepare(self, job):
+        schema = self._resolve(job)
+        resource_id = job.resource_id
+        conn = self.S.connection()
+        state_table = _state_table(self.S, schema)
+        state = (
+            self.S.execute(
+                sql.select(state_table).where(state_table.c.resource_id == resource_id)
+            )
+            .mappings()
+            .first()
+        )
+        catalog = self.S.execute(
+            sql.select(
+                resource_column.c.field_name,
+                resource_column.c.data_type,
+                resource_column.c.description,
+            )
+            .where(resource_column.c.resource_id == resource_id)
+            .order_by(resource_column.c.field_number)
+        ).fetchall()
+        names = self._column_names(resource_id, schema)
+        table = _qualified(resource_id, schema)
+        if not names:
+            Table(
+                resource_id,
+                MetaData(),
+                *[sa_column_for(*c) for c in catalog],
+                Column(id_column, Text),
+                Column(updated_column, Text),
+                schema=schema,
+            ).create(bind=conn)
+            state = None
+        elif id_column not in names:
+            # loaded from a rows.csv export
+            for c in (id_column, updated_column):
+                conn.exec_driver_sql('ALTER TABLE %s ADD COLUMN "%s" TEXT' % (table, c))
+            conn.exec_driver_sql("DELETE FROM %s" % table)
+            state = None
+        if state is None:
+            # the columns a rows.csv header didn't give, or added to the dataset since
+            names = self._column_names(resource_id, schema)
+            for c in catalog:
+                if c.field_name not in names:
+                    type_ = sa_column_for(*c).type.compile(dialect=self.S.bind.dialect)
+                    conn.exec_driver_sql(
+                        'ALTER TABLE %s ADD COLUMN "%s" %s' % (table, c.field_name, type_)
+                    )
+        conn.exec_driver_sql(
+            'CREATE UNIQUE INDEX IF NOT EXISTS %s ON "%s" ("%s")'
+            % (_qualified("ux_%s_id" % resource_id, schema), resource_id, id_column)
+        )
+        if state is None:
+            state = dict(
+                resource_id=resource_id,
+                domain=job.domain,
+                high_water_mark=None,
+                last_id=None,
+                seeded=False,
+                synced_at=None,
+                upserted=0,
+                deleted=0,
+            )
+            self.S.execute(state_table.delete().where(state_table.c.resource_id == resource_id))
+            self.S.execute(state_table.insert().values(**state))
+        job.state = dict(state)
+
+        names = self._column_names(resource_id, schema)
+        types = dict((c.field_name, _type_map.get(c.data_type, Text)) for c in catalog)
+        job.table = Table(resource_id, MetaData(), *[Column(n) for n in names], schema=schema)
+        job.converters = [_converter(types[n]) if n in types else None for n in names]
+        job.geometry = [n for n in names if n in types and issubclass(types[n], Geometry)]
+
+    def _rowids(self, job, ids):
+        return [
+            r[0]
+            for r in self.S.connection().exec_driver_sql(
+                'SELECT rowid FROM %s WHERE "%s" IN (SELECT value FROM json_each(?))'
+                % (_qualified(job.resource_id, job.schema), id_column),
+                (json.dumps(ids),),
+            )
+        ]
+
+    def _refresh_spatial(self, job, rowids):
+        for c in job.geometry:
+            if has_spatial_index(self.S, job.resource_id, c, job.schema):
+                refresh_spatial_index(self.S, job.resource_id, c, rowids, job.schema)
+
+    def _save_state(self, job, **values):
+        state_table = sync_state.to_metadata(MetaData(), schema=job.schema)
+        job.state.update(values, synced_at=datetime.now())
+        self.S.execute(
+            state_table.update()
+            .where(state_table.c.resource_id == job.resource_id)
+            .values(**job.state)
+        )
+
+    def _apply(self, job, rows):
+        self._resolve(job)
+        names = [c.name for c in job.table.columns]
+        unknown = set(k for r in rows for k in r) - set(names) - job.unknown
+        if unknown:
+            # columns added to the dataset since the table was made
+            log.warning(
+                "columns not in the table", resource_id=job.resource_id, columns=sorted(unknown)
+            )
+            job.unknown |= unknown
+        upsert_tuples(
+            self.S,
+            job.table,
+            [tuple(_soda_value(r.get(n), c) for n, c in zip(names, job.converters)) for r in rows],
+            id_column,
+        )
+        if job.state["seeded"]:
+            self._refresh_spatial(job, self._rowids(job, [r[id_column] for r in rows]))
+        job.upserted += len(rows)
+        values = dict(upserted=job.state["upserted"] + len(rows))
+        last = (rows[-1][updated_column], rows[-1][id_column])
+        # the rows re-read for the lookback don't move the mark back
+        if job.state["high_water_mark"] is None or last > (
+            job.state["high_water_mark"],
+            job.state["last_id"],
+        ):
+            values.update(high_water_mark=last[0], last_id=last[1])
+        self._save_state(job, **values)
+
+    def _seeded(self, job):
+        self._resolve(job)
+        if self.spatial_index:
+            for c in job.geometry:
+                create_spatial_index(self.S, job.resource_id, c, job.schema)
+        self._save_state(job, seeded=True)
+
+    async def _pull(self, job):
+        mark, last_id = job.state["high_water_mark"], job.state["last_id"]
+        if job.state["seeded"] and mark is not None and self.lookback:
+            mark, last_id = _rewind(mark, self.lookback), ""
+        while True:
+            params = {
+                "$select": "%s, %s, *" % (id_column, updated_column),
+                "$order": "%s, %s" % (updated_column, id_column),
+                "$limit": self.page_size,
+            }
+            where = _after(mark, last_id)
+            if where is not None:
+                params["$where"] = where
+            rows = await self.downloader.soda(job.domain, job.resource_id, **params)
+            if rows:
+                self._commit(self._apply, job, rows)
+                mark, last_id = rows[-1][updated_column], rows[-1][id_column]
+            if len(rows) < self.page_size:
+                break
+        if not job.state["seeded"]:
+            self._commit(self._seeded, job)
+
+    def _local(self, job, select, lo, hi, suffix=""):
+        self._resolve(job)
+        q = "SELECT %s FROM %s WHERE %s%s" % (
+            select,
+            _qualified(job.resource_id, job.schema),
+            _id_range(lo, hi, '"%s"' % id_column),
+            suffix,
+        )
+        return [r[0] for r in self.S.connection().exec_driver_sql(q)]
+
+    async def _remote_count(self, job, lo, hi):
+        params = {"$select": "count(*) AS n"}
+        if lo is not None or hi is not None:
+            params["$where"] = _id_range(lo, hi)
+        rows = await self.downloader.soda(job.domain, job.resource_id, **params)
+        return int(rows[0]["n"]) if rows else 0
+
+    async def _missing(self, job, ids):
+        where = "%s IN (%s)" % (id_column, ", ".join(_literal(i) for i in ids))
+        rows = await self.downloader.soda(
+            job.domain,
+            job.resource_id,
+            **{"$select": id_column, "$where": where, "$limit": len(ids)},
+        )
+        return sorted(set(ids) - set(r[id_column] for r in rows))
+
+    def _delete(self, job, ids):
+        self._resolve(job)
+        rowids = self._rowids(job, ids)
+        self.S.connection().exec_driver_sql(
+            'DELETE FROM %s WHERE "%s" IN (SELECT value FROM json_each(?))'
+            % (_qualified(job.resource_id, job.schema), id_column),
+            (json.dumps(ids),),
+        )
+        self._refresh_spatial(job, rowids)
+        job.deleted += len(ids)
+        self._save_state(job, deleted=job.state["deleted"] + len(ids))
+
+    async def _deletions(self, job):
+        local = self._local(job, "count(*)", None, None)[0]
+        remote = await self._remote_count(job, None, None)
+        if local < remote:
+            log.warning("fewer rows than the source", resource_id=job.resource_id, rows=local)
+        ranges = [(None, None, local, remote)]
+        while ranges:
+            lo, hi, n_local, n_remote = ranges.pop()
+            # a range with rows added since the pull can hide a deletion until the next sync
+            if n_local <= n_remote:
+                continue
+            if n_remote == 0 or n_local <= self.leaf_size:
+                # an empty count is not proof on its own (a stale or filtered count would wipe
+                # the range) so every id is still checked against the source
+                local_ids = self._local(job, '"%s"' % id_column, lo, hi)
+                ids = []
+                for i in range(0, len(local_ids), self.leaf_size):
+                    ids.extend(await self._missing(job, local_ids[i : i + self.leaf_size]))
+            else:
+                mid = self._local(
+                    job, '"%s"' % id_column, lo, hi, ' ORDER BY "%s" LIMIT 1 OFFSET %d'
+                    % (id_column, n_local // 2)
+                )[0]
+                halves = ((lo, mid), (mid, hi))
+                counts = await asyncio.gather(*[self._remote_count(job, a, b) for a, b in halves])
+                for (a, b), n in zip(halves, counts):
+                    ranges.append((a, b, self._local(job, "count(*)", a, b)[0], n))
+                continue
+            if ids:
+                self._commit(self._delete, job, ids)
+
+    async def sync(self, resource_id):
+        """
+        bring one resource's table up to date. Returns the rows upserted and deleted"""
+        t0 = time.perf_counter()
+        job = _Job()
+        job.resource_id = resource_id
+        job.domain = self._domain(resource_id)
+        job.schema = self.schema
+        job.unknown = set()
+        job.upserted = job.deleted = 0
+        self._commit(self._prepare, job)
+        seeding = not job.state["seeded"]
+        await self._pull(job)
+        await self._deletions(job)
+        if job.upserted or job.deleted:
+            invalidate_session(self.S, job.schema or "main")
+        log.info(
+            "Done syncing dataset",
+            resource_id=resource_id,
+            seeding=seeding,
+            upserted=job.upserted,
+            deleted=job.deleted,
+            high_water_mark=job.state["high_water_mark"],
+            seconds=round(time.perf_counter() - t0, 3),
+        )
+        return dict(upserted=job.upserted, deleted=job.deleted)
+
+
+def sync_datasets(
+    S,
+    resource_ids,
+    schema=None,
+    router=None,
+    max_concurrent=4,
+    page_size=page_size,
+    lookback=lookback,
+    spatial_index=True,
+    **kwargs
+):
+    """
+    synchronous entry point: sync the resources, max_concurrent at a time. kwargs go to the
+    Downloader. Returns a dict of resource_id to {upserted, deleted} (or the exception)"""
+
+    async def run():
+        async with Downloader(**kwargs) as d:
+            sync = DatasetSync(
+                S,
+                d,
+                schema=schema,
+                router=router,
+                page_size=page_size,
+                lookback=lookback,
+                spatial_index=spatial_index,
+            )
+            semaphore = asyncio.Semaphore(max_concurrent)
+
+            async def one(resource_id):
+                async with semaphore:
+                    return await sync.sync(resource_id)
+
+            t0 = time.perf_counter()
+            results = await asyncio.gather(
+                *[one(r) for r in resource_ids], return_exceptions=True
+            )
+            statuses = dict(zip(resource_ids, results))
+            for resource_id, status in statuses.items():
+                if isinstance(status, Exception):
+                    log.error("problem syncing dataset", resource_id=resource_id, error=str(status))
+            log.info(
+                "Done syncing datasets",
+                datasets=len(statuses),
+                bytes=d.bytes_downloaded,
+                seconds=round(time.perf_counter() - t0, 3),
+            )
+            return statuses
+
+    return asyncio.run(run())
@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from cleanknit.socrata.download import Downloader
+
+# fetch_export against a stub export server that does conditional and range requests the way
+# the Socrata one does
+
+body = b"".join(b"%d,row %d\n" % (i, i) for i in range(1000))
+etag = '"v2"'
+last_modified = "Sat, 22 Jan 2022 03:56:01 GMT"
+
+
+def export_app(requests):
+    async def export(request):
+        requests.append(dict(request.headers))
+        headers = {"ETag": etag, "Last-Modified": last_modified}
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+        range_ = request.headers.get("Range")
+        if range_ and request.headers.get("If-Range") in (etag, last_modified):
+            offset = int(range_[len("bytes=") :].rstrip("-"))
+            if offset >= len(body):
+                return web.Response(status=416, headers={"Content-Range": "bytes */%d" % len(body)})
+            headers["Content-Range"] = "bytes %d-%d/%d" % (offset, len(body) - 1, len(body))
+            return web.Response(status=206, body=body[offset:], headers=headers)
+        return web.Response(body=body, headers=headers)
+
+    app = web.Application()
+    app.router.add_get("/{resource_id}.csv", export)
+    return app
+
+
+def fetch(output_dir, requests):
+    async def run():
+        async with TestServer(export_app(requests)) as server:
+            domain = "%s:%d" % (server.host, server.port)
+            export_url = "http://{domain}/{resource_id}.csv"
+            async with Downloader(output_dir=output_dir, export_url=export_url) as d:
+                return await d.fetch_export(domain, "abcd-1234")
+
+    return asyncio.run(run())
+
+
+def write(path, data):
+    with open(path, "wb" if isinstance(data, bytes) else "w") as fp:
+        fp.write(data)
+
+
+def read(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def test_download(tmp_path):
+    requests = []
+    assert fetch(tmp_path, requests) == "downloaded"
+    assert read(tmp_path / "abcd-1234.csv") == body
+    assert read(tmp_path / "abcd-1234.csv.etag") == etag.encode()
+    assert sorted(os.listdir(tmp_path)) == ["abcd-1234.csv", "abcd-1234.csv.etag"]
+    assert "Range" not in requests[0]
+
+
+def test_not_modified(tmp_path):
+    requests = []
+    fetch(tmp_path, requests)
+    assert fetch(tmp_path, requests) == "not-modified"
+    assert requests[1]["If-None-Match"] == etag
+    assert "If-Modified-Since" in requests[1]
+    assert read(tmp_path / "abcd-1234.csv") == body
+
+
+def test_resume(tmp_path):
+    write(tmp_path / "abcd-1234.csv.part", body[:1234])
+    write(tmp_path / "abcd-1234.csv.part.etag", etag)
+    requests = []
+    assert fetch(tmp_path, requests) == "resumed"
+    assert requests[0]["Range"] == "bytes=1234-"
+    assert requests[0]["If-Range"] == etag
+    assert read(tmp_path / "abcd-1234.csv") == body
+    assert sorted(os.listdir(tmp_path)) == ["abcd-1234.csv", "abcd-1234.csv.etag"]
+
+
+def test_resume_last_modified(tmp_path):
+    write(tmp_path / "abcd-1234.csv.part", body[:10])
+    write(tmp_path / "abcd-1234.csv.part.etag", last_modified)
+    requests = []
+    assert fetch(tmp_path, requests) == "resumed"
+    assert requests[0]["If-Range"] == last_modified
+    assert read(tmp_path / "abcd-1234.csv") == body
+
+
+def test_resume_etag_mismatch(tmp_path):
+    # the .part is of a version the server no longer has so it sends the whole thing
+    write(tmp_path / "abcd-1234.csv.part", b"stale")
+    write(tmp_path / "abcd-1234.csv.part.etag", '"v1"')
+    requests = []
+    assert fetch(tmp_path, requests) == "downloaded"
+    assert requests[0]["If-Range"] == '"v1"'
+    assert read(tmp_path / "abcd-1234.csv") == body
+    assert sorted(os.listdir(tmp_path)) == ["abcd-1234.csv", "abcd-1234.csv.etag"]
+
+
+def test_resume_without_validator(tmp_path):
+    write(tmp_path / "abcd-1234.csv.part", b"stale")
+    requests = []
+    assert fetch(tmp_path, requests) == "downloaded"
+    assert "Range" not in requests[0]
+    assert read(tmp_path / "abcd-1234.csv") == body
+
+
+def test_range_not_satisfiable(tmp_path):
+    write(tmp_path / "abcd-1234.csv.part", body + b"more")
+    write(tmp_path / "abcd-1234.csv.part.etag", etag)
+    requests = []
+    assert fetch(tmp_path, requests) == "downloaded"
+    assert len(requests) == 2 and "Range" not in requests[1]
+    assert read(tmp_path / "abcd-1234.csv") == body
+    assert sorted(os.listdir(tmp_path)) == ["abcd-1234.csv", "abcd-1234.csv.etag"]
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import sqlite3
+
+import aiohttp
+import pysqlite3
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from cleanknit.socrata.download import Downloader
+from cleanknit.socrata.model import (
+    _socrata_sqlalchemy_metadata,
+    domain,
+    resource,
+    resource_column,
+)
+from cleanknit.socrata.sync import DatasetSync
+
+# DatasetSync against a stub SODA server. The stub keeps the rows in SQLite and runs the
+# SoQL the sync sends as SQL, which it is close enough to
+
+resource_id = "abcd-1234"
+
+
+class StubSoda:
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE rows (id TEXT PRIMARY KEY, updated_at TEXT, doc TEXT)")
+        self.requests = []
+        # the number of requests to answer before failing the rest
+        self.fail_after = None
+        self.second = 0
+
+    def stamp(self):
+        self.second += 1
+        return "2024-01-01T00:%02d:%02d.000Z" % divmod(self.second, 60)
+
+    def put(self, id_, doc, updated_at=None):
+        self.db.execute(
+            "INSERT OR REPLACE INTO rows VALUES (?, ?, ?)",
+            (id_, updated_at or self.stamp(), json.dumps(doc)),
+        )
+
+    def delete(self, id_):
+        self.db.execute("DELETE FROM rows WHERE id = ?", (id_,))
+
+    def rows(self):
+        return dict((r[0], json.loads(r[1])) for r in self.db.execute("SELECT id, doc FROM rows"))
+
+    async def handle(self, request):
+        q = dict(request.query)
+        self.requests.append(q)
+        if self.fail_after is not None:
+            if self.fail_after <= 0:
+                raise web.HTTPServiceUnavailable()
+            self.fail_after -= 1
+        where = q.get("$where", "1").replace(":updated_at", "updated_at").replace(":id", "id")
+        select = q.get("$select", "*")
+        if select.startswith("count"):
+            n = self.db.execute("SELECT count(*) FROM rows WHERE %s" % where).fetchone()[0]
+            return web.json_response([{"n": str(n)}])
+        sql = "SELECT id, updated_at, doc FROM rows WHERE %s" % where
+        if "$order" in q:
+            sql += " ORDER BY updated_at, id"
+        if "$limit" in q:
+            sql += " LIMIT %d" % int(q["$limit"])
+        out = []
+        for id_, updated_at, doc in self.db.execute(sql):
+            row = {":id": id_}
+            if select != ":id":
+                row.update(json.loads(doc), **{":updated_at": updated_at})
+            out.append(row)
+        return web.json_response(out)
+
+
+def session():
+    S = Session(bind=create_engine("sqlite://", module=pysqlite3))
+    S.execute("ATTACH DATABASE ':memory:' AS socrata")
+    S.commit()
+    _socrata_sqlalchemy_metadata.create_all(bind=S.connection())
+    S.execute(domain.insert().values(domain="data.example.gov", _resources="0" * 40))
+    S.execute(
+        resource.insert().values(
+            domain="data.example.gov", resource_id=resource_id, resource="0" * 40
+        )
+    )
+    S.execute(
+        resource_column.insert(),
+        [
+            dict(
+                resource_id=resource_id,
+                field_number=i,
+                field_name=f,
+                data_type=t,
+                name=f,
+                description="",
+            )
+            for i, (f, t) in enumerate((("name", "Text"), ("n", "Number")))
+        ],
+    )
+    S.commit()
+    return S
+
+
+def sync(S, stub, **kwargs):
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{domain}/{resource_id}.json", stub.handle)
+        async with TestServer(app) as server:
+            soda_url = "http://%s:%d/{domain}/{resource_id}.json" % (server.host, server.port)
+            async with Downloader(soda_url=soda_url) as d:
+                return await DatasetSync(S, d, **kwargs).sync(resource_id)
+
+    return asyncio.run(run())
+
+
+def local_rows(S):
+    rows = S.connection().exec_driver_sql('SELECT ":id", name, n FROM "%s"' % resource_id)
+    return dict((r[0], dict(name=r[1], n=str(r[2]))) for r in rows)
+
+
+def sync_state(S):
+    return S.connection().exec_driver_sql("SELECT * FROM sync_state").mappings().first()
+
+
+def populate(stub, n, updated_at=None):
+    for i in range(n):
+        stub.put("row-%04d" % i, dict(name="row %d" % i, n=str(i)), updated_at)
+
+
+def test_seed():
+    S, stub = session(), StubSoda()
+    populate(stub, 120)
+    assert sync(S, stub, page_size=50) == dict(upserted=120, deleted=0)
+    assert local_rows(S) == stub.rows()
+    state = sync_state(S)
+    assert state["seeded"] and state["last_id"] == "row-0119"
+    # nothing changed: a page of nothing and a count
+    n = len(stub.requests)
+    assert sync(S, stub, page_size=50, lookback=0) == dict(upserted=0, deleted=0)
+    assert len(stub.requests) - n == 2
+    # the rows stamped in the lookback before the mark are read again
+    assert sync(S, stub, page_size=50, lookback=10) == dict(upserted=11, deleted=0)
+
+
+def test_keyset_paging_equal_updated_at():
+    # a bulk update gives every row the one :updated_at, which $offset paging would get wrong
+    # if rows changed between pages
+    S, stub = session(), StubSoda()
+    populate(stub, 120, "2024-01-01T00:00:00.000Z")
+    assert sync(S, stub, page_size=50, lookback=0) == dict(upserted=120, deleted=0)
+    assert local_rows(S) == stub.rows()
+    pages = [q for q in stub.requests if "$order" in q]
+    assert len(pages) == 3
+    assert "$where" not in pages[0]
+    assert ":id > 'row-0049'" in pages[1]["$where"]
+    assert ":id > 'row-0099'" in pages[2]["$where"]
+
+    stub.put("row-0500", dict(name="new", n="500"), "2024-01-01T00:00:00.000Z")
+    stub.put("row-0001", dict(name="updated", n="1"))
+    assert sync(S, stub, page_size=50, lookback=0) == dict(upserted=2, deleted=0)
+    assert local_rows(S) == stub.rows()
+
+
+def test_resume_after_failure():
+    S, stub = session(), StubSoda()
+    populate(stub, 120)
+    stub.fail_after = 1
+    with pytest.raises(aiohttp.ClientResponseError):
+        sync(S, stub, page_size=50)
+    # the first page was applied and the mark moved on in the same transaction
+    state = sync_state(S)
+    assert not state["seeded"] and state["last_id"] == "row-0049"
+    assert len(local_rows(S)) == 50
+
+    stub.fail_after = None
+    n = len(stub.requests)
+    assert sync(S, stub, page_size=50) == dict(upserted=70, deleted=0)
+    assert ":id > 'row-0049'" in stub.requests[n]["$where"]
+    assert local_rows(S) == stub.rows()
+    assert sync_state(S)["seeded"]
+
+
+def test_deletions():
+    S, stub = session(), StubSoda()
+    populate(stub, 400)
+    sync(S, stub, page_size=100)
+    deleted = ["row-0003", "row-0150", "row-0151", "row-0333"]
+    for id_ in deleted:
+        stub.delete(id_)
+    n = len(stub.requests)
+    assert sync(S, stub, page_size=100, leaf_size=20, lookback=0) == dict(upserted=0, deleted=4)
+    assert local_rows(S) == stub.rows()
+    # the ranges with nothing deleted are not looked at any closer
+    looked_up = [q for q in stub.requests[n:] if q.get("$select") == ":id"]
+    assert 0 < len(looked_up) <= len(deleted)
+    assert sum(q["$where"].count("'row-") for q in looked_up) < 100
+
+    # everything deleted: every id is still confirmed missing before it goes
+    for id_ in list(stub.rows()):
+        stub.delete(id_)
+    assert sync(S, stub, page_size=100, leaf_size=20, lookback=0) == dict(upserted=0, deleted=396)
+    assert local_rows(S) == {}